@@ -6,6 +6,11 @@ class ApiAppConfig(AppConfig):
     name = 'api_app'
     
     def ready(self):
+        # connect the signals that keep the card catalog, the cosmetics and the leaderboard up to date
+        import api_app.services.card_catalog
+        import api_app.services.cosmetics_cache
+        import api_app.services.leaderboard
+
         # Import and start the scheduler when Django is fully loaded
         # Avoid running scheduler in some management commands like migrations
         import sys
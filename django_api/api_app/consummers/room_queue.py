@@ -0,0 +1,48 @@
+import asyncio
+
+
+class RoomCommandQueue:
+    """
+    Run the commands of a room one after the other, in the order they arrived.
+    Every socket of a room goes through the same queue, so two players acting at
+    once never interleave their database work and the broadcasts keep the order
+    of the moves. A queue only lives while it has work, then it removes itself.
+    """
+    rooms = {} # room id -> RoomCommandQueue
+
+    def __init__(self, room_id):
+        self.room_id = room_id
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+    @classmethod
+    def get(cls, room_id) -> "RoomCommandQueue":
+        if room_id not in cls.rooms:
+            cls.rooms[room_id] = cls(room_id)
+        return cls.rooms[room_id]
+
+    @classmethod
+    async def run(cls, room_id, command, *args):
+        """queue a coroutine function of the room and wait for its result"""
+        room_queue = cls.get(room_id)
+        future = asyncio.get_running_loop().create_future()
+        room_queue.queue.put_nowait((command, args, future))
+        if room_queue.worker is None:
+            room_queue.worker = asyncio.create_task(room_queue._work())
+        return await future
+
+    async def _work(self):
+        while not self.queue.empty():
+            command, args, future = self.queue.get_nowait()
+            try:
+                result = await command(*args)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                # the socket may have been closed while waiting
+                if not future.done():
+                    future.set_result(result)
+        # nothing left to do, the next command will create a new queue
+        if self.rooms.get(self.room_id) is self:
+            del self.rooms[self.room_id]
@@ -0,0 +1,97 @@
+import time
+from collections import deque
+from django.conf import settings
+from api_app.services.game_snapshot import apply_patch
+
+# game messages kept per room for the sockets that reconnect
+BUFFER_SIZE = getattr(settings, "UNO_REPLAY_BUFFER_SIZE", 64)
+# the buffer of a room nothing was sent to for this long is dropped
+IDLE_SECONDS = 600
+
+UNKNOWN = object() # the game at a point the buffer can't rebuild
+
+
+def game_after(game, event:dict):
+    """the game once a websocket_game_state or websocket_game_patch event is applied"""
+    if event["type"] == "websocket_game_state":
+        return event["game"]
+    if game is UNKNOWN or game is None or game["version"] != event["base_version"]:
+        return UNKNOWN
+    return apply_patch(game, event["patch"])
+
+
+class RoomReplay:
+    """
+    The last game messages of a room received by this process, so a socket that reconnects
+    with the sequence it got last only receives what it missed instead of the whole game.
+    The messages are numbered by their sender with room_sequence.next(), shared by every
+    process, and each process keeps the ones its sockets receive. Keeps at most BUFFER_SIZE
+    messages and the game before the oldest one, the game at any kept sequence is rebuilt from it.
+    A number that never arrived (no socket of the room here, or a late message) drops
+    what was kept before it
+    """
+    rooms = {} # room id -> RoomReplay
+    last_cleanup = time.monotonic()
+
+    def __init__(self):
+        self.sequence = 0 # of the last message kept
+        self.messages = deque() # the group events, with their "sequence"
+        self.base = UNKNOWN # the game before the oldest message
+        self.last_used = time.monotonic()
+
+    @classmethod
+    def get(cls, room_id) -> "RoomReplay":
+        now = time.monotonic()
+        if now - cls.last_cleanup > 60:
+            cls.last_cleanup = now
+            for idle_room in [room for room, replay in cls.rooms.items() if now - replay.last_used > IDLE_SECONDS]:
+                del cls.rooms[idle_room]
+        if room_id not in cls.rooms:
+            cls.rooms[room_id] = cls()
+        replay = cls.rooms[room_id]
+        replay.last_used = now
+        return replay
+
+    @property
+    def first_sequence(self) -> int:
+        """the sequence the base is at"""
+        return self.sequence - len(self.messages)
+
+    def add(self, event:dict):
+        """keep a message received from the room, once when several sockets receive it"""
+        if event["sequence"] <= self.sequence:
+            return
+        if event["sequence"] != self.sequence + 1:
+            # the messages in between are not here, nothing before can be rebuilt
+            self.messages.clear()
+            self.base = UNKNOWN
+        self.sequence = event["sequence"]
+        self.messages.append(event)
+        while len(self.messages) > BUFFER_SIZE:
+            self.base = game_after(self.base, self.messages.popleft())
+
+    def seed(self, game, sequence:int):
+        """the game loaded once `sequence` was the last message of the room"""
+        if sequence > self.sequence or (sequence == self.sequence and self.game_at(sequence) is UNKNOWN):
+            self.messages.clear()
+            self.base = game
+            self.sequence = sequence
+
+    def game_at(self, sequence:int):
+        game = self.base
+        for event in self.messages:
+            if event["sequence"] > sequence:
+                break
+            game = game_after(game, event)
+        return game
+
+    def resume(self, sequence:int, last_sequence:int):
+        """(the game at `sequence`, the events sent since), None when they are not kept.
+        `last_sequence` is the shared one, the messages after it are still to come
+        """
+        if self.sequence != last_sequence or not self.first_sequence <= sequence <= self.sequence:
+            return None
+        game = self.game_at(sequence)
+        if game is UNKNOWN:
+            return None
+        return game, [event for event in self.messages if event["sequence"] > sequence]
@@ -1,251 +1,453 @@
-import datetime
-import json
-from channels.generic.websocket import JsonWebsocketConsumer
-from asgiref.sync import async_to_sync
+import asyncio
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from channels.db import database_sync_to_async
 from rest_framework_simplejwt.tokens import AccessToken
 from django.contrib.auth import get_user_model
 User = get_user_model()
 from urllib.parse import parse_qs
 from api_app.models import Room
 from api_app.services import uno_game_service
-from api_app.models.uno import UnoGame, UnoCard
+from api_app.services.live_games import live_games
+from api_app.services.card_catalog import get_catalog
+from api_app.services.game_snapshot import apply_patch, compact_cards, diff_game, project_for_viewer
+from api_app.services.presence import TTL as PRESENCE_TTL, presence
+from api_app.services.room_sequence import room_sequence
+from api_app.models.uno import UnoGame
+from api_app.consummers.room_queue import RoomCommandQueue
+from api_app.consummers.room_replay import RoomReplay
+import msgpack
 
+# clients asking for this subprotocol (or ?format=msgpack) get MessagePack frames
+# where cards are only ids, resolved with the catalog sent when connecting
+MSGPACK_SUBPROTOCOL = "uno.msgpack"
+
+
+def expected_version(content:dict):
+    """the game version a command was made on, None when the client did not send one"""
+    version = content.get("version", None)
+    if version is None:
+        return None
+    if isinstance(version, str) and version.isdigit():
+        return int(version)
+    if not isinstance(version, int) or isinstance(version, bool):
+        raise ValueError("The version must be a whole number")
+    return version
+
+
+class UnoGameConsummer(AsyncJsonWebsocketConsumer):
+    async def connect(self):
+        query_string = parse_qs(self.scope["query_string"].decode())
+        # binary frames if asked for, json otherwise
+        subprotocol = MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", [])
+        self.binary = subprotocol or query_string.get("format", [None])[0] == "msgpack"
+        await self.accept(subprotocol=MSGPACK_SUBPROTOCOL if self.binary and subprotocol else None)
 
-class UnoGameConsummer(JsonWebsocketConsumer):
-    # Class variable to track connected users per room
-    connected_users = {}
-    
-    def connect(self):
-        self.accept()
         self.room_id = self.scope["url_route"]["kwargs"]["pk"]
         self.room_group_name = f"uno_game_{self.room_id}"
+        # last game snapshot this socket knows, patches are applied on it
+        self.game_state = None
+        # the sequence of the last game message sent to this socket, see RoomReplay
+        self.sequence = None
 
-        query_string = parse_qs(self.scope["query_string"].decode())
         token = query_string.get("token", [None])[0]
+        # clients that can apply patches only receive what changed after each move
+        self.deltas = query_string.get("deltas", ["0"])[0] == "1"
+        # a client that reconnects gives the sequence it got last, and only gets what it missed
+        last_sequence = query_string.get("last_seq", [None])[0]
+        self.resume_from = int(last_sequence) if last_sequence and last_sequence.isdigit() else None
 
         if token:
             try:
                 # Validate token and get user
                 access_token = AccessToken(token)
                 user_id = access_token["user_id"]
-                self.user = User.objects.get(id=user_id)
-                if self.user.room_id != self.room_id:
-                    raise Exception(f"User tried to connect to a room he is not in")
+                self.user, self.room = await self.get_user_and_room(user_id)
                 self.scope["user"] = self.user
-                self.room = Room.objects.get(id=self.room_id)
             except Exception as e:
-                self.send_json({
+                await self.send_json({
                     "type": "error",
                     "error": str(e)
                 })
-                self.close(code=3003, reason=str(e))
+                await self.close(code=3003, reason=str(e))
                 return
         else:
-            self.close(code=3000, reason="Token not provided")
+            await self.close(code=3000, reason="Token not provided")
             return
 
         if not self.user.is_authenticated:
-            self.close()
+            await self.close()
             return
 
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.room_group_name, self.channel_name
         )
-        
-        # Track connected user
-        if self.room_id not in self.connected_users:
-            self.connected_users[self.room_id] = set()
-        self.connected_users[self.room_id].add(self.user.id)
-        
-        # if the game has started, send the game state
-        # if the game has not started, send the player count
-        try:
-            game_service = self.get_game_service()
-            if game_service :
-                self._send_game_state()
-            else :
-                self._send_player_count()
-        except ValueError:
-            self._send_player_count()
-    
-    def _send_player_count(self):
+
+        if self.binary:
+            catalog = await database_sync_to_async(get_catalog)()
+            await self.send_json({
+                "type": "card_catalog",
+                "version": catalog.version, # the version of cards/catalog/
+                "cards": catalog.to_list(),
+            })
+
+        # Track connected user, in the registry shared by every process
+        self.joined = await database_sync_to_async(presence.join)(self.room_id, self.user.id, self.channel_name)
+        self.heartbeat = asyncio.create_task(self._heartbeat())
+        if self.joined:
+            # a new player for the others, a reconnection changes nothing for them
+            await self._send_player_count()
+
+        # only this socket gets the game, or what it missed of it
+        await RoomCommandQueue.run(self.room_id, self.send_initial_state)
+
+    @database_sync_to_async
+    def get_user_and_room(self, user_id):
+        user = User.objects.get(id=user_id)
+        if user.room_id != self.room_id:
+            raise Exception(f"User tried to connect to a room he is not in")
+        return user, Room.objects.get(id=self.room_id)
+
+    async def send_initial_state(self):
+        """runs in the command queue of the room, no message is sent to the room by this process meanwhile"""
+        replay = RoomReplay.get(self.room_id)
+        # this socket is in the group already, the messages numbered after this one reach it
+        last_sequence = await database_sync_to_async(room_sequence.last)(self.room_id)
+        resumed = replay.resume(self.resume_from, last_sequence) if self.resume_from is not None else None
+        if resumed is not None:
+            self.game_state, missed = resumed
+            self.sequence = self.resume_from
+            for event in missed:
+                await getattr(self, event["type"])(event)
+            return
+
+        self.sequence = last_sequence
+        snapshot = await self.load_snapshot()
+        replay.seed(snapshot, last_sequence)
+        if snapshot is not None:
+            await self.websocket_game_state({"game": snapshot})
+        elif not self.joined:
+            # the others were not told, this user was already there
+            await self.websocket_player_count({"count": await database_sync_to_async(presence.count)(self.room_id)})
+
+    async def _heartbeat(self):
+        """keep this socket in the room, it leaves if the process dies"""
+        while True:
+            await asyncio.sleep(PRESENCE_TTL / 3)
+            try:
+                await database_sync_to_async(presence.heartbeat)(self.room_id, self.user.id, self.channel_name)
+            except Exception as e:
+                print(f"Failed to send presence heartbeat of room {self.room_id}: {str(e)}")
+
+    async def _send_player_count(self):
         """Send the current WebSocket player count to all users in the room"""
-        player_count = len(self.connected_users.get(self.room_id, set()))
-        async_to_sync(self.channel_layer.group_send)(
+        player_count = await database_sync_to_async(presence.count)(self.room_id)
+        await self.channel_layer.group_send(
             self.room_group_name,
             {
                 "type": "websocket_player_count",
                 "count": player_count
             }
         )
-    
-    def _send_game_state(self):
-        """Send the current WebSocket game state to all users in the room"""
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                "type": "websocket_game_state",
-            }
-        )
-    
-    def websocket_player_count(self, event):
+
+    async def _send_game_message(self, event):
+        """number a game message with the sequence shared by the processes and send it to the room.
+        Taken once the move is committed, a game loaded after reading a number has every move numbered before
+        """
+        sequence = await database_sync_to_async(room_sequence.next)(self.room_id)
+        if sequence is None:
+            return # the room was deleted, nobody is left to tell
+        event["sequence"] = sequence
+        await self.channel_layer.group_send(self.room_group_name, event)
+
+    async def _send_game_state(self, snapshot):
+        """Send the current WebSocket game state to all users in the room
+        the game is rendered once by the sender, recipients only project it for their user
+        """
+        await self._send_game_message({
+            "type": "websocket_game_state",
+            "game": snapshot,
+        })
+
+    async def _send_game_update(self, before, after):
+        """Send what the last move changed to all users in the room
+        `before` and `after` are the snapshots of the game around the move
+        """
+        patch = diff_game(before, after)
+        if patch is None:
+            await self._send_game_state(after)
+            return
+        await self._send_game_message({
+            "type": "websocket_game_patch",
+            "base_version": before["version"],
+            "version": after["version"],
+            "patch": patch,
+        })
+
+    def _snapshot(self, game_service):
+        """the snapshot of the game before a move, from the cache if it is up to date"""
+        if self.game_state is not None and self.game_state["version"] == game_service.game.version:
+            return self.game_state
+        return game_service.to_dict()
+
+    async def send_json(self, content, close=False):
+        if self.binary:
+            await self.send(bytes_data=msgpack.packb(content), close=close)
+        else:
+            await super().send_json(content, close)
+
+    async def receive(self, text_data=None, bytes_data=None, **kwargs):
+        if bytes_data is not None and self.binary:
+            await self.receive_json(msgpack.unpackb(bytes_data), **kwargs)
+        else:
+            await super().receive(text_data, bytes_data, **kwargs)
+
+    def _project(self, game):
+        """what this socket's user sees of the game, in the format of the socket"""
+        projection = project_for_viewer(game, self.user.id)
+        return compact_cards(projection) if self.binary else projection
+
+    async def websocket_player_count(self, event):
         """Handle player count event and send to client"""
-        self.send_json({
+        await self.send_json({
             "type": "player_count",
             "count": event["count"]
         })
-    
-    def websocket_game_state(self, event):
+
+    def _already_sent(self, event) -> bool:
+        """True for a room message this socket got (or skipped) when it resumed or loaded the game"""
+        if "sequence" not in event:
+            return False
+        RoomReplay.get(self.room_id).add(event)
+        return self.sequence is not None and event["sequence"] <= self.sequence
+
+    def _follows(self, event) -> bool:
+        """False when a message numbered before this one has not arrived (late, or another
+        process sent it first), the game is then loaded again instead of patched
+        """
+        return self.sequence is None or event["sequence"] == self.sequence + 1
+
+    async def websocket_game_state(self, event):
         """ Send the game state to the user
-        other players' hands and the pile are hidden
+        other players' hands and the pile are hidden.
+        The snapshot comes with the event, it is only loaded from the database
+        when it is missing (the client asked for a sync or missed a move)
         """
-        try :
-            game_service = self.get_game_service()
-        except ValueError:
-            self.send_json({
+        if self._already_sent(event):
+            return
+        if "game" in event:
+            self.sequence = event.get("sequence", self.sequence)
+            self.game_state = event["game"]
+        else:
+            # taken before loading, the game has every message numbered up to it
+            self.sequence = await database_sync_to_async(room_sequence.last)(self.room_id)
+            self.game_state = await self.load_snapshot()
+
+        if self.game_state is None:
+            await self.send_json({
                 "type": "game_state",
+                "sequence": self.sequence,
                 "game": None
             })
             return
 
-        game_dict = game_service.game.to_dict()
-        for player in game_dict["players"]:
-            if player["user"]["username"] != self.user.username:
-                player["hand"] = len(player["hand"])
-            else: # if it's the current player, show which card he can play
-                for card in player["hand"]:
-                    card["can_play"] = game_service.can_place(game_service.get_player(self.user), card)
-        game_dict["pile"] = len(game_dict["pile"])
-        
-        self.send_json({
+        await self.send_json({
             "type": "game_state",
-            "game": game_dict
+            "sequence": self.sequence,
+            "game": self._project(self.game_state)
         })
-    
+
+    async def websocket_game_outdated(self, event):
+        """the live game of the room could not be written (see LiveGameRegistry.flush),
+        the players are told and get the game as it is in the database
+        """
+        await self.send_json({
+            "type": "error",
+            "error": event["error"]
+        })
+        await self.websocket_game_state({})
+
+    async def websocket_game_patch(self, event):
+        """ Apply the changes of a move to the known snapshot and send them to the user
+        if this socket missed a move, the full game state is reloaded instead
+        """
+        if self._already_sent(event):
+            return
+        previous = self.game_state
+        if not self._follows(event) or previous is None or previous["version"] != event["base_version"]:
+            await self.websocket_game_state({})
+            return
+        self.sequence = event["sequence"]
+
+        self.game_state = apply_patch(previous, event["patch"])
+        if not self.deltas:
+            await self.send_json({
+                "type": "game_state",
+                "sequence": self.sequence,
+                "game": self._project(self.game_state)
+            })
+            return
+
+        await self.send_json({
+            "type": "game_patch",
+            "sequence": self.sequence,
+            "base_version": event["base_version"],
+            "version": event["version"],
+            "patch": diff_game(
+                self._project(previous),
+                self._project(self.game_state),
+            ),
+        })
+
     def get_game_service(self):
+        if live_games.enabled:
+            return live_games.get(self.room.id, self.load_game_service)
+        return self.load_game_service()
+
+    def load_game_service(self):
         try:
             # Always get a fresh instance from the database
-            game = UnoGame.objects.get(room=self.room)
-            return uno_game_service.UnoGameService(game)
+            game = uno_game_service.load_game(room=self.room)
+            return uno_game_service.UnoGameService(game, write_behind=live_games.enabled)
         except UnoGame.DoesNotExist:
             raise ValueError("No game has been started yet")
 
-    def disconnect(self, close_code):
-        # Remove user from connected users set before disconnecting
-        if hasattr(self, 'room_id') and hasattr(self, 'user'):
-            if self.room_id in self.connected_users and self.user.id in self.connected_users[self.room_id]:
-                self.connected_users[self.room_id].remove(self.user.id)
+    @database_sync_to_async
+    def load_snapshot(self):
+        try:
+            with live_games.lock:
+                return self.get_game_service().to_dict()
+        except ValueError:
+            return None
+
+    async def disconnect(self, close_code):
+        # Remove user from connected users before disconnecting
+        if hasattr(self, "heartbeat"):
+            self.heartbeat.cancel()
+            left = await database_sync_to_async(presence.leave)(self.room_id, self.user.id, self.channel_name)
+            if left:
                 # Send updated player count
-                self._send_player_count()
-                
-                # Clean up empty rooms
-                if not self.connected_users[self.room_id]:
-                    del self.connected_users[self.room_id]
-                
-        async_to_sync(self.channel_layer.group_discard)(
+                await self._send_player_count()
+
+        await self.channel_layer.group_discard(
             self.room_group_name, self.channel_name
         )
 
-    def receive_json(self, content):
-        if content["type"] == "start_game":
-            self.start_game(content)
-        elif content["type"] == "play_card":
-            self.play_card(content)
-        elif content["type"] == "say_uno":
-            self.say_uno(content)
-        elif content["type"] == "deny_uno":
-            self.deny_uno(content)
-        elif content["type"] == "draw_card":
-            self.draw_card(content)
-        elif content["type"] == "restart_game":
-            self.restart_game(content)
-        elif content["type"] == "stop_game":
-            self.stop_game(content)
-        else:
-            self.send_json(
+    async def receive_json(self, content):
+        commands = {
+            "start_game": self.start_game,
+            "play_card": self.play_card,
+            "say_uno": self.say_uno,
+            "deny_uno": self.deny_uno,
+            "draw_card": self.draw_card,
+            "restart_game": self.restart_game,
+            "stop_game": self.stop_game,
+        }
+        if content.get("type") == "sync":
+            # the client lost track of the game, send it the full state again
+            await self.websocket_game_state({})
+            return
+        if content.get("type") not in commands:
+            await self.send_json(
                 {
                     "type": "error",
                     "error": "Invalid message type"
                 }
             )
-    
-    def stop_game(self, content):
-        try :
-            UnoGame.objects.filter(room=self.room).first().delete() 
-        except AttributeError:
-            pass
-
-        async_to_sync(self.channel_layer.group_send)(
-            self.room_group_name,
-            {
-                "type": "websocket_game_state",
-                "game": None
-            }
-        )
+            return
 
-        
-    def restart_game(self, content):
-        UnoGame.objects.filter(room=self.room).first().delete() 
-        self.start_game(content)
+        # commands of a room run one at a time, in order
+        try:
+            await RoomCommandQueue.run(self.room_id, commands[content["type"]], content)
+        except Exception as e:
+            await self.send_json({
+                "type": "error",
+                "error": str(e)
+            })
+            if isinstance(e, uno_game_service.StaleGameError):
+                # the client acted on an old state, give it the current one
+                await self.websocket_game_state({})
 
-    def start_game(self, content):
-        self.room = self.room
+    @database_sync_to_async
+    def _apply(self, command):
+        """load the game, run a service command on it and render the result,
+        all the database work of a move in a single call
+        """
+        with live_games.lock:
+            game_service = self.get_game_service()
+            before = self._snapshot(game_service)
+            command(game_service)
+            if live_games.enabled and game_service.state.game_over:
+                # the end of a game is written right away
+                live_games.flush([self.room.id])
+            return before, game_service.to_dict()
+
+    @database_sync_to_async
+    def _delete_game(self):
+        if live_games.enabled:
+            # the moves not written yet still go to the game log
+            live_games.discard(self.room.id)
+        UnoGame.objects.filter(room=self.room).delete()
+
+    @database_sync_to_async
+    def _start_game(self, player_ids, options):
         if UnoGame.objects.filter(room=self.room).exists():
-            self.send_json(
-                {
-                    "type": "error",	
-                    "error": "Game has already been started"
-                }
-            )
-            return
+            raise ValueError("Game has already been started")
 
         game = UnoGame(room=self.room)
-        game_service = uno_game_service.UnoGameService(game)
+        game_service = uno_game_service.UnoGameService(game, write_behind=live_games.enabled)
 
         game_rules = uno_game_service.UnoGameRules()
-        game_rules.players = [get_user_model().objects.get(id=user_id) for user_id in self.connected_users[self.room_id]]
+        game_rules.players = list(User.objects.filter(id__in=player_ids))
+        game_rules.set_options(options)
         game_rules.select_base_deck()
 
         game_service.start_game(game_rules)
-        
-        self._send_game_state()
-    
-    def play_card(self, content):
-        card = UnoCard.objects.get(id=content["card_id"])
-        color = content.get("color", None)
-        game_service = self.get_game_service()
-        try :
-            game_service.play_card(self.user, card, color)
-        except ValueError as e:
-            self.send_json({
-                "type": "error",
-                "error": str(e)
-            })
-            return
-        
-        self._send_game_state()
+        if live_games.enabled:
+            live_games.add(self.room.id, game_service)
+        return game_service.to_dict()
+
+    async def stop_game(self, content):
+        await self._delete_game()
+        await self._send_game_state(None)
 
-    def draw_card(self, content):
-        game_service = self.get_game_service()
-        game_service.draw_card(self.user)
-        
-        self._send_game_state()
-    
-    def say_uno(self, content):
-        print("SAY UNO")
-        game_service = self.get_game_service()
-        game_service.say_uno(self.user)
-        
-        self._send_game_state()
-    
-    def deny_uno(self, content):
-        game_service = self.get_game_service()
-        
-        target_player = User.objects.get(id=content["player_id"])
-        game_service.deny_uno(target_player)
+    async def restart_game(self, content):
+        await self._delete_game()
+        await self.start_game(content)
 
-        self._send_game_state()
+    async def start_game(self, content):
+        player_ids = list(await database_sync_to_async(presence.members)(self.room_id))
+        snapshot = await self._start_game(player_ids, content)
+        await self._send_game_state(snapshot)
 
+    async def play_card(self, content):
+        card_id = int(content["card_id"])
+        color = content.get("color", None)
+        version = expected_version(content)
+        before, after = await self._apply(
+            lambda game_service: game_service.play_card(self.user, card_id, color, expected_version=version)
+        )
+        await self._send_game_update(before, after)
+
+    async def draw_card(self, content):
+        version = expected_version(content)
+        before, after = await self._apply(
+            lambda game_service: game_service.draw_card(self.user, expected_version=version)
+        )
+        await self._send_game_update(before, after)
+
+    async def say_uno(self, content):
+        version = expected_version(content)
+        before, after = await self._apply(
+            lambda game_service: game_service.say_uno(self.user, expected_version=version)
+        )
+        await self._send_game_update(before, after)
 
+    async def deny_uno(self, content):
+        version = expected_version(content)
 
+        def deny(game_service):
+            target_player = User.objects.get(id=content["player_id"])
+            game_service.deny_uno(target_player, expected_version=version)
 
+        before, after = await self._apply(deny)
+        await self._send_game_update(before, after)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 from urllib.parse import parse_qs
 from channels.generic.websocket import AsyncWebsocketConsumer
@@ -6,6 +7,8 @@ from django.contrib.auth import get_user_model
 from django.db import transaction
 User = get_user_model()
 from rest_framework_simplejwt.tokens import AccessToken
+from auth_app.broadcaster import user_broadcaster
+from api_app.services.presence import TTL as PRESENCE_TTL, USER_SOCKETS, presence
 
 class UserConsumer(AsyncWebsocketConsumer):
     async def connect(self):
@@ -39,10 +42,14 @@ class UserConsumer(AsyncWebsocketConsumer):
             self.user_group_name,
             self.channel_name
         )
+        # the updates of this user are sent from this process, the others find the socket in the registry
+        user_broadcaster.subscribe(self.user_id)
+        await database_sync_to_async(presence.join)(USER_SOCKETS, self.user_id, self.channel_name)
+        self.heartbeat = asyncio.create_task(self._heartbeat())
         
         # Send initial user data
         user_data = await self.get_user_data()
-        self.send(text_data=json.dumps({
+        await self.send(text_data=json.dumps({
             "type": "user_data",
             "data": user_data
         }))
@@ -59,6 +66,20 @@ class UserConsumer(AsyncWebsocketConsumer):
             )
         if hasattr(self, "user"):
             await self.set_user_online(self.user.id, False)
+        if hasattr(self, "user_id"):
+            user_broadcaster.unsubscribe(self.user_id)
+        if hasattr(self, "heartbeat"):
+            self.heartbeat.cancel()
+            await database_sync_to_async(presence.leave)(USER_SOCKETS, self.user_id, self.channel_name)
+
+    async def _heartbeat(self):
+        """keep this socket in the registry, it is forgotten if the process dies"""
+        while True:
+            await asyncio.sleep(PRESENCE_TTL / 3)
+            try:
+                await database_sync_to_async(presence.heartbeat)(USER_SOCKETS, self.user_id, self.channel_name)
+            except Exception as e:
+                print(f"Failed to send presence heartbeat of user {self.user_id}: {str(e)}")
     
     async def receive(self, text_data):
         # Handle any client-to-server communication if needed
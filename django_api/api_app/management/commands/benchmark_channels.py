@@ -0,0 +1,24 @@
+import asyncio
+from channels.layers import get_channel_layer
+from django.core.management.base import BaseCommand
+from api_app.services.channel_benchmark import measure_fan_out
+
+
+class Command(BaseCommand):
+    help = 'Measure the group_send fan-out latency of the configured channel layer (CHANNEL_LAYER)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', default='10,100,1000', help='comma separated numbers of rooms')
+        parser.add_argument('--members', type=int, default=4, help='sockets per room')
+        parser.add_argument('--rounds', type=int, default=3)
+
+    def handle(self, *args, **options):
+        layer = get_channel_layer()
+        self.stdout.write(self.style.SUCCESS(f"{type(layer).__name__}:"))
+        for rooms in [int(rooms) for rooms in options['rooms'].split(',')]:
+            report = asyncio.run(measure_fan_out(layer, rooms, options['members'], options['rounds']))
+            result = report.to_dict()
+            self.stdout.write(f"  {result['rooms']} rooms of {result['members']}:")
+            self.stdout.write(f"    p50 fan-out latency:  {result['p50_ms']:.3f} ms")
+            self.stdout.write(f"    p99 fan-out latency:  {result['p99_ms']:.3f} ms")
+            self.stdout.write(f"    deliveries/sec:       {result['deliveries_per_second']:.0f}")
@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from api_app.services.uno_simulation import STRATEGIES, simulate_in_memory, simulate_with_database
+
+
+class Command(BaseCommand):
+    help = 'Play headless games of Uno and report turns/sec, queries per turn, turn latency and memory per game'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=1000, help='games played on the in-memory engine')
+        parser.add_argument('--db-games', type=int, default=20, help='games played through the database (rolled back)')
+        parser.add_argument('--players', type=int, default=4)
+        parser.add_argument('--strategy', choices=sorted(STRATEGIES), default='heuristic')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--mode', choices=['memory', 'database', 'both'], default='both')
+
+    def handle(self, *args, **options):
+        reports = []
+        if options['mode'] in ('memory', 'both'):
+            reports.append(simulate_in_memory(options['games'], options['players'], options['strategy'], options['seed']))
+        if options['mode'] in ('database', 'both'):
+            reports.append(simulate_with_database(options['db_games'], options['players'], options['strategy'], options['seed']))
+
+        for report in reports:
+            result = report.to_dict()
+            self.stdout.write(self.style.SUCCESS(f"{result['mode']}:"))
+            self.stdout.write(f"  games:              {result['games']} ({result['finished_games']} finished)")
+            self.stdout.write(f"  turns:              {result['turns']}")
+            self.stdout.write(f"  turns/sec:          {result['turns_per_second']:.0f}")
+            self.stdout.write(f"  queries per turn:   {result['queries_per_turn']:.2f}")
+            self.stdout.write(f"  p50 turn latency:   {result['p50_ms']:.3f} ms")
+            self.stdout.write(f"  p99 turn latency:   {result['p99_ms']:.3f} ms")
+            if report.mode == 'memory':
+                self.stdout.write(f"  memory per game:    {result['memory_per_game_bytes']} bytes")
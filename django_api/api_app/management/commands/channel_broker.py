@@ -0,0 +1,21 @@
+import asyncio
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from api_app.services.socket_channel_layer import ChannelBroker
+
+
+class Command(BaseCommand):
+    help = 'Run the channel broker shared by the workers of this host (CHANNEL_LAYER=unix)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default=settings.CHANNEL_LAYER_SOCKET, help='the UNIX socket the workers connect to')
+        parser.add_argument('--capacity', type=int, default=settings.CHANNEL_LAYER_CAPACITY, help='messages a channel holds at most')
+        parser.add_argument('--expiry', type=int, default=60, help='seconds a message waits for its receiver')
+
+    def handle(self, *args, **options):
+        broker = ChannelBroker(capacity=options['capacity'], expiry=options['expiry'])
+        self.stdout.write(f"Channel broker listening on {options['path']}")
+        try:
+            asyncio.run(broker.serve(options['path']))
+        except KeyboardInterrupt:
+            pass
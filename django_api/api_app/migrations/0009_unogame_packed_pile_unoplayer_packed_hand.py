@@ -0,0 +1,63 @@
+# Generated by Django 5.1.6 on 2026-10-18 10:12
+
+import api_app.models.fields
+from django.db import migrations
+
+
+def pack_hands_and_piles(apps, schema_editor):
+    UnoPlayer = apps.get_model("api_app", "UnoPlayer")
+    UnoGame = apps.get_model("api_app", "UnoGame")
+    for player in UnoPlayer.objects.all():
+        player.packed_hand = list(player.hand.values_list("id", flat=True))
+        player.save(update_fields=["packed_hand"])
+    for game in UnoGame.objects.all():
+        game.packed_pile = list(game.pile.values_list("id", flat=True))
+        game.save(update_fields=["packed_pile"])
+
+
+def unpack_hands_and_piles(apps, schema_editor):
+    UnoPlayer = apps.get_model("api_app", "UnoPlayer")
+    UnoGame = apps.get_model("api_app", "UnoGame")
+    for player in UnoPlayer.objects.all():
+        player.hand.set(player.packed_hand)
+    for game in UnoGame.objects.all():
+        game.pile.set(game.packed_pile)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api_app", "0008_remove_unogame_card_back"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="unoplayer",
+            name="packed_hand",
+            field=api_app.models.fields.CardListField(verbose_name="main"),
+        ),
+        migrations.AddField(
+            model_name="unogame",
+            name="packed_pile",
+            field=api_app.models.fields.CardListField(blank=True, verbose_name="pioche"),
+        ),
+        migrations.RunPython(pack_hands_and_piles, unpack_hands_and_piles),
+        migrations.RemoveField(
+            model_name="unoplayer",
+            name="hand",
+        ),
+        migrations.RemoveField(
+            model_name="unogame",
+            name="pile",
+        ),
+        migrations.RenameField(
+            model_name="unoplayer",
+            old_name="packed_hand",
+            new_name="hand",
+        ),
+        migrations.RenameField(
+            model_name="unogame",
+            old_name="packed_pile",
+            new_name="pile",
+        ),
+    ]
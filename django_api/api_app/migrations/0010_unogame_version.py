@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api_app", "0009_unogame_packed_pile_unoplayer_packed_hand"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="unogame",
+            name="version",
+            field=models.PositiveIntegerField(default=0, verbose_name="version"),
+        ),
+    ]
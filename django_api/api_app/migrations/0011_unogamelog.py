@@ -0,0 +1,65 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api_app", "0010_unogame_version"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UnoGameLog",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("players", models.JSONField(default=list, verbose_name="joueurs")),
+                ("created_at", models.DateTimeField(auto_now_add=True, verbose_name="date de création")),
+                ("finished_at", models.DateTimeField(blank=True, null=True, verbose_name="date de fin")),
+                ("room", models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="game_logs", to="api_app.room", verbose_name="salle")),
+            ],
+            options={
+                "verbose_name": "historique de partie",
+                "verbose_name_plural": "historiques de parties",
+                "ordering": ["-created_at"],
+            },
+        ),
+        migrations.AddField(
+            model_name="unogame",
+            name="log",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="games", to="api_app.unogamelog", verbose_name="historique"),
+        ),
+        migrations.CreateModel(
+            name="UnoGameEvent",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("sequence", models.PositiveIntegerField(verbose_name="séquence")),
+                ("kind", models.CharField(max_length=20, verbose_name="type")),
+                ("data", models.JSONField(verbose_name="données")),
+                ("log", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="events", to="api_app.unogamelog", verbose_name="historique")),
+            ],
+            options={
+                "verbose_name": "événement de partie",
+                "verbose_name_plural": "événements de parties",
+                "ordering": ["log", "sequence"],
+                "constraints": [models.UniqueConstraint(fields=("log", "sequence"), name="unique_event_sequence")],
+            },
+        ),
+        migrations.CreateModel(
+            name="UnoGameSnapshot",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("sequence", models.PositiveIntegerField(verbose_name="séquence")),
+                ("state", models.JSONField(verbose_name="état")),
+                ("log", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="snapshots", to="api_app.unogamelog", verbose_name="historique")),
+            ],
+            options={
+                "verbose_name": "snapshot de partie",
+                "verbose_name_plural": "snapshots de parties",
+                "ordering": ["log", "sequence"],
+                "constraints": [models.UniqueConstraint(fields=("log", "sequence"), name="unique_snapshot_sequence")],
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:28
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api_app", "0011_unogamelog"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="RoomPresence",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("connection", models.CharField(max_length=255, unique=True, verbose_name="connexion")),
+                ("expires_at", models.DateTimeField(db_index=True, verbose_name="expire le")),
+                ("room", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="presences", to="api_app.room", verbose_name="salle")),
+                ("user", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name="+", to=settings.AUTH_USER_MODEL, verbose_name="utilisateur")),
+            ],
+            options={
+                "verbose_name": "présence",
+                "verbose_name_plural": "présences",
+                "indexes": [models.Index(fields=["room", "user"], name="api_app_roo_room_id_eec6d7_idx")],
+            },
+        ),
+    ]
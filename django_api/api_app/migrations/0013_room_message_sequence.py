@@ -0,0 +1,18 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api_app", "0012_roompresence"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="room",
+            name="message_sequence",
+            field=models.BigIntegerField(default=0, verbose_name="dernier message"),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.6 on 2026-10-18 14:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api_app", "0013_room_message_sequence"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="roompresence",
+            name="room",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name="presences", to="api_app.room", verbose_name="salle"),
+        ),
+    ]
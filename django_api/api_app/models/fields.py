@@ -0,0 +1,53 @@
+import sys
+from array import array
+from django.db import models
+
+
+def pack_cards(card_ids) -> bytes:
+    """card ids -> 2 bytes per card, little endian"""
+    packed = array("H", card_ids)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def unpack_cards(data) -> list:
+    unpacked = array("H")
+    unpacked.frombytes(bytes(data))
+    if sys.byteorder == "big":
+        unpacked.byteswap()
+    return unpacked.tolist()
+
+
+class CardListField(models.BinaryField):
+    """
+    A list of card ids stored as a single packed value.
+    A hand or a pile is read and written in one go, instead of a row per card
+    in a ManyToMany table. Card ids must fit in 16 bits.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("default", list)
+        super().__init__(*args, **kwargs)
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return []
+        return unpack_cards(value)
+
+    def to_python(self, value):
+        if value is None:
+            return []
+        if isinstance(value, list):
+            return value
+        if isinstance(value, str):
+            # value_to_string() format, used by dumpdata/loaddata
+            return [int(card_id) for card_id in value.split(",") if card_id]
+        return unpack_cards(value)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if isinstance(value, (list, tuple)):
+            value = pack_cards(value)
+        return super().get_db_prep_value(value, connection, prepared)
+
+    def value_to_string(self, obj):
+        return ",".join(str(card_id) for card_id in self.value_from_object(obj))
@@ -10,6 +10,8 @@ class Room(models.Model):
     player_limit:int = models.IntegerField(default=8, verbose_name="limite de joueurs")
     is_open:bool = models.BooleanField(default=True, verbose_name="ouverte")
     invitation_code:str = models.CharField(max_length=10, verbose_name="code d'invitation", unique=True)
+    # the number of the last game message sent to the room, see DatabaseSequencer.next
+    message_sequence:int = models.BigIntegerField(default=0, verbose_name="dernier message")
     
     def __str__(self):
         return f"{self.name}"
@@ -128,3 +130,20 @@ class Message(models.Model):
         Update the Message instance with the data from the dictionary
         """
         self.content = data.get("content", self.content)
+
+
+class RoomPresence(models.Model):
+    """a socket connected to the game of a room, kept while its heartbeats come (see api_app.services.presence)"""
+    # no room for the user sockets (presence.USER_SOCKETS)
+    room:Room = models.ForeignKey(Room, on_delete=models.CASCADE, verbose_name="salle", related_name="presences", null=True, blank=True)
+    user:CustomUser = models.ForeignKey(CustomUser, on_delete=models.CASCADE, verbose_name="utilisateur", related_name="+")
+    connection:str = models.CharField(max_length=255, unique=True, verbose_name="connexion") # the channel name of the socket
+    expires_at:datetime = models.DateTimeField(db_index=True, verbose_name="expire le")
+
+    def __str__(self):
+        return f"{self.user_id} - {self.room_id}"
+
+    class Meta:
+        verbose_name = "présence"
+        verbose_name_plural = "présences"
+        indexes = [models.Index(fields=["room", "user"])]
@@ -1,7 +1,9 @@
 from django.db import models
+from django.db.models import prefetch_related_objects
 from django.contrib.auth import get_user_model
 User = get_user_model()
 from django.conf import settings
+from api_app.models.fields import CardListField
 
 # uno cards are readonly. Each game just link to the correct card and doesn't edit it.
 # the images are already there.
@@ -47,7 +49,7 @@ from api_app.models.shop import GameEnvironment
 
 class UnoPlayer(models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE, verbose_name="joueur")
-    hand = models.ManyToManyField(UnoCard, verbose_name="main")
+    hand = CardListField(verbose_name="main")
     player_number = models.IntegerField(verbose_name="numéro de joueur", db_index=True)
     said_uno = models.BooleanField(verbose_name="a dit uno", default=False)
     game = models.ForeignKey("UnoGame", on_delete=models.CASCADE, verbose_name="partie", related_name="players")
@@ -61,14 +63,18 @@ class UnoPlayer(models.Model):
         ordering = ['user']
     
     def to_dict(self) -> dict:
+        from api_app.services.card_catalog import get_catalog
+        from api_app.services.cosmetics_cache import get_cosmetics
+        catalog = get_catalog()
+        cosmetics = get_cosmetics()
         return {
             "id": self.id,
             "user": self.user.to_dict_public(),
             "player_number": self.player_number,
-            "hand": [card.to_dict() for card in self.hand.all()],
+            "hand": [catalog.to_dict(card_id) for card_id in self.hand],
             "said_uno": self.said_uno,
-            "card_back": self.user.card_back.to_dict() if self.user.card_back else CardBack.objects.get(name="default").to_dict(),
-            "game_environment": self.user.game_environment.to_dict() if self.user.game_environment else GameEnvironment.objects.get(name="default").to_dict()
+            "card_back": cosmetics.card_back(self.user.active_card_back_id),
+            "game_environment": cosmetics.game_environment(self.user.active_game_environment_id),
         }
         
     
@@ -76,29 +82,40 @@ class UnoPlayer(models.Model):
 class UnoGame(models.Model):
     current_card = models.ForeignKey(UnoCard, on_delete=models.CASCADE, verbose_name="carte actuelle" , related_name="in_game_current", null=True)
     direction = models.BooleanField(verbose_name="sens du jeu")
-    pile = models.ManyToManyField(UnoCard, verbose_name="pioche", related_name="in_game_piles", blank=True)
+    pile = CardListField(verbose_name="pioche", blank=True)
     current_player_number = models.IntegerField(verbose_name="joueur actuel", null=True)
     room = models.OneToOneField("Room", on_delete=models.CASCADE, verbose_name="salle")
     stored_to_draw = models.IntegerField(verbose_name="cartes à piocher", default=0) # for +2 and +4 cards
     game_over = models.BooleanField(verbose_name="fin de partie")
     winner = models.ForeignKey(UnoPlayer, on_delete=models.CASCADE, verbose_name="gagnant", related_name="won", null=True)
+    version = models.PositiveIntegerField(verbose_name="version", default=0) # of the state in this row, the moves after it are in the log
+    log = models.ForeignKey("UnoGameLog", on_delete=models.SET_NULL, verbose_name="historique", related_name="games", null=True, blank=True)
 
     @property
     def current_player(self) -> UnoPlayer:
         return self.players.get(player_number=self.current_player_number)
     
     
-    def to_dict(self) -> dict:
+    def to_dict(self, players:list=None) -> dict:
+        """`players` can be given when they are already loaded (and maybe not saved yet)"""
+        from api_app.services.card_catalog import get_catalog
+        from api_app.services.cosmetics_cache import get_cosmetics
+        players = list(self.players.all() if players is None else players)
+        # the users in one query, skipped when they are already loaded
+        prefetch_related_objects(players, "user")
+        winner = next((player for player in players if player.id == self.winner_id), None)
         return {
             "id": self.id,
-            "current_card": self.current_card.to_dict(),
+            "version": self.version,
+            "current_card": get_catalog().to_dict(self.current_card_id),
             "direction": self.direction,
-            "pile": [card.to_dict() for card in self.pile.all()],
+            "pile": len(self.pile), # the pile is hidden, only its size is sent
             "game_over": self.game_over,
             "current_player_number": self.current_player_number,
-            "players": [player.to_dict() for player in self.players.all()],
-            "card_back" : CardBack.objects.get(name="default").to_dict(),
-            "winner": self.winner.to_dict() if self.winner else None
+            "stored_to_draw": self.stored_to_draw,
+            "players": [player.to_dict() for player in players],
+            "card_back" : get_cosmetics().card_back(),
+            "winner": winner.to_dict() if winner else None
         }
     
     def __str__(self):
@@ -109,3 +126,70 @@ class UnoGame(models.Model):
         verbose_name_plural = "parties"
         ordering = ['id']
 
+
+
+# every move of a game is appended to its log, with a snapshot of the whole state
+# from time to time. The state at any point is the last snapshot before it plus the
+# events after it (see api_app.services.game_log). The log outlives the UnoGame row.
+class UnoGameLog(models.Model):
+    room = models.ForeignKey("Room", on_delete=models.SET_NULL, verbose_name="salle", related_name="game_logs", null=True)
+    players = models.JSONField(verbose_name="joueurs", default=list) # user id of each player number
+    created_at = models.DateTimeField(verbose_name="date de création", auto_now_add=True)
+    finished_at = models.DateTimeField(verbose_name="date de fin", null=True, blank=True)
+
+    def __str__(self):
+        return f"Historique {self.id}"
+
+    class Meta:
+        verbose_name = "historique de partie"
+        verbose_name_plural = "historiques de parties"
+        ordering = ['-created_at']
+
+    def compact(self) -> int:
+        """forget what comes before the last snapshot, the final state stays rebuildable.
+        Returns the number of rows deleted
+        """
+        last = self.snapshots.order_by("-sequence").first()
+        if last is None:
+            return 0
+        deleted, _ = self.events.filter(sequence__lte=last.sequence).delete()
+        snapshots, _ = self.snapshots.filter(sequence__lt=last.sequence).delete()
+        return deleted + snapshots
+
+
+class UnoGameEvent(models.Model):
+    log = models.ForeignKey(UnoGameLog, on_delete=models.CASCADE, verbose_name="historique", related_name="events")
+    sequence = models.PositiveIntegerField(verbose_name="séquence") # version of the game after the event
+    kind = models.CharField(max_length=20, verbose_name="type")
+    data = models.JSONField(verbose_name="données")
+
+    def __str__(self):
+        return f"{self.kind} {self.sequence}"
+
+    class Meta:
+        verbose_name = "événement de partie"
+        verbose_name_plural = "événements de parties"
+        ordering = ['log', 'sequence']
+        constraints = [
+            models.UniqueConstraint(fields=["log", "sequence"], name="unique_event_sequence"),
+        ]
+
+    def to_event(self) -> dict:
+        return {"type": self.kind, **self.data}
+
+
+class UnoGameSnapshot(models.Model):
+    log = models.ForeignKey(UnoGameLog, on_delete=models.CASCADE, verbose_name="historique", related_name="snapshots")
+    sequence = models.PositiveIntegerField(verbose_name="séquence") # version of the game when it was taken
+    state = models.JSONField(verbose_name="état")
+
+    def __str__(self):
+        return f"Snapshot {self.sequence}"
+
+    class Meta:
+        verbose_name = "snapshot de partie"
+        verbose_name_plural = "snapshots de parties"
+        ordering = ['log', 'sequence']
+        constraints = [
+            models.UniqueConstraint(fields=["log", "sequence"], name="unique_snapshot_sequence"),
+        ]
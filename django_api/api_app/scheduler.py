@@ -93,5 +93,44 @@ def remove_inactive_users_from_rooms():
     except Exception as e:
         print(f"Error in remove_inactive_users_from_rooms: {str(e)}")
 
+@scheduler.register_task(interval=3600)
+def compact_game_logs():
+    from api_app.services.game_log import compact_finished_logs
+
+    try:
+        deleted = compact_finished_logs()
+        if deleted:
+            print(f"Compacted game logs, {deleted} rows removed")
+    except Exception as e:
+        print(f"Error in compact_game_logs: {str(e)}")
+
+@scheduler.register_task(interval=3600)
+def rebuild_leaderboard():
+    # the games update the ranks as they end, this catches the stats changed another way (update() by hand)
+    from api_app.services.leaderboard import rank_store
+
+    try:
+        rank_store.rebuild()
+    except Exception as e:
+        print(f"Error in rebuild_leaderboard: {str(e)}")
+
+@scheduler.register_task(interval=60)
+def sweep_presence():
+    # the sockets of a process that died stop sending heartbeats, their users leave the rooms
+    from asgiref.sync import async_to_sync
+    from channels.layers import get_channel_layer
+    from api_app.services.presence import USER_SOCKETS, presence
+
+    try:
+        left = presence.sweep()
+        channel_layer = get_channel_layer()
+        for room_id in {room_id for room_id, _ in left} - {USER_SOCKETS}:
+            async_to_sync(channel_layer.group_send)(
+                f"uno_game_{room_id}",
+                {"type": "websocket_player_count", "count": presence.count(room_id)},
+            )
+    except Exception as e:
+        print(f"Error in sweep_presence: {str(e)}")
+
 def start_scheduler():
     scheduler.start()
\ No newline at end of file
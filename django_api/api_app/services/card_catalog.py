@@ -0,0 +1,110 @@
+import hashlib
+import json
+from typing import NamedTuple
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from api_app.models.uno import UnoCard
+
+
+class CatalogCard(NamedTuple):
+    id: int
+    color: str
+    action: str
+    is_special: bool
+    image: str
+
+
+class CardCatalog:
+    """
+    Immutable view of every UnoCard, keyed by the card id.
+    Cards never change during a game so the catalog is loaded once per process,
+    every lookup the game needs is precomputed here and is a single dict access.
+    """
+    def __init__(self, cards):
+        self._cards = {}
+        self._by_key = {}
+        self._version = None
+        for card in cards:
+            entry = CatalogCard(card.id, card.color, card.action, card.is_special, str(card.image))
+            self._cards[entry.id] = entry
+            self._by_key[(entry.color, entry.action, entry.is_special)] = entry.id
+
+        self.ids = tuple(sorted(self._cards))
+        # the colors a wild card can take
+        self.colors = tuple(sorted({card.color for card in self._cards.values() if card.is_special and "wild" in card.action}))
+
+        # plain version of a card: a recolored wild goes back to the black one
+        self._plain = {}
+        # wild recolored to a color: (card id, color) -> special card id
+        self._recolored = {}
+        self._dicts = {}
+        for card in self._cards.values():
+            color = card.color if "wild" not in card.action else "black"
+            plain = self._by_key.get((color, card.action, False))
+            if plain is not None:
+                self._plain[card.id] = plain
+            if "wild" in card.action:
+                for wild_color in self.colors:
+                    special = self._by_key.get((wild_color, card.action, True))
+                    if special is not None:
+                        self._recolored[(card.id, wild_color)] = special
+            self._dicts[card.id] = {
+                "id": card.id,
+                "color": card.color,
+                "action": card.action,
+                "image": f"{settings.MEDIA_FULL_URL}{card.image}",
+            }
+
+    def __contains__(self, card_id:int) -> bool:
+        return card_id in self._cards
+
+    def __len__(self) -> int:
+        return len(self._cards)
+
+    def get(self, card_id:int) -> CatalogCard:
+        return self._cards[card_id]
+
+    def lookup(self, color:str, action:str, is_special:bool=False) -> int:
+        return self._by_key[(color, action, is_special)]
+
+    def plain_of(self, card_id:int) -> int:
+        """the card as it is in the deck"""
+        return self._plain[card_id]
+
+    def recolored(self, card_id:int, color:str) -> int:
+        """the special version of a wild card with the chosen color"""
+        return self._recolored[(card_id, color)]
+
+    def to_dict(self, card_id:int) -> dict:
+        # a copy, callers are allowed to add keys (like can_play)
+        return dict(self._dicts[card_id])
+
+    def to_list(self) -> list:
+        """every card, sorted by id"""
+        return [self.to_dict(card_id) for card_id in self.ids]
+
+    @property
+    def version(self) -> str:
+        """a hash of the cards, changes whenever a card does"""
+        if self._version is None:
+            content = json.dumps(self.to_list(), sort_keys=True).encode()
+            self._version = hashlib.sha256(content).hexdigest()[:16]
+        return self._version
+
+
+_catalog = None
+
+def get_catalog() -> CardCatalog:
+    """the process-wide catalog, loaded on first use"""
+    global _catalog
+    if _catalog is None:
+        _catalog = CardCatalog(UnoCard.objects.all())
+    return _catalog
+
+
+@receiver([post_save, post_delete], sender=UnoCard)
+def reset_catalog(sender=None, **kwargs):
+    """cards were edited, the catalog (and everything built from it) is reloaded on next use"""
+    global _catalog
+    _catalog = None
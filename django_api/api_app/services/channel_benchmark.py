@@ -0,0 +1,60 @@
+import asyncio
+import time
+
+
+class FanOutReport:
+    """group_send latencies of a channel layer for a number of rooms"""
+    def __init__(self, rooms:int, members:int):
+        self.rooms = rooms
+        self.members = members
+        self.latencies = [] # seconds until every member of a room got the message
+        self.burst_elapsed = 0.0
+        self.deliveries = 0
+
+    def percentile(self, percent:float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def to_dict(self) -> dict:
+        return {
+            "rooms": self.rooms,
+            "members": self.members,
+            "p50_ms": self.percentile(50) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "deliveries_per_second": self.deliveries / self.burst_elapsed if self.burst_elapsed else 0.0,
+        }
+
+
+async def measure_fan_out(layer, rooms:int, members:int, rounds:int) -> FanOutReport:
+    """`rooms` groups of `members` channels, like the sockets of the game rooms.
+    Each round sends to the groups one at a time, for the latency of a fan-out,
+    then to all of them at once, for the deliveries per second under load
+    """
+    groups = {}
+    for room in range(rooms):
+        group = f"benchmark_{room}"
+        groups[group] = [await layer.new_channel() for _ in range(members)]
+        for channel in groups[group]:
+            await layer.group_add(group, channel)
+
+    report = FanOutReport(rooms, members)
+    try:
+        for _ in range(rounds):
+            for group, channels in groups.items():
+                start = time.perf_counter()
+                await layer.group_send(group, {"type": "benchmark"})
+                await asyncio.gather(*(layer.receive(channel) for channel in channels))
+                report.latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(layer.group_send(group, {"type": "benchmark"}) for group in groups))
+            await asyncio.gather(*(layer.receive(channel) for channels in groups.values() for channel in channels))
+            report.burst_elapsed += time.perf_counter() - start
+            report.deliveries += rooms * members
+    finally:
+        for group, channels in groups.items():
+            for channel in channels:
+                await layer.group_discard(group, channel)
+    return report
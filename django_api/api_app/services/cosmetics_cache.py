@@ -0,0 +1,71 @@
+import time
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from api_app.models.shop import GameEnvironment, ProfileEffect
+from api_app.models.uno import CardBack
+
+# the cache is dropped when a cosmetic is saved or deleted in this process,
+# the TTL covers the changes made by other processes
+TTL = getattr(settings, "COSMETICS_CACHE_TTL", 300)
+
+
+class CosmeticsCatalog:
+    """
+    Every card back, game environment and profile effect of the shop, already
+    rendered with to_dict(). They almost never change, the shop lists and the
+    game renders read them from here instead of the database.
+    """
+    def __init__(self):
+        self.loaded_at = time.monotonic()
+        self.card_backs = {card_back.id: card_back.to_dict() for card_back in CardBack.objects.order_by("id")}
+        self.game_environments = {environment.id: environment.to_dict() for environment in GameEnvironment.objects.order_by("id")}
+        self.profile_effects = {effect.id: effect.to_dict() for effect in ProfileEffect.objects.order_by("id")}
+        self._default_card_back = next((id for id, item in self.card_backs.items() if item["name"] == "default"), None)
+        self._default_game_environment = next((id for id, item in self.game_environments.items() if item["name"] == "default"), None)
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self.loaded_at > TTL
+
+    # the dicts are copies, callers may change them
+
+    def card_back_list(self) -> list:
+        return [dict(item) for item in self.card_backs.values()]
+
+    def game_environment_list(self) -> list:
+        return [dict(item) for item in self.game_environments.values()]
+
+    def profile_effect_list(self) -> list:
+        return [dict(item) for item in self.profile_effects.values()]
+
+    def card_back(self, card_back_id:int=None) -> dict:
+        """a card back, or the default one when there is none"""
+        return dict(self.card_backs.get(card_back_id) or self.card_backs[self._default_card_back])
+
+    def game_environment(self, game_environment_id:int=None) -> dict:
+        """a game environment, or the default one when there is none"""
+        return dict(self.game_environments.get(game_environment_id) or self.game_environments[self._default_game_environment])
+
+    def profile_effect_name(self, profile_effect_id:int=None) -> str:
+        effect = self.profile_effects.get(profile_effect_id)
+        return effect["name"] if effect else "default"
+
+
+_cosmetics = None
+
+def get_cosmetics() -> CosmeticsCatalog:
+    """the process-wide cosmetics, loaded on first use and reloaded after TTL seconds"""
+    global _cosmetics
+    if _cosmetics is None or _cosmetics.expired:
+        _cosmetics = CosmeticsCatalog()
+    return _cosmetics
+
+
+@receiver([post_save, post_delete], sender=CardBack)
+@receiver([post_save, post_delete], sender=GameEnvironment)
+@receiver([post_save, post_delete], sender=ProfileEffect)
+def reset_cosmetics(sender=None, **kwargs):
+    """a cosmetic was edited, reloaded on next use"""
+    global _cosmetics
+    _cosmetics = None
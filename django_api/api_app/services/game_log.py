@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from api_app.models.uno import UnoGameEvent, UnoGameLog, UnoGameSnapshot
+from api_app.services.card_catalog import get_catalog
+from api_app.services.uno_engine import UnoGameState
+
+# a snapshot is taken every SNAPSHOT_INTERVAL moves, so rebuilding a state never
+# replays more than that many events
+SNAPSHOT_INTERVAL = getattr(settings, "UNO_SNAPSHOT_INTERVAL", 25)
+# finished logs older than this are compacted down to their last snapshot
+RETENTION_DAYS = getattr(settings, "UNO_GAME_LOG_RETENTION_DAYS", 30)
+
+
+def snapshot_due(state:UnoGameState, saved_version:int, sequence:int) -> bool:
+    """whether the moves from `saved_version` to `sequence` end with a snapshot.
+    Several moves may be written at once, it is due if one of them crossed the interval
+    """
+    return state.game_over or sequence // SNAPSHOT_INTERVAL > saved_version // SNAPSHOT_INTERVAL
+
+
+def append(log_id:int, events:list, state:UnoGameState, saved_version:int, sequence:int, snapshot:bool=False):
+    """write the events of the moves since `saved_version`, and a snapshot if it is time.
+    `events` are (sequence, event) pairs, `sequence` is the version of the game now.
+    Only inserts, the log row itself is not loaded
+    """
+    if events:
+        UnoGameEvent.objects.bulk_create([
+            UnoGameEvent(
+                log_id=log_id,
+                sequence=event_sequence,
+                kind=event["type"],
+                data={key: value for key, value in event.items() if key != "type"},
+            )
+            for event_sequence, event in events
+        ])
+
+    if snapshot or snapshot_due(state, saved_version, sequence):
+        UnoGameSnapshot.objects.create(log_id=log_id, sequence=sequence, state=state.to_snapshot())
+    if state.game_over:
+        UnoGameLog.objects.filter(pk=log_id, finished_at__isnull=True).update(finished_at=timezone.now())
+
+
+def rebuild_state(log:UnoGameLog, sequence:int=None) -> UnoGameState:
+    """the state of the game at `sequence` (the latest one by default),
+    from the last snapshot before it and the events after that snapshot
+    """
+    snapshots = log.snapshots.order_by("-sequence")
+    if sequence is not None:
+        snapshots = snapshots.filter(sequence__lte=sequence)
+    snapshot = snapshots.first()
+    if snapshot is None:
+        raise ValueError("This game can't be rebuilt at this point")
+
+    state = UnoGameState.from_snapshot(get_catalog(), snapshot.state)
+    events = log.events.filter(sequence__gt=snapshot.sequence)
+    if sequence is not None:
+        events = events.filter(sequence__lte=sequence)
+    for event in events.order_by("sequence"):
+        state.apply_event(event.to_event())
+    state.events.clear()
+    state.dirty_players.clear()
+    state.pile_dirty = False
+    return state
+
+
+def compact_finished_logs() -> int:
+    """compact the logs of the games finished (or abandoned) before the retention period"""
+    limit = timezone.now() - timezone.timedelta(days=RETENTION_DAYS)
+    deleted = 0
+    logs = UnoGameLog.objects.filter(Q(games__isnull=True) | Q(finished_at__isnull=False), created_at__lte=limit)
+    for log in logs:
+        deleted += log.compact()
+    return deleted
@@ -0,0 +1,90 @@
+from api_app.services.card_catalog import get_catalog
+from api_app.services.uno_engine import playability_for
+
+
+# a snapshot is the output of UnoGame.to_dict(): every hand is visible.
+# It never leaves the server, each client receives its own projection of it.
+
+def _players_by_number(game:dict) -> dict:
+    return {str(player["player_number"]): player for player in game["players"]}
+
+
+def diff_game(old:dict, new:dict):
+    """the changes to apply to `old` to get `new`.
+    Players are keyed by their player number, and only their changed keys are kept.
+    Returns None when the two states can't be patched (not the same players)
+    """
+    old_players = _players_by_number(old)
+    new_players = _players_by_number(new)
+    if old_players.keys() != new_players.keys():
+        return None
+
+    patch = {key: value for key, value in new.items() if key != "players" and old.get(key) != value}
+    players = {}
+    for number, player in new_players.items():
+        changes = {key: value for key, value in player.items() if old_players[number].get(key) != value}
+        if changes:
+            players[number] = changes
+    if players:
+        patch["players"] = players
+    return patch
+
+
+def apply_patch(game:dict, patch:dict) -> dict:
+    """return a new state with the patch from diff_game applied"""
+    patched = {key: value for key, value in game.items() if key != "players"}
+    patched.update({key: value for key, value in patch.items() if key != "players"})
+    player_changes = patch.get("players", {})
+    patched["players"] = [
+        {**player, **player_changes[str(player["player_number"])]}
+        if str(player["player_number"]) in player_changes else player
+        for player in game["players"]
+    ]
+    return patched
+
+
+def project_for_viewer(game:dict, user_id:int) -> dict:
+    """ what a user is allowed to see of the game
+    other players' hands are replaced by their size,
+    the user's own cards say if they can be played
+    """
+    playability = playability_for(get_catalog())
+    top_id = game["current_card"]["id"]
+    stacking = game.get("stored_to_draw", 0) != 0
+    players = []
+    for player in game["players"]:
+        player = dict(player)
+        if player["user"]["id"] != user_id:
+            player["hand"] = len(player["hand"])
+        else:
+            my_turn = not game["game_over"] and game["current_player_number"] == player["player_number"]
+            if my_turn:
+                mask = playability.playable_mask([card["id"] for card in player["hand"]], top_id, stacking)
+            else:
+                mask = [False] * len(player["hand"])
+            player["hand"] = [{**card, "can_play": can_play} for card, can_play in zip(player["hand"], mask)]
+        players.append(player)
+    return {**game, "players": players}
+
+
+def compact_cards(projection:dict) -> dict:
+    """a projection with card ids instead of card dicts, for the binary protocol.
+    The client resolves the ids with the catalog it received when connecting,
+    the playability of the user's hand moves to a `can_play` list
+    """
+    def compact_player(player, playable=True):
+        # only the user's own hand (and the winner's) is a list of cards
+        if player is None or isinstance(player["hand"], int):
+            return player
+        player = dict(player)
+        if playable:
+            player["can_play"] = [card["can_play"] for card in player["hand"]]
+        player["hand"] = [card["id"] for card in player["hand"]]
+        return player
+
+    return {
+        **projection,
+        "current_card": projection["current_card"]["id"],
+        "players": [compact_player(player) for player in projection["players"]],
+        "winner": compact_player(projection["winner"], playable=False),
+    }
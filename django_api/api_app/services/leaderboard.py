@@ -0,0 +1,399 @@
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left, insort
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+User = get_user_model()
+
+# how users are ordered for each sort key, best first. Every ordering is an index of the
+# users table (see CustomUser.Meta), the id keeps equal users in a stable order
+ORDERINGS = {
+    "games_won": ["-games_won", "-games_played", "id"],
+    "games_played": ["-games_played", "-games_won", "id"],
+    "win_rate": ["-win_rate", "-games_played", "id"],
+    "cards_currency": ["-cards_currency", "id"],
+}
+# the sort keys that only change at the end of a game, kept ranked by the materialized
+# stores. The cards currency changes with every card played, it is always ranked in SQL
+GAME_METRICS = {
+    "games_won": lambda played, won, rate: (-won, -played),
+    "games_played": lambda played, won, rate: (-played, -won),
+    "win_rate": lambda played, won, rate: (-rate, -played),
+}
+
+
+class RankedList:
+    """
+    A sorted list that can say the position of an item.
+    Items live in sorted buckets of about `bucket_size` items, a Fenwick tree keeps the
+    size of the buckets: add, remove and index are O(log n) plus an insert in one small bucket.
+    """
+    def __init__(self, items=(), bucket_size:int=512):
+        self.bucket_size = bucket_size
+        items = sorted(items)
+        self.buckets = [items[i:i + bucket_size] for i in range(0, len(items), bucket_size)]
+        self._reindex()
+
+    def _reindex(self):
+        """rebuild the bucket maxes and the tree, after a bucket was split or removed"""
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.tree = [0] * (len(self.buckets) + 1)
+        for i, bucket in enumerate(self.buckets):
+            self._tree_add(i, len(bucket))
+        self.size = sum(len(bucket) for bucket in self.buckets)
+
+    def _tree_add(self, bucket_index:int, delta:int):
+        i = bucket_index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _count_before(self, bucket_index:int) -> int:
+        """how many items are in the buckets before this one"""
+        count = 0
+        i = bucket_index
+        while i > 0:
+            count += self.tree[i]
+            i -= i & -i
+        return count
+
+    def _locate(self, position:int):
+        """(bucket index, index in the bucket) of the item at `position`"""
+        bucket_index = 0
+        step = 1 << (len(self.buckets).bit_length() - 1) if self.buckets else 0
+        while step:
+            if bucket_index + step <= len(self.buckets) and self.tree[bucket_index + step] <= position:
+                bucket_index += step
+                position -= self.tree[bucket_index]
+            step >>= 1
+        return bucket_index, position
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, item):
+        if not self.buckets:
+            self.buckets = [[item]]
+            self._reindex()
+            return
+        i = min(bisect_left(self.maxes, item), len(self.buckets) - 1)
+        bucket = self.buckets[i]
+        insort(bucket, item)
+        self.maxes[i] = bucket[-1]
+        self.size += 1
+        if len(bucket) > 2 * self.bucket_size:
+            self.buckets[i:i + 1] = [bucket[:self.bucket_size], bucket[self.bucket_size:]]
+            self._reindex()
+        else:
+            self._tree_add(i, 1)
+
+    def remove(self, item):
+        i = bisect_left(self.maxes, item)
+        bucket = self.buckets[i] if i < len(self.buckets) else []
+        j = bisect_left(bucket, item)
+        if j == len(bucket) or bucket[j] != item:
+            raise KeyError(item)
+        del bucket[j]
+        self.size -= 1
+        if not bucket:
+            del self.buckets[i]
+            self._reindex()
+        else:
+            self.maxes[i] = bucket[-1]
+            self._tree_add(i, -1)
+
+    def index(self, item) -> int:
+        """position of the item, or where it would be inserted"""
+        i = bisect_left(self.maxes, item)
+        if i == len(self.buckets):
+            return self.size
+        return self._count_before(i) + bisect_left(self.buckets[i], item)
+
+    def slice(self, start:int, stop:int) -> list:
+        start, stop = max(start, 0), min(stop, self.size)
+        items = []
+        if start >= stop:
+            return items
+        bucket_index, offset = self._locate(start)
+        while len(items) < stop - start:
+            bucket = self.buckets[bucket_index]
+            items.extend(bucket[offset:offset + stop - start - len(items)])
+            bucket_index, offset = bucket_index + 1, 0
+        return items
+
+
+class RankStore(ABC):
+    """
+    The rank of every user for each sort key. The materialized stores keep the GAME_METRICS
+    ranked and are updated with the stats read back at the end of each game (see
+    UnoGameService.finish_turn), the users table stays the source of truth.
+    """
+    metrics = GAME_METRICS
+
+    @abstractmethod
+    def top(self, metric:str, limit:int) -> list:
+        """the ids of the `limit` best users"""
+
+    @abstractmethod
+    def around(self, metric:str, user_id:int, radius:int):
+        """(rank of the user, ids of the user and the `radius` users before and after it),
+        ranks start at 1. (None, []) for an unknown user
+        """
+
+    @abstractmethod
+    def count(self) -> int:
+        """how many users are ranked"""
+
+    def record(self, stats:dict):
+        """new stats for users, user id -> (games played, games won, win rate)"""
+
+    def discard(self, user_id:int):
+        """a user that was deleted"""
+
+    def rebuild(self):
+        """load every user again, for the changes not made by a game (an admin edit)"""
+
+    def reset(self):
+        """forget the rankings, loaded again on next use"""
+
+
+def ahead_of(user, ordering:list) -> Q:
+    """the users placed before `user` in the ordering"""
+    ahead = Q()
+    equal = {}
+    for key in ordering:
+        field = key.lstrip("-")
+        value = getattr(user, field)
+        ahead |= Q(**equal, **{f"{field}__gt" if key.startswith("-") else f"{field}__lt": value})
+        equal[field] = value
+    return ahead
+
+
+def reversed_ordering(ordering:list) -> list:
+    return [key[1:] if key.startswith("-") else f"-{key}" for key in ordering]
+
+
+class DatabaseRanks(RankStore):
+    """
+    Not materialized: ranks the users table with its indexes on every request.
+    A page is an index scan that stops after `limit` rows, but a rank counts the users
+    ahead, which costs as much as the rank. Used for the cards currency, and for every
+    sort key with the database backend
+    """
+    metrics = ORDERINGS
+
+    def top(self, metric, limit):
+        return list(User.objects.order_by(*ORDERINGS[metric]).values_list("id", flat=True)[:limit])
+
+    def around(self, metric, user_id, radius):
+        ordering = ORDERINGS[metric]
+        user = User.objects.filter(pk=user_id).first()
+        if user is None:
+            return None, []
+        ahead = User.objects.filter(ahead_of(user, ordering))
+        rank = ahead.count() + 1
+        before = list(ahead.order_by(*reversed_ordering(ordering)).values_list("id", flat=True)[:radius])[::-1]
+        after = User.objects.exclude(ahead_of(user, ordering)).exclude(pk=user_id).order_by(*ordering).values_list("id", flat=True)[:radius]
+        return rank, [*before, user_id, *after]
+
+    def count(self):
+        return User.objects.count()
+
+
+class MemoryRanks(RankStore):
+    """in the process, for a single process and the tests. Loaded from the database on first use"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.stats = {} # user id -> (games played, games won, win rate)
+        self.rankings = None # metric -> RankedList of (*key, user id)
+
+    def _key(self, metric:str, user_id:int):
+        return (*self.metrics[metric](*self.stats[user_id]), user_id)
+
+    def rebuild(self):
+        stats = {user_id: (played, won, rate) for user_id, played, won, rate in User.objects.values_list("id", "games_played", "games_won", "win_rate")}
+        with self.lock:
+            self.stats = stats
+            self.rankings = {metric: RankedList(self._key(metric, user_id) for user_id in stats) for metric in self.metrics}
+
+    def _loaded(self):
+        if self.rankings is None:
+            self.rebuild()
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.rankings = None
+
+    def record(self, stats):
+        with self.lock:
+            if self.rankings is None:
+                return # loaded with the right stats on first use
+            for user_id, user_stats in stats.items():
+                self.discard(user_id)
+                self.stats[user_id] = user_stats
+                for metric, ranking in self.rankings.items():
+                    ranking.add(self._key(metric, user_id))
+
+    def discard(self, user_id):
+        with self.lock:
+            if self.rankings is None or user_id not in self.stats:
+                return
+            for metric, ranking in self.rankings.items():
+                ranking.remove(self._key(metric, user_id))
+            del self.stats[user_id]
+
+    def top(self, metric, limit):
+        with self.lock:
+            self._loaded()
+            return [item[-1] for item in self.rankings[metric].slice(0, limit)]
+
+    def around(self, metric, user_id, radius):
+        with self.lock:
+            self._loaded()
+            if user_id not in self.stats:
+                return None, []
+            rank = self.rankings[metric].index(self._key(metric, user_id)) + 1
+            items = self.rankings[metric].slice(rank - 1 - radius, rank + radius)
+            return rank, [item[-1] for item in items]
+
+    def count(self):
+        with self.lock:
+            self._loaded()
+            return len(self.stats)
+
+
+class RedisRanks(RankStore):
+    """
+    in Redis, shared by every process using the same server. leaderboard:{metric} is a
+    sorted set of the users scored by their stats, ZREVRANK gives a rank in O(log n).
+    The score packs the two stats of the ordering, the member is 10**12 - id zero padded:
+    equal scores are ordered by member, so by id
+    """
+    PLAYED_BITS = 26 # up to 67 million games, the score stays an exact double
+    RATE_PRECISION = 10 ** 6
+
+    def __init__(self, url:str):
+        import redis # only needed with this backend
+        self.redis = redis.Redis.from_url(url)
+
+    def _key(self, metric:str):
+        return f"leaderboard:{metric}"
+
+    def _member(self, user_id:int) -> str:
+        return f"{10 ** 12 - user_id:012d}"
+
+    def _user_id(self, member:bytes) -> int:
+        return 10 ** 12 - int(member)
+
+    def _score(self, metric:str, played:int, won:int, rate:float) -> int:
+        first, second = {
+            "games_won": (won, played),
+            "games_played": (played, won),
+            "win_rate": (round(rate * self.RATE_PRECISION), played),
+        }[metric]
+        return (first << self.PLAYED_BITS) + min(second, (1 << self.PLAYED_BITS) - 1)
+
+    def _add(self, pipe, key:str, metric:str, stats:dict):
+        pipe.zadd(key, {self._member(user_id): self._score(metric, *user_stats) for user_id, user_stats in stats.items()})
+
+    def rebuild(self):
+        stats = {user_id: (played, won, rate) for user_id, played, won, rate in User.objects.values_list("id", "games_played", "games_won", "win_rate")}
+        items = list(stats.items())
+        pipe = self.redis.pipeline()
+        for metric in self.metrics:
+            # filled aside then renamed, the rankings are never seen half loaded
+            building = f"{self._key(metric)}:building"
+            pipe.delete(building)
+            for start in range(0, len(items), 10000):
+                self._add(pipe, building, metric, dict(items[start:start + 10000]))
+            if stats:
+                pipe.rename(building, self._key(metric))
+            else:
+                pipe.delete(self._key(metric))
+        pipe.execute()
+
+    def _loaded(self):
+        if not self.redis.exists(self._key("games_played")) and User.objects.exists():
+            self.rebuild()
+
+    def record(self, stats):
+        if not self.redis.exists(self._key("games_played")):
+            return # loaded with the right stats on first use
+        pipe = self.redis.pipeline()
+        for metric in self.metrics:
+            self._add(pipe, self._key(metric), metric, stats)
+        pipe.execute()
+
+    def reset(self):
+        self.redis.delete(*(self._key(metric) for metric in self.metrics))
+
+    def discard(self, user_id):
+        pipe = self.redis.pipeline()
+        for metric in self.metrics:
+            pipe.zrem(self._key(metric), self._member(user_id))
+        pipe.execute()
+
+    def top(self, metric, limit):
+        self._loaded()
+        return [self._user_id(member) for member in self.redis.zrevrange(self._key(metric), 0, limit - 1)]
+
+    def around(self, metric, user_id, radius):
+        self._loaded()
+        position = self.redis.zrevrank(self._key(metric), self._member(user_id))
+        if position is None:
+            return None, []
+        members = self.redis.zrevrange(self._key(metric), max(position - radius, 0), position + radius)
+        return position + 1, [self._user_id(member) for member in members]
+
+    def count(self):
+        self._loaded()
+        return self.redis.zcard(self._key("games_played"))
+
+
+def create_rank_store() -> RankStore:
+    backend = getattr(settings, "UNO_LEADERBOARD_BACKEND", None) or getattr(settings, "UNO_PRESENCE_BACKEND", "memory")
+    if backend == "redis":
+        return RedisRanks(getattr(settings, "UNO_LEADERBOARD_REDIS_URL", None) or settings.UNO_PRESENCE_REDIS_URL)
+    if backend == "memory":
+        return MemoryRanks()
+    return DatabaseRanks()
+
+
+rank_store = create_rank_store()
+database_ranks = DatabaseRanks()
+
+
+def ranks_for(metric:str) -> RankStore:
+    """the store that ranks this sort key"""
+    return rank_store if metric in rank_store.metrics else database_ranks
+
+
+def _stats(user) -> tuple:
+    # from __dict__, a deferred field is not loaded for this
+    return tuple(user.__dict__.get(field) for field in ("games_played", "games_won", "win_rate"))
+
+
+@receiver(post_init, sender=User)
+def remember_stats(sender, instance, **kwargs):
+    instance._ranked_stats = _stats(instance)
+
+
+@receiver(post_save, sender=User)
+def rank_saved_user(sender, instance, created=False, **kwargs):
+    # new users, and stats changed by hand. The games update the stats with update(), see finish_turn
+    stats = _stats(instance)
+    if (created or stats != instance._ranked_stats) and None not in stats:
+        instance._ranked_stats = stats
+        transaction.on_commit(lambda: rank_store.record({instance.id: stats}))
+
+
+@receiver(post_delete, sender=User)
+def unrank_deleted_user(sender, instance, **kwargs):
+    user_id = instance.id
+    transaction.on_commit(lambda: rank_store.discard(user_id))
@@ -0,0 +1,129 @@
+import atexit
+import threading
+import time
+from django.conf import settings
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import close_old_connections
+from api_app.services.uno_game_service import StaleGameError
+
+
+class LiveGameRegistry:
+    """
+    The games being played, kept in memory when UNO_WRITE_BEHIND is on.
+    A move only changes the in-memory UnoGameService, a background thread writes the
+    games that changed (and only those) every `interval_ms`.
+    A game is written right away when it ends, and everything is written on shutdown.
+    Every socket of a room must be served by the same process, like the command queue.
+    """
+    IDLE_SECONDS = 600 # clean games not played for this long are dropped from memory
+
+    def __init__(self, interval_ms:int, enabled:bool=True):
+        self.enabled = enabled
+        self.interval = interval_ms / 1000
+        self.games = {} # room id -> UnoGameService
+        self.last_used = {} # room id -> time.monotonic()
+        # held while a command changes a game and while games are written
+        self.lock = threading.RLock()
+        self.thread = None
+        self.running = False
+
+    def get(self, room_id, load):
+        """the live game of a room, `load` creates the service when it is not in memory"""
+        with self.lock:
+            if room_id not in self.games:
+                self.add(room_id, load())
+            self.last_used[room_id] = time.monotonic()
+            return self.games[room_id]
+
+    def add(self, room_id, game_service):
+        with self.lock:
+            self.games[room_id] = game_service
+            self.last_used[room_id] = time.monotonic()
+        self.start()
+
+    def discard(self, room_id):
+        """write the game one last time and forget it"""
+        with self.lock:
+            self.flush([room_id])
+            self.games.pop(room_id, None)
+            self.last_used.pop(room_id, None)
+
+    def flush(self, room_ids=None) -> int:
+        """write the dirty games (of `room_ids`, or all), return how many were written.
+        Each game is written in its own transaction and only marked clean once it is
+        committed, a game that fails stays dirty and is written again next time
+        """
+        written = 0
+        with self.lock:
+            dirty = [
+                (room_id, game_service) for room_id, game_service in self.games.items()
+                if game_service.dirty and (room_ids is None or room_id in room_ids)
+            ]
+            for room_id, game_service in dirty:
+                try:
+                    game_service.save()
+                    written += 1
+                except StaleGameError:
+                    # another process wrote this game, ours is outdated: its moves are lost
+                    print(f"Live game of room {room_id} is outdated, dropped")
+                    self.games.pop(room_id, None)
+                    self.last_used.pop(room_id, None)
+                    self._notify_outdated(room_id)
+                except Exception as e:
+                    print(f"Error writing the live game of room {room_id}: {str(e)}")
+        return written
+
+    def _notify_outdated(self, room_id):
+        """tell the sockets of the room, they show the error and load the game again"""
+        try:
+            async_to_sync(get_channel_layer().group_send)(f"uno_game_{room_id}", {
+                "type": "websocket_game_outdated",
+                "error": "The game was changed somewhere else, the last moves were lost",
+            })
+        except Exception as e:
+            print(f"Failed to notify room {room_id}: {str(e)}")
+
+    def _evict(self):
+        """forget the games that are over or idle, once written"""
+        now = time.monotonic()
+        with self.lock:
+            for room_id, game_service in list(self.games.items()):
+                idle = now - self.last_used.get(room_id, now) > self.IDLE_SECONDS
+                if not game_service.dirty and (idle or game_service.state.game_over):
+                    del self.games[room_id]
+                    self.last_used.pop(room_id, None)
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+                self._evict()
+            except Exception as e:
+                print(f"Error flushing live games: {str(e)}")
+            finally:
+                close_old_connections()
+
+    def start(self):
+        """start the flusher, an interval of 0 means games are only written by flush()"""
+        if self.running or self.interval <= 0:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """stop the flusher and write everything"""
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=self.interval + 5)
+            self.thread = None
+        self.flush()
+
+
+live_games = LiveGameRegistry(
+    getattr(settings, "UNO_WRITE_BEHIND_FLUSH_MS", 500),
+    enabled=getattr(settings, "UNO_WRITE_BEHIND", False),
+)
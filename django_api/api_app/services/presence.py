@@ -0,0 +1,253 @@
+import threading
+from abc import ABC, abstractmethod
+import time
+from collections import defaultdict
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+# a socket that has not sent a heartbeat for TTL seconds is not in its room anymore,
+# so the rooms of a process that died empty themselves
+TTL = getattr(settings, "UNO_PRESENCE_TTL", 30)
+# the "room" of the user sockets, whatever room their user is in (see auth_app.broadcaster)
+USER_SOCKETS = None
+
+
+class PresenceRegistry(ABC):
+    """
+    Who is connected to the game of each room, shared by every process serving sockets.
+    A user is in a room while one of its connections (a socket, named by its channel
+    name) is, join() and leave() say when the user itself joins or leaves the room.
+    Connections send heartbeat() every TTL / 3 seconds, sweep() forgets the expired ones.
+    The user sockets are kept the same way, in the room USER_SOCKETS.
+    """
+    @abstractmethod
+    def join(self, room_id:int, user_id:int, connection:str) -> bool:
+        """add a connection, True if the user was not in the room"""
+
+    @abstractmethod
+    def heartbeat(self, room_id:int, user_id:int, connection:str):
+        """keep a connection, added back if it was swept"""
+
+    @abstractmethod
+    def leave(self, room_id:int, user_id:int, connection:str) -> bool:
+        """remove a connection, True if it was the last one of the user in the room"""
+
+    @abstractmethod
+    def is_member(self, room_id:int, user_id:int) -> bool:
+        """True while one of the user's connections is alive"""
+
+    @abstractmethod
+    def members(self, room_id:int) -> set:
+        """the ids of the users in the room"""
+
+    def count(self, room_id:int) -> int:
+        return len(self.members(room_id))
+
+    @abstractmethod
+    def sweep(self) -> list:
+        """forget the expired connections, [(room id, user id)] of the users that left because of it"""
+
+
+class MemoryPresence(PresenceRegistry):
+    """in the process, for a single process and the tests"""
+    def __init__(self, ttl:float=TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # room id -> user id -> connection -> expiry (time.monotonic())
+        self.rooms = defaultdict(lambda: defaultdict(dict))
+
+    def _alive(self, connections:dict) -> bool:
+        now = time.monotonic()
+        return any(expires > now for expires in connections.values())
+
+    def join(self, room_id, user_id, connection):
+        with self.lock:
+            connections = self.rooms[room_id][user_id]
+            joined = not self._alive(connections)
+            connections[connection] = time.monotonic() + self.ttl
+            return joined
+
+    def heartbeat(self, room_id, user_id, connection):
+        with self.lock:
+            self.rooms[room_id][user_id][connection] = time.monotonic() + self.ttl
+
+    def leave(self, room_id, user_id, connection):
+        with self.lock:
+            users = self.rooms.get(room_id, {})
+            connections = users.get(user_id, {})
+            if connections.pop(connection, None) is None:
+                return False
+            if self._alive(connections):
+                return False
+            users.pop(user_id, None)
+            if not users:
+                self.rooms.pop(room_id, None)
+            return True
+
+    def is_member(self, room_id, user_id):
+        with self.lock:
+            return self._alive(self.rooms.get(room_id, {}).get(user_id, {}))
+
+    def members(self, room_id):
+        with self.lock:
+            return {user_id for user_id, connections in self.rooms.get(room_id, {}).items() if self._alive(connections)}
+
+    def sweep(self):
+        left = []
+        now = time.monotonic()
+        with self.lock:
+            for room_id, users in list(self.rooms.items()):
+                for user_id, connections in list(users.items()):
+                    for connection, expires in list(connections.items()):
+                        if expires <= now:
+                            del connections[connection]
+                    if not connections:
+                        del users[user_id]
+                        left.append((room_id, user_id))
+                if not users:
+                    del self.rooms[room_id]
+        return left
+
+
+class DatabasePresence(PresenceRegistry):
+    """in the database (RoomPresence), shared by the processes using it"""
+    def __init__(self, ttl:float=TTL):
+        self.ttl = ttl
+
+    def _expiry(self):
+        return timezone.now() + timezone.timedelta(seconds=self.ttl)
+
+    def _alive(self, room_id):
+        from api_app.models import RoomPresence
+        return RoomPresence.objects.filter(room_id=room_id, expires_at__gt=timezone.now())
+
+    def join(self, room_id, user_id, connection):
+        from api_app.models import RoomPresence
+        with transaction.atomic():
+            joined = not self._alive(room_id).filter(user_id=user_id).exists()
+            RoomPresence.objects.update_or_create(
+                connection=connection,
+                defaults={"room_id": room_id, "user_id": user_id, "expires_at": self._expiry()},
+            )
+        return joined
+
+    def heartbeat(self, room_id, user_id, connection):
+        from api_app.models import RoomPresence
+        if not RoomPresence.objects.filter(connection=connection).update(expires_at=self._expiry()):
+            self.join(room_id, user_id, connection)
+
+    def leave(self, room_id, user_id, connection):
+        from api_app.models import RoomPresence
+        with transaction.atomic():
+            deleted, _ = RoomPresence.objects.filter(connection=connection).delete()
+            return bool(deleted) and not self._alive(room_id).filter(user_id=user_id).exists()
+
+    def is_member(self, room_id, user_id):
+        return self._alive(room_id).filter(user_id=user_id).exists()
+
+    def members(self, room_id):
+        return set(self._alive(room_id).values_list("user_id", flat=True))
+
+    def count(self, room_id):
+        return self._alive(room_id).values("user_id").distinct().count()
+
+    def sweep(self):
+        from api_app.models import RoomPresence
+        with transaction.atomic():
+            expired = RoomPresence.objects.select_for_update().filter(expires_at__lte=timezone.now())
+            gone = set(expired.values_list("room_id", "user_id"))
+            expired.delete()
+            # still there with another connection
+            staying = set(
+                RoomPresence.objects.filter(room_id__in={room_id for room_id, _ in gone})
+                .values_list("room_id", "user_id")
+            )
+        return sorted(gone - staying)
+
+
+class RedisPresence(PresenceRegistry):
+    """
+    in Redis, shared by every process using the same server.
+    presence:{room} is a sorted set of the users of the room scored by the expiry of their
+    latest heartbeat, presence:{room}:{user} the same for the connections of the user
+    """
+    def __init__(self, url:str, ttl:float=TTL):
+        import redis # only needed with this backend
+        self.redis = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def _room_key(self, room_id):
+        return f"presence:{room_id}"
+
+    def _user_key(self, room_id, user_id):
+        return f"presence:{room_id}:{user_id}"
+
+    def _add(self, room_id, user_id, connection, pipe):
+        expires = time.time() + self.ttl
+        pipe.zadd(self._user_key(room_id, user_id), {connection: expires})
+        pipe.zadd(self._room_key(room_id), {user_id: expires})
+        pipe.expire(self._user_key(room_id, user_id), int(self.ttl) + 1)
+
+    def join(self, room_id, user_id, connection):
+        # one MULTI: the score read is the one the add replaces, two joins can't both win
+        pipe = self.redis.pipeline()
+        pipe.zscore(self._room_key(room_id), user_id)
+        self._add(room_id, user_id, connection, pipe)
+        expires, _, added, _ = pipe.execute()
+        # new in the room, or back after its connections expired (not swept yet)
+        return added == 1 or expires <= time.time()
+
+    def heartbeat(self, room_id, user_id, connection):
+        pipe = self.redis.pipeline()
+        self._add(room_id, user_id, connection, pipe)
+        pipe.execute()
+
+    def leave(self, room_id, user_id, connection):
+        user_key = self._user_key(room_id, user_id)
+        pipe = self.redis.pipeline()
+        pipe.zrem(user_key, connection)
+        pipe.zremrangebyscore(user_key, "-inf", time.time())
+        pipe.zcard(user_key)
+        removed, _, remaining = pipe.execute()
+        if not removed or remaining:
+            return False
+        self.redis.zrem(self._room_key(room_id), user_id)
+        return True
+
+    def is_member(self, room_id, user_id):
+        expires = self.redis.zscore(self._room_key(room_id), user_id)
+        return expires is not None and expires > time.time()
+
+    def members(self, room_id):
+        return {int(user_id) for user_id in self.redis.zrangebyscore(self._room_key(room_id), time.time(), "+inf")}
+
+    def count(self, room_id):
+        return self.redis.zcount(self._room_key(room_id), time.time(), "+inf")
+
+    def sweep(self):
+        left = []
+        now = time.time()
+        for room_key in self.redis.scan_iter(match="presence:*", count=500):
+            room_key = room_key.decode()
+            if room_key.count(":") != 1:
+                continue
+            room_id = room_key.split(":")[1]
+            room_id = USER_SOCKETS if room_id == str(USER_SOCKETS) else int(room_id)
+            for user_id in self.redis.zrangebyscore(room_key, "-inf", now):
+                # the score is the latest heartbeat of the user, every connection expired
+                if self.redis.zrem(room_key, user_id):
+                    left.append((room_id, int(user_id)))
+        return left
+
+
+def create_presence() -> PresenceRegistry:
+    backend = getattr(settings, "UNO_PRESENCE_BACKEND", "memory")
+    if backend == "database":
+        return DatabasePresence()
+    if backend == "redis":
+        return RedisPresence(settings.UNO_PRESENCE_REDIS_URL)
+    return MemoryPresence()
+
+
+presence = create_presence()
@@ -0,0 +1,112 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+
+
+class RoomSequencer(ABC):
+    """
+    Numbers the game messages of each room, shared by every process sending them.
+    The numbers only grow, whatever the process that sends the message, so a socket
+    can tell what it missed (see api_app.consummers.room_replay)
+    """
+    @abstractmethod
+    def next(self, room_id:int):
+        """the number of a new game message of the room, None if the room is gone"""
+
+    @abstractmethod
+    def last(self, room_id:int) -> int:
+        """the number of the last game message of the room, 0 if the room is gone"""
+
+
+class MemorySequencer(RoomSequencer):
+    """in the process, for a single process and the tests"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sequences = {} # room id -> number of the last message
+
+    def _last(self, room_id):
+        # starts at the time in ms, so the numbers a client got from the process
+        # before a restart are lower than the new ones
+        return self.sequences.setdefault(room_id, int(time.time() * 1000))
+
+    def next(self, room_id):
+        with self.lock:
+            self.sequences[room_id] = self._last(room_id) + 1
+            return self.sequences[room_id]
+
+    def last(self, room_id):
+        with self.lock:
+            return self._last(room_id)
+
+
+class DatabaseSequencer(RoomSequencer):
+    """in the room row (Room.message_sequence), shared by the processes using the database"""
+    def _returning(self) -> bool:
+        # UPDATE ... RETURNING, SQLite has it from the version that can return inserted columns
+        return connection.vendor == "postgresql" or (
+            connection.vendor == "sqlite" and connection.features.can_return_columns_from_insert
+        )
+
+    def next(self, room_id):
+        from api_app.models import Room
+        if self._returning():
+            table = connection.ops.quote_name(Room._meta.db_table)
+            column = connection.ops.quote_name(Room._meta.get_field("message_sequence").column)
+            pk = connection.ops.quote_name(Room._meta.pk.column)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    f"UPDATE {table} SET {column} = {column} + 1 WHERE {pk} = %s RETURNING {column}", [room_id]
+                )
+                row = cursor.fetchone()
+            return row[0] if row else None
+
+        with transaction.atomic():
+            # the row stays locked until the commit, the number read is ours
+            if not Room.objects.filter(pk=room_id).update(message_sequence=F("message_sequence") + 1):
+                return None
+            return Room.objects.values_list("message_sequence", flat=True).get(pk=room_id)
+
+    def last(self, room_id):
+        from api_app.models import Room
+        return Room.objects.filter(pk=room_id).values_list("message_sequence", flat=True).first() or 0
+
+
+class RedisSequencer(RoomSequencer):
+    """in Redis, sequence:{room} is the number of the last message of the room"""
+    def __init__(self, url:str):
+        import redis # only needed with this backend
+        self.redis = redis.Redis.from_url(url)
+
+    def _key(self, room_id):
+        return f"sequence:{room_id}"
+
+    def _start(self, room_id, pipe):
+        # like MemorySequencer, from the time in ms if the key was lost with a restart
+        pipe.set(self._key(room_id), int(time.time() * 1000), nx=True)
+
+    def next(self, room_id):
+        pipe = self.redis.pipeline()
+        self._start(room_id, pipe)
+        pipe.incr(self._key(room_id))
+        return pipe.execute()[-1]
+
+    def last(self, room_id):
+        pipe = self.redis.pipeline()
+        self._start(room_id, pipe)
+        pipe.get(self._key(room_id))
+        return int(pipe.execute()[-1])
+
+
+def create_sequencer() -> RoomSequencer:
+    backend = getattr(settings, "UNO_SEQUENCE_BACKEND", None) or getattr(settings, "UNO_PRESENCE_BACKEND", "memory")
+    if backend == "database":
+        return DatabaseSequencer()
+    if backend == "redis":
+        return RedisSequencer(getattr(settings, "UNO_SEQUENCE_REDIS_URL", None) or settings.UNO_PRESENCE_REDIS_URL)
+    return MemorySequencer()
+
+
+room_sequence = create_sequencer()
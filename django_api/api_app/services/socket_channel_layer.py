@@ -0,0 +1,311 @@
+import asyncio
+import itertools
+import os
+import struct
+import time
+import uuid
+import weakref
+from collections import defaultdict, deque
+import msgpack
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+# a frame is its length then a msgpack list:
+# [request id, operation, *arguments] to the broker, [request id, ok, result] back
+HEADER = struct.Struct("!I")
+
+
+async def read_frame(reader:asyncio.StreamReader):
+    size, = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return msgpack.unpackb(await reader.readexactly(size), raw=False)
+
+
+def write_frame(writer:asyncio.StreamWriter, frame:list):
+    data = msgpack.packb(frame, use_bin_type=True)
+    writer.write(HEADER.pack(len(data)) + data)
+
+
+class ChannelBroker:
+    """
+    The channels and groups of every worker of a host, which talk to it over a UNIX
+    socket (see UnixSocketChannelLayer). Run it with `manage.py channel_broker`.
+    Same rules as the in-memory layer: a channel holds at most `capacity` messages, they
+    expire after `expiry` seconds, and group memberships after `group_expiry` seconds
+    """
+    def __init__(self, capacity:int=100, expiry:int=60, group_expiry:int=86400):
+        self.capacity = capacity
+        self.expiry = expiry
+        self.group_expiry = group_expiry
+        self.channels = defaultdict(deque) # channel -> (expires, message)
+        self.waiters = defaultdict(deque) # channel -> futures of the receives waiting for a message
+        self.groups = defaultdict(dict) # group -> channel -> expires
+
+    def _drop_expired(self, channel:str):
+        queue = self.channels.get(channel)
+        now = time.monotonic()
+        while queue and queue[0][0] <= now:
+            queue.popleft()
+        if queue is not None and not queue:
+            del self.channels[channel]
+
+    def send(self, channel:str, message:dict):
+        # straight to a receive waiting for it
+        waiters = self.waiters.get(channel)
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(message)
+                return
+        self._drop_expired(channel)
+        queue = self.channels[channel]
+        if len(queue) >= self.capacity:
+            raise ChannelFull(channel)
+        queue.append((time.monotonic() + self.expiry, message))
+
+    async def receive(self, channel:str) -> dict:
+        self._drop_expired(channel)
+        if channel in self.channels:
+            message = self.channels[channel].popleft()[1]
+            self._drop_expired(channel)
+            return message
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters[channel].append(waiter)
+        try:
+            return await waiter
+        finally:
+            waiters = self.waiters.get(channel)
+            if waiters is not None:
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[channel]
+
+    def group_add(self, group:str, channel:str):
+        self.groups[group][channel] = time.monotonic() + self.group_expiry
+
+    def group_discard(self, group:str, channel:str):
+        members = self.groups.get(group)
+        if members is not None:
+            members.pop(channel, None)
+            if not members:
+                del self.groups[group]
+
+    def group_send(self, group:str, message:dict):
+        now = time.monotonic()
+        for channel, expires in list(self.groups.get(group, {}).items()):
+            if expires <= now:
+                self.group_discard(group, channel)
+                continue
+            try:
+                self.send(channel, message)
+            except ChannelFull:
+                pass # like the other layers, a full member misses the message
+
+    def flush(self):
+        self.channels.clear()
+        self.groups.clear()
+        for waiters in self.waiters.values():
+            for waiter in waiters:
+                waiter.cancel()
+        self.waiters.clear()
+
+    def sweep(self):
+        """forget the expired messages and memberships, the channels of closed sockets"""
+        for channel in list(self.channels):
+            self._drop_expired(channel)
+        now = time.monotonic()
+        for group, members in list(self.groups.items()):
+            for channel, expires in list(members.items()):
+                if expires <= now:
+                    self.group_discard(group, channel)
+
+    async def _receive_for(self, writer, request_id, channel):
+        try:
+            message = await self.receive(channel)
+        except asyncio.CancelledError:
+            return
+        if not writer.is_closing():
+            write_frame(writer, [request_id, True, message])
+
+    async def handle(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        """serve the requests of one worker connection"""
+        operations = {
+            "send": self.send,
+            "group_add": self.group_add,
+            "group_discard": self.group_discard,
+            "group_send": self.group_send,
+            "flush": self.flush,
+        }
+        receives = {} # request id -> task, the only requests that wait
+        try:
+            while True:
+                request_id, operation, *args = await read_frame(reader)
+                if operation == "receive":
+                    task = asyncio.ensure_future(self._receive_for(writer, request_id, *args))
+                    receives[request_id] = task
+                    task.add_done_callback(lambda _, request_id=request_id: receives.pop(request_id, None))
+                elif operation == "cancel":
+                    task = receives.pop(args[0], None)
+                    if task is not None:
+                        task.cancel()
+                else:
+                    try:
+                        write_frame(writer, [request_id, True, operations[operation](*args)])
+                    except ChannelFull:
+                        write_frame(writer, [request_id, False, "full"])
+                    except Exception as e:
+                        write_frame(writer, [request_id, False, str(e)])
+                    await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass # the worker is gone
+        finally:
+            for task in list(receives.values()):
+                task.cancel()
+            writer.close()
+
+    async def serve(self, path:str):
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(self.handle, path=path)
+        async with server:
+            while True:
+                await asyncio.sleep(min(self.expiry, 10))
+                self.sweep()
+
+
+class BrokerConnection:
+    """
+    a connection to the broker, requests run concurrently and are matched by id.
+    It closes itself when its reader stops: the broker went away, close() was called, or
+    the event loop is shutting down (asyncio.run, so async_to_sync, cancels the tasks left)
+    """
+    def __init__(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter, on_close=None):
+        self.reader = reader
+        self.writer = writer
+        self.on_close = on_close
+        self.ids = itertools.count()
+        self.pending = {} # request id -> future
+        self.closed = False
+        self.reader_task = asyncio.ensure_future(self._read())
+
+    async def _read(self):
+        try:
+            while True:
+                request_id, ok, result = await read_frame(self.reader)
+                future = self.pending.pop(request_id, None)
+                if future is None or future.done():
+                    continue # cancelled meanwhile
+                if ok:
+                    future.set_result(result)
+                elif result == "full":
+                    future.set_exception(ChannelFull())
+                else:
+                    future.set_exception(RuntimeError(result))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.closed = True
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError("Lost the connection to the channel broker"))
+            self.pending.clear()
+            self.writer.close()
+            if self.on_close is not None:
+                self.on_close(self)
+
+    async def call(self, operation:str, *args):
+        if self.closed:
+            raise ConnectionError("Lost the connection to the channel broker")
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        write_frame(self.writer, [request_id, operation, *args])
+        try:
+            return await future
+        except asyncio.CancelledError:
+            if self.pending.pop(request_id, None) is not None and not self.closed:
+                write_frame(self.writer, [next(self.ids), "cancel", request_id])
+            raise
+
+    async def close(self):
+        self.reader_task.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+class UnixSocketChannelLayer(BaseChannelLayer):
+    """
+    A channel layer for the workers of one host, the channels and groups live in a
+    ChannelBroker they reach through the UNIX socket at `path`.
+    One connection per event loop. async_to_sync runs each call in a new loop, whose
+    shutdown cancels the reader of the connection and so closes it. flush() and close()
+    close the connection of the running loop
+    """
+    extensions = ["groups", "flush"]
+
+    def __init__(self, path:str="/tmp/uno-channels.sock", expiry:int=60, capacity:int=100, channel_capacity=None):
+        # the capacity and expiry are the broker ones, see `manage.py channel_broker`
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        self.path = path
+        # by event loop, a closed connection removes itself so nothing keeps its loop alive
+        self.connections = weakref.WeakKeyDictionary() # event loop -> BrokerConnection
+        self.locks = weakref.WeakKeyDictionary() # event loop -> lock held while connecting
+
+    async def _connection(self) -> BrokerConnection:
+        loop = asyncio.get_running_loop()
+        connection = self.connections.get(loop)
+        if connection is not None and not connection.closed:
+            return connection
+        lock = self.locks.setdefault(loop, asyncio.Lock())
+        async with lock:
+            connection = self.connections.get(loop)
+            if connection is None or connection.closed:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+                connection = self.connections[loop] = BrokerConnection(reader, writer, on_close=self._forget)
+        return connection
+
+    def _forget(self, connection:BrokerConnection):
+        for loop, open_connection in list(self.connections.items()):
+            if open_connection is connection:
+                del self.connections[loop]
+                self.locks.pop(loop, None)
+
+    async def send(self, channel:str, message:dict):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await (await self._connection()).call("send", channel, message)
+
+    async def receive(self, channel:str) -> dict:
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        return await (await self._connection()).call("receive", channel)
+
+    async def new_channel(self, prefix:str="specific") -> str:
+        return f"{prefix}.unix!{uuid.uuid4().hex}"
+
+    async def group_add(self, group:str, channel:str):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await (await self._connection()).call("group_add", group, channel)
+
+    async def group_discard(self, group:str, channel:str):
+        assert self.valid_group_name(group), "Group name not valid"
+        assert self.valid_channel_name(channel), "Channel name not valid"
+        await (await self._connection()).call("group_discard", group, channel)
+
+    async def group_send(self, group:str, message:dict):
+        assert isinstance(message, dict), "message is not a dict"
+        assert self.valid_group_name(group), "Group name not valid"
+        await (await self._connection()).call("group_send", group, message)
+
+    async def flush(self):
+        await (await self._connection()).call("flush")
+        await self.close()
+
+    async def close(self):
+        """close the connection of the running event loop"""
+        connection = self.connections.pop(asyncio.get_running_loop(), None)
+        if connection is not None:
+            await connection.close()
@@ -0,0 +1,284 @@
+import random
+from functools import lru_cache
+from api_app.services.card_catalog import CardCatalog
+
+
+def card_rank(action:str) -> int:
+    """+2 < +4 < black+4, used when stacking draw cards"""
+    if "+4" in action and "wild" in action:
+        return 3
+    if "+4" in action:
+        return 2
+    return 1
+
+
+def card_playable(card, top, stacking:bool) -> bool:
+    """check if `card` can be placed on `top`, ignoring whose turn it is.
+    `stacking` is True when there are cards waiting to be drawn (+2 / +4 on the pile)
+    Can be replaced in the future for different rules
+    """
+    if stacking:
+        if not any(x in card.action for x in ("+2", "+4", "skip")):
+            return False
+        if "skip" in card.action:
+            return card.color == top.color
+        # card have a ranking, +2 < +4 < black+4
+        # you can only place a card superior or equal to the one on the pile
+        if card_rank(card.action) < card_rank(top.action):
+            return False
+
+    if card.color != top.color and card.color != "black":
+        if card.action != top.action:
+            return False # card cannot be placed on the current card
+
+    return True
+
+
+class PlayabilityTable:
+    """
+    card_playable() precomputed for every (top card, candidate card, stacking) of a catalog.
+    Answering "can this card be placed" is then a single lookup in a flat table.
+    """
+    def __init__(self, catalog:CardCatalog):
+        self.index = {card_id: i for i, card_id in enumerate(catalog.ids)}
+        size = len(catalog.ids)
+        self.size = size
+        self.table = bytearray(2 * size * size)
+        for stacking in (False, True):
+            for top_id, top_index in self.index.items():
+                top = catalog.get(top_id)
+                row = (stacking * size + top_index) * size
+                for card_id, card_index in self.index.items():
+                    self.table[row + card_index] = card_playable(catalog.get(card_id), top, stacking)
+
+    def playable(self, top_id:int, card_id:int, stacking:bool) -> bool:
+        return self.table[(stacking * self.size + self.index[top_id]) * self.size + self.index[card_id]] == 1
+
+    def playable_mask(self, hand:list, top_id:int, stacking:bool) -> list:
+        """playable() for every card of a hand, in the same order"""
+        row = (stacking * self.size + self.index[top_id]) * self.size
+        return [self.table[row + self.index[card_id]] == 1 for card_id in hand]
+
+
+@lru_cache(maxsize=4)
+def playability_for(catalog:CardCatalog) -> PlayabilityTable:
+    """the table of a catalog, built once per catalog"""
+    return PlayabilityTable(catalog)
+
+
+class UnoGameState:
+    """
+    The whole state of a game of Uno, in memory.
+    Cards are referenced by their id in the CardCatalog, players by their player number.
+    Every rule is applied here, the service only loads and persists the state.
+    """
+    def __init__(self, cards:CardCatalog, hands:dict, pile:list, current_card:int,
+                 current_player_number:int, direction:bool=False, stored_to_draw:int=0,
+                 said_uno:dict=None, game_over:bool=False, winner:int=None, rng:random.Random=None):
+        self.cards = cards
+        self.rng = rng or random # draws and the first player, the simulation passes its own
+        self.playability = playability_for(cards)
+        self.hands = hands # player number -> list of card ids
+        self.pile = pile
+        self.current_card = current_card
+        self.current_player_number = current_player_number
+        self.direction = direction
+        self.stored_to_draw = stored_to_draw
+        self.said_uno = said_uno if said_uno is not None else {number: False for number in hands}
+        self.game_over = game_over
+        self.winner = winner
+
+        # what changed since the last save, so the service only writes that
+        self.dirty_players = set()
+        self.pile_dirty = False
+        # what happened since the last save, appended to the game log.
+        # Events hold the drawn cards so a game can be replayed without randomness
+        self.events = []
+
+    @classmethod
+    def deal(cls, cards:CardCatalog, deck:list, player_count:int, starting_cards_count:int, rng:random.Random=None):
+        """create a new game from an already shuffled deck of card ids"""
+        hands = {}
+        distributed = 0
+        for number in range(player_count):
+            hands[number] = list(deck[distributed:distributed + starting_cards_count])
+            distributed += starting_cards_count
+
+        state = cls(
+            cards,
+            hands=hands,
+            pile=list(deck[distributed:]),
+            current_card=deck[distributed],
+            current_player_number=(rng or random).randint(0, player_count - 1),
+            rng=rng,
+        )
+        state.dirty_players = set(hands)
+        state.pile_dirty = True
+        return state
+
+    def to_snapshot(self) -> dict:
+        """the state as plain json data, see from_snapshot"""
+        return {
+            "hands": {str(number): list(hand) for number, hand in self.hands.items()},
+            "pile": list(self.pile),
+            "current_card": self.current_card,
+            "current_player_number": self.current_player_number,
+            "direction": self.direction,
+            "stored_to_draw": self.stored_to_draw,
+            "said_uno": {str(number): said for number, said in self.said_uno.items()},
+            "game_over": self.game_over,
+            "winner": self.winner,
+        }
+
+    @classmethod
+    def from_snapshot(cls, cards:CardCatalog, data:dict):
+        return cls(
+            cards,
+            hands={int(number): list(hand) for number, hand in data["hands"].items()},
+            pile=list(data["pile"]),
+            current_card=data["current_card"],
+            current_player_number=data["current_player_number"],
+            direction=data["direction"],
+            stored_to_draw=data["stored_to_draw"],
+            said_uno={int(number): said for number, said in data["said_uno"].items()},
+            game_over=data["game_over"],
+            winner=data["winner"],
+        )
+
+    def apply_event(self, event:dict):
+        """replay an event of the game log"""
+        if event["type"] == "play_card":
+            self.play_card(event["player"], event["card"], event["color"])
+        elif event["type"] == "draw_card":
+            self.draw_card(event["player"], drawn=event["cards"])
+        elif event["type"] == "say_uno":
+            self.say_uno(event["player"])
+        elif event["type"] == "deny_uno":
+            self.deny_uno(event["player"], drawn=event["cards"])
+        else:
+            raise ValueError(f"Unknown event {event['type']}")
+
+    @property
+    def player_count(self) -> int:
+        return len(self.hands)
+
+    def next_turn(self):
+        if self.direction:
+            self.current_player_number = (self.current_player_number + 1) % self.player_count
+        else:
+            self.current_player_number = (self.current_player_number - 1) % self.player_count
+
+    def finish_turn(self):
+        for number in sorted(self.hands):
+            if len(self.hands[number]) == 0:
+                self.game_over = True
+                self.winner = number
+                return
+        self.next_turn()
+
+    def can_place(self, player_number:int, card_id:int) -> bool:
+        if self.game_over:
+            return False # game is over
+        if self.current_player_number != player_number:
+            return False # not your turn
+        if card_id not in self.hands[player_number]:
+            return False # you don't have this card
+        return self.playability.playable(self.current_card, card_id, self.stored_to_draw != 0)
+
+    def playable_mask(self, player_number:int) -> list:
+        """can_place() for every card of a player's hand, in the same order"""
+        hand = self.hands[player_number]
+        if self.game_over or self.current_player_number != player_number:
+            return [False] * len(hand)
+        return self.playability.playable_mask(hand, self.current_card, self.stored_to_draw != 0)
+
+    def play_card(self, player_number:int, card_id:int, color:str=None):
+        """play a card and finish the turn"""
+        if not self.can_place(player_number, card_id):
+            raise ValueError("You can't place this card")
+        card = self.cards.get(card_id)
+        if "wild" in card.action and color not in self.cards.colors:
+            raise Exception("You must specify a color")
+
+        # place the original version of the current card in the pile
+        self.pile.append(self.cards.plain_of(self.current_card))
+        self.pile_dirty = True
+        self.current_card = card_id
+        self.hands[player_number].remove(card_id)
+        self.dirty_players.add(player_number)
+
+        if "reverse" in card.action:
+            self.direction = not self.direction
+        if "+2" in card.action:
+            self.stored_to_draw += 2
+        if "+4" in card.action:
+            self.stored_to_draw += 4
+        if "skip" in card.action:
+            # if put on a +2, it cancel the draw. Else it skips the next player
+            if self.stored_to_draw == 0:
+                self.next_turn()
+            else:
+                self.stored_to_draw = 0
+
+        # if it's a black+4 or a basic black replace the card with a new one with the specified color
+        if "wild" in card.action:
+            self.current_card = self.cards.recolored(card_id, color)
+
+        self.events.append({"type": "play_card", "player": player_number, "card": card_id, "color": color})
+        self.finish_turn()
+
+    def draw_card(self, player_number:int, drawn:list=None):
+        """draw a card (or every stored card) and finish the turn
+        `drawn` forces the cards drawn, when replaying the game log
+        """
+        if player_number != self.current_player_number:
+            raise Exception("It's not your turn")
+        cards = self._draw(player_number, self.stored_to_draw or 1, drawn)
+        self.stored_to_draw = 0
+
+        self.events.append({"type": "draw_card", "player": player_number, "cards": cards})
+        self.finish_turn()
+
+    def _draw(self, player_number:int, count:int, drawn:list=None) -> list:
+        """draw `count` cards from the pile if possible, return the cards drawn"""
+        if drawn is None:
+            drawn = []
+            for _ in range(count):
+                if not self.pile:
+                    break
+                # the pile has no order, swap the drawn card with the last one to pop it cheaply
+                index = self.rng.randrange(len(self.pile))
+                self.pile[index], self.pile[-1] = self.pile[-1], self.pile[index]
+                drawn.append(self.pile.pop())
+        else:
+            # replayed, the pile has no order so any copy of the card will do
+            for card_id in drawn:
+                index = self.pile.index(card_id)
+                self.pile[index], self.pile[-1] = self.pile[-1], self.pile[index]
+                self.pile.pop()
+
+        if drawn:
+            self.hands[player_number].extend(drawn)
+            self.said_uno[player_number] = False
+            self.pile_dirty = True
+            self.dirty_players.add(player_number)
+        return drawn
+
+    def say_uno(self, player_number:int):
+        """announce that you have one card left
+        can be done only if you have one card, or two cards during your turn"""
+        if len(self.hands[player_number]) in (1, 2):
+            self.said_uno[player_number] = True
+            self.dirty_players.add(player_number)
+            self.events.append({"type": "say_uno", "player": player_number})
+        else:
+            raise Exception("You can't say uno")
+
+    def deny_uno(self, target_number:int, drawn:list=None):
+        """has only one card and didn't say uno, draw two cards"""
+        if len(self.hands[target_number]) == 1 and not self.said_uno[target_number]:
+            cards = self._draw(target_number, 2, drawn)
+            self.events.append({"type": "deny_uno", "player": target_number, "cards": cards})
+            self.finish_turn()
+        else:
+            raise Exception("You can't deny uno")
@@ -1,61 +1,256 @@
+from collections import Counter
 from functools import lru_cache
-from api_app.models.uno import CardBack, UnoGame, UnoPlayer, UnoCard   
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, FloatField, Prefetch, Q, Value, When
+from django.db.models.functions import Cast
+from api_app.models.uno import CardBack, UnoGame, UnoGameEvent, UnoGameLog, UnoPlayer
+from api_app.services import game_log
+from api_app.services.card_catalog import CardCatalog, get_catalog
+from api_app.services.leaderboard import rank_store
+from auth_app.models import broadcast_user_updates, changed_user_fields, user_patch
+from api_app.services.uno_engine import UnoGameState
 
 import random
+User = get_user_model()
 
 
+class StaleGameError(ValueError):
+    """the game changed since the version the command was made on"""
+
+
+# what a client can ask for, a deck template of 108 * MAX_DECK_COUNT cards is kept in memory
+MAX_DECK_COUNT = 4
+MAX_STARTING_CARDS_COUNT = 20
+
+
+def _count_option(options:dict, key:str, default:int) -> int:
+    """a whole number sent by the client, its range is checked by verify_counts()"""
+    value = options.get(key, default)
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        value = int(value)
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise Exception(f"{key} must be a whole number")
+    return value
+
 
 # all the settings that can be changed for a game
 class UnoGameRules:
     def __init__(self):
         self.starting_cards_count = 7
+        self.deck_count = 1 # how many standard decks are shuffled together
         self.starting_deck = []
         self.players = []
         self.card_back = "default"
 
+    def set_options(self, options:dict):
+        """the counts chosen by the client, checked before anything is built from them"""
+        self.deck_count = _count_option(options, "deck_count", self.deck_count)
+        self.starting_cards_count = _count_option(options, "starting_cards_count", self.starting_cards_count)
+        self.verify_counts()
+
+    def verify_counts(self):
+        if self.deck_count < 1:
+            raise Exception("Can't play with less than one deck")
+        if self.deck_count > MAX_DECK_COUNT:
+            raise Exception(f"Can't play with more than {MAX_DECK_COUNT} decks")
+        if self.starting_cards_count < 1:
+            raise Exception("Can't start with less than one card")
+        if self.starting_cards_count > MAX_STARTING_CARDS_COUNT:
+            raise Exception(f"Can't start with more than {MAX_STARTING_CARDS_COUNT} cards")
+
     def verify(self):
         if len(self.players) < 2:
             raise Exception("Not enough players")
+        self.verify_counts()
         if len(self.starting_deck) < len(self.players) * self.starting_cards_count + 1:
             raise Exception("Not enough cards")
-        if self.starting_cards_count < 1:
-            raise Exception("Can't start with less than one card")
         for player in self.players:
             if self.players.count(player) > 1:
                 raise Exception("Duplicate player")
     
     def select_base_deck(self):
-        self.starting_deck = get_base_deck()
+        self.verify_counts()
+        self.starting_deck = get_base_deck(self.deck_count)
+
+
+def load_game(**filters) -> UnoGame:
+    """a game with its players and their users in two queries.
+    Rendering it needs no other query, the cosmetics come from the cosmetics cache
+    """
+    players = UnoPlayer.objects.select_related("user")
+    return UnoGame.objects.prefetch_related(Prefetch("players", queryset=players)).get(**filters)
+
+
+def get_base_deck(deck_count:int=1) -> list:
+    """the card ids of `deck_count` standard decks.
+    A new list every time, each game can shuffle and deal it without touching the others
+    """
+    return list(_deck_template(get_catalog(), deck_count))
 
-@lru_cache(maxsize=128)
-def get_base_deck():
+
+@lru_cache(maxsize=8)
+def _deck_template(catalog:CardCatalog, deck_count:int) -> tuple:
+    """the 108 card ids of a standard deck, `deck_count` times.
+    Cached per catalog: when cards change the catalog is replaced and so is the template
+    """
     deck = []
 
     for color in ["red", "green", "blue", "yellow"]:
         for _ in range(2):
             for number in range(1, 10):
-                deck.append(UnoCard.objects.get(color=color, action=str(number), is_special=False))
+                deck.append(catalog.lookup(color, str(number)))
             for action in ["reverse", "skip", "+2"]:
-                deck.append(UnoCard.objects.get(color=color, action=action, is_special=False))
-        deck.append(UnoCard.objects.get(color=color, action="0", is_special=False))
+                deck.append(catalog.lookup(color, action))
+        deck.append(catalog.lookup(color, "0"))
     
     for _ in range(4):
-        deck.append(UnoCard.objects.get(color="black", action="wild_+4_reverse", is_special=False))
-        deck.append(UnoCard.objects.get(color="black", action="wild", is_special=False))
+        deck.append(catalog.lookup("black", "wild_+4_reverse"))
+        deck.append(catalog.lookup("black", "wild"))
     
-    return deck
+    return tuple(deck) * deck_count
 
-            
-            
 
 class UnoGameService:
     """
     Service to manage a game of Uno
-    The service is stateless, it only contains methods to manage the game
+    The game is loaded once into an in-memory UnoGameState, every command is
+    applied to it and the result is persisted in a single transaction.
+    With `write_behind` the commands only change the memory, save() is called
+    later by the live game registry (see api_app.services.live_games).
     """
-    def __init__(self, game:UnoGame):
+    def __init__(self, game:UnoGame, write_behind:bool=False, rng:random.Random=None):
         self.game = game
-    
+        self.write_behind = write_behind
+        self.rng = rng or random
+        self.state = None
+        self.players = {} # player number -> UnoPlayer
+        # what changed since the last save
+        self.saved_version = game.version
+        self.dirty_players = set()
+        self.pile_dirty = False
+        self.events = [] # (sequence, event) for the game log
+        self.currency = Counter() # user id -> cards currency earned
+        if game.pk is not None and game.current_card_id is not None:
+            self._load()
+
+    @property
+    def dirty(self) -> bool:
+        return self.game.version != self.saved_version
+
+    def _load(self):
+        if "players" in getattr(self.game, "_prefetched_objects_cache", {}):
+            players = list(self.game.players.all()) # from load_game()
+        else:
+            players = list(self.game.players.select_related("user"))
+        self.players = {player.player_number: player for player in players}
+        self.state = UnoGameState(
+            get_catalog(),
+            hands={player.player_number: list(player.hand) for player in players},
+            pile=list(self.game.pile),
+            current_card=self.game.current_card_id,
+            current_player_number=self.game.current_player_number,
+            direction=self.game.direction,
+            stored_to_draw=self.game.stored_to_draw,
+            said_uno={player.player_number: player.said_uno for player in players},
+            game_over=self.game.game_over,
+            winner=next((player.player_number for player in players if player.id == self.game.winner_id), None),
+            rng=self.rng,
+        )
+        if self.game.log_id is None:
+            return
+
+        # the rows are only written every few moves, the moves after them are in the log
+        events = UnoGameEvent.objects.filter(log_id=self.game.log_id, sequence__gt=self.game.version).order_by("sequence")
+        for event in events:
+            self.state.apply_event(event.to_event())
+            self.game.version = event.sequence
+        self.saved_version = self.game.version
+        self.state.events.clear()
+        self._sync()
+        self.dirty_players.clear()
+
+    def _sync(self):
+        """copy the in-memory state to the model instances, without writing them"""
+        state = self.state
+        if state.pile_dirty:
+            self.game.pile = list(state.pile)
+            self.pile_dirty = True
+        self.game.current_card_id = state.current_card
+        self.game.current_player_number = state.current_player_number
+        self.game.direction = state.direction
+        self.game.stored_to_draw = state.stored_to_draw
+        self.game.game_over = state.game_over
+        self.game.winner = self.players[state.winner] if state.winner is not None else None
+
+        for number in state.dirty_players:
+            player = self.players[number]
+            player.said_uno = state.said_uno[number]
+            player.hand = list(state.hands[number])
+        self.dirty_players |= state.dirty_players
+        self.events.extend((self.game.version, event) for event in state.events)
+        state.dirty_players.clear()
+        state.pile_dirty = False
+        state.events.clear()
+
+    def save(self, snapshot:bool=False):
+        """write the in-memory state back to the database
+        With a game log, a move only appends its events: the log can't have two events with
+        the same sequence, so if someone else played in between nothing is written.
+        The game and player rows are written with the snapshots only (every few moves, and
+        when the game ends), loading a game replays the events after them.
+        Games without a log write their rows every time, if their version is still the one saved last.
+        `snapshot` forces a snapshot of the state.
+        """
+        self._sync()
+        checkpoint = self.game.log_id is None or snapshot or game_log.snapshot_due(self.state, self.saved_version, self.game.version)
+        try:
+            with transaction.atomic():
+                if self.game.log_id is not None:
+                    game_log.append(self.game.log_id, self.events, self.state, self.saved_version, self.game.version, snapshot=checkpoint)
+                    version = Q(version__lt=self.game.version)
+                else:
+                    version = Q(version=self.saved_version)
+
+                if checkpoint:
+                    updated = UnoGame.objects.filter(version, pk=self.game.pk).update(
+                        pile=self.game.pile,
+                        current_card_id=self.game.current_card_id,
+                        current_player_number=self.game.current_player_number,
+                        direction=self.game.direction,
+                        stored_to_draw=self.game.stored_to_draw,
+                        game_over=self.game.game_over,
+                        winner=self.game.winner,
+                        version=self.game.version,
+                    )
+                    if updated == 0:
+                        raise StaleGameError("The game has changed, try again")
+                    # the rows may be several moves behind, every hand is written
+                    players = self.players.values() if self.game.log_id is not None else [self.players[number] for number in self.dirty_players]
+                    if players:
+                        UnoPlayer.objects.bulk_update(players, ["hand", "said_uno"])
+
+                if self.currency:
+                    for user_id, amount in self.currency.items():
+                        User.objects.filter(pk=user_id).update(cards_currency=F("cards_currency") + amount)
+                    # update() sends no post_save, the new balances are read back and broadcast here
+                    balances = dict(User.objects.filter(pk__in=self.currency).values_list("id", "cards_currency"))
+                    patches = {user_id: {"cards_currency": balance} for user_id, balance in balances.items()}
+                    for player in self.players.values():
+                        if player.user_id in balances:
+                            player.user.cards_currency = balances[player.user_id]
+                            changed_user_fields(player.user, ["cards_currency"]) # remembered as sent
+                    transaction.on_commit(lambda: broadcast_user_updates(patches))
+        except IntegrityError:
+            # the events of these moves were written by someone else
+            raise StaleGameError("The game has changed, try again")
+
+        self.saved_version = self.game.version
+        self.dirty_players.clear()
+        self.pile_dirty = False
+        self.events.clear()
+        self.currency.clear()
+
     def start_game(self, rules:UnoGameRules):
         rules.verify()
 
@@ -64,187 +259,114 @@ class UnoGameService:
         self.game.stored_to_draw = 0
         self.game.winner = None
         self.game.card_back = CardBack.objects.get(name=rules.card_back)
+        self.game.log = UnoGameLog.objects.create(
+            room=self.game.room, players=[user.id for user in rules.players]
+        )
         self.game.save()
-        
-        random.shuffle(rules.starting_deck)
-        
-        # distribute cards then assign player number and save
-        distributed = 0
-        for user in rules.players:
-            existing = UnoPlayer.objects.filter(user=user)
-            if existing.exists():
-                existing.delete()
-
-            player = UnoPlayer.objects.create(user=user, player_number=rules.players.index(user), game=self.game)
-            player.hand.set(rules.starting_deck[distributed:distributed + rules.starting_cards_count])
-            distributed += rules.starting_cards_count
-            player.save()
-
-        self.game.current_player_number = random.randint(0, len(rules.players) - 1)
-        self.game.current_card = rules.starting_deck[distributed]
-        self.game.pile.set(rules.starting_deck[distributed:])
-        self.game.save()
-    
-    def _set_to_next_turn(self):
-        if self.game.direction:
-            self.game.current_player_number = (self.game.current_player_number + 1) % self.game.players.count()
-        else:
-            self.game.current_player_number = (self.game.current_player_number - 1) % self.game.players.count()
-        self.game.save()
-        
+        self.saved_version = self.game.version
+
+        self.rng.shuffle(rules.starting_deck)
+        self.state = UnoGameState.deal(
+            get_catalog(),
+            rules.starting_deck,
+            len(rules.players),
+            rules.starting_cards_count,
+            self.rng,
+        )
+
+        # assign player numbers, the hands are written by save()
+        UnoPlayer.objects.filter(user__in=rules.players).delete()
+        self.players = {
+            number: UnoPlayer.objects.create(user=user, player_number=number, game=self.game)
+            for number, user in enumerate(rules.players)
+        }
+        # the dealt game is the first snapshot of the log
+        self.game.version += 1
+        self.save(snapshot=True)
+
     def finish_turn(self):
-        winner = None
-        for player in self.game.players.all():
-            if player.hand.count() == 0:
-                winner = player
-                break
-
-        if winner is not None:
-            self.game.game_over = True
-            self.game.winner = self.game.current_player
-            self.game.save()
-            for player in self.game.players.all():
-                player.user.games_played += 1
-                if player == self.game.winner:
-                    player.user.games_won += 1
-                player.user.save()
+        """record the stats of the players if the last command ended the game.
+        One UPDATE for every player, the users are broadcast and ranked once it is committed
+        """
+        if not self.state.game_over:
             return
-        self._set_to_next_turn()
-        self.game.save()
-    
-    def get_player(self, user):
-        return UnoPlayer.objects.get(user=user, game=self.game)
+        winner = self.players[self.state.winner]
+        player_ids = [player.user_id for player in self.players.values()]
+        won = Case(When(pk=winner.user_id, then=Value(1)), default=Value(0))
+        with transaction.atomic():
+            # win_rate is computed from the old values, so it is set first: MySQL evaluates
+            # the SET from left to right and would see the new games_won and games_played
+            User.objects.filter(pk__in=player_ids).update(
+                win_rate=Cast(F("games_won") + won, FloatField()) / Cast(F("games_played") + 1, FloatField()),
+                games_played=F("games_played") + 1,
+                games_won=F("games_won") + won,
+            )
+
+            # the loaded users may be outdated, the new stats are read back for them and the patches
+            stats = {
+                user_id: (games_played, games_won, win_rate)
+                for user_id, games_played, games_won, win_rate in User.objects.filter(pk__in=player_ids).values_list("id", "games_played", "games_won", "win_rate")
+            }
+            patches = {}
+            for player in self.players.values():
+                player.user.games_played, player.user.games_won, player.user.win_rate = stats[player.user_id]
+                fields = changed_user_fields(player.user, ["games_played", "games_won", "win_rate"])
+                patches[player.user_id] = user_patch(player.user, fields)
+            transaction.on_commit(lambda: broadcast_user_updates(patches))
+            transaction.on_commit(lambda: rank_store.record(stats))
+
+    def get_player(self, user) -> UnoPlayer:
+        for player in self.players.values():
+            if player.user_id == user.id:
+                return player
+        raise UnoPlayer.DoesNotExist("This user is not playing this game")
 
-    
     def can_place(self, player:UnoPlayer, card:dict):
-        """check if a card can be placed on the current card. 
-        Can be replaced in the future for different rules
+        """check if a card can be placed on the current card."""
+        return self.state.can_place(player.player_number, card["id"])
+
+    def _run(self, command, *args, expected_version=None):
+        """apply a command to the state, then persist it once (or later, with write behind)
+        `expected_version` is the version the client acted on, if it is outdated the
+        command is rejected before touching the state
         """
-        if self.game.game_over:
-            return False # game is over
-        if self.game.current_player_number != player.player_number:
-            return False # not your turn
-        if card["id"] not in [card.id for card in player.hand.all()]:
-            return False # you don't have this card
-        
-        if self.game.stored_to_draw != 0:
-            if not any(x in card["action"] for x in ("+2", "+4", "skip")):
-                return False
-            if "skip" in card["action"]:
-                return card["color"] == self.game.current_card.color
-            # card have a ranking, +2 < +4 < black+4
-            # you can only place a card superior or equal to the one on the pile
-            rank = lambda a: 3 if ("+4" in a and "wild" in a) else (2 if "+4" in a else 1)
-            if rank(card["action"]) < rank(self.game.current_card.action):
-                return False
-        
-        if card["color"] != self.game.current_card.color and card["color"] != "black":
-            if card["action"] != self.game.current_card.action:
-                return False # card cannot be placed on the current card
-            
-        return True
-
-    def play_card(self, user, card:UnoCard, color=None):
+        if expected_version is not None and expected_version != self.game.version:
+            raise StaleGameError("The game has changed, your action is outdated")
+        was_over = self.state.game_over
+        command(*args)
+        self.game.version += 1
+        self._sync()
+        if not self.write_behind:
+            self.save()
+        if not was_over:
+            self.finish_turn()
+
+    def play_card(self, user, card_id:int, color=None, expected_version=None):
         """play a card and finish the turn"""
-        
         player = self.get_player(user)
-        if not self.can_place(player, card.to_dict()):
-            print("trying to place", card.to_dict(), "on", self.game.current_card.to_dict())
-            raise ValueError("You can't place this card")
-
-        # alternative way of doing things :
-            # a bit of a trick, we don't place the current card in the pile but a copy,
-            # so at every point the current card is also in the can draw pile
-            # this has 2 advantages: 
-            #   - we never get stuck, because the current card can be "duplicated"
-            #   - we can alter the current card without altering the pile
-            # this has 2 drawbacks:
-            #   - the pile will be bigger than it should
-            #   - if there's only one card left in the pile, the game will never end, we can pick then place the same card on itself
-            #       but this is a very unlikely scenario.
-            # self.game.pile.add(card)
-            # self.game.current_card = card
-
-        # place the original version of the current card in the pile
-        self.game.pile.add(
-            UnoCard.objects.get(
-                action=self.game.current_card.action, 
-                color=self.game.current_card.color if "wild" not in self.game.current_card.action else "black",
-                is_special=False
-            )
-        )
-        self.game.current_card = card
-        player.hand.remove(card)
-        
-        if "reverse" in card.action:
-            self.game.direction = not self.game.direction
-        if "+2" in card.action:
-            self.game.stored_to_draw += 2
-        if "+4" in card.action:
-            self.game.stored_to_draw += 4
-        if "skip" in card.action:
-            # if put on a +2, it cancel the draw. Else it skips the next player
-            if self.game.stored_to_draw == 0:
-                self._set_to_next_turn()
-            else :
-                self.game.stored_to_draw = 0
-        
-        # if it's a black+4 or a basic black replace the card with a new one with the specified color
-        if "wild" in card.action:
-            if color is None:
-                raise Exception("You must specify a color")
-            self.game.current_card = UnoCard.objects.get(is_special=True, color=color, action=card.action)
-
-        player.save()
-        self.finish_turn()
-        
-        player.user.cards_currency += 1
-        player.user.save()
-
-    def draw_card(self, user):
+
+        def play(*args):
+            self.state.play_card(*args)
+            # only the currency is written, with the game (later, with write behind): a full
+            # save of the user would write back whatever else it changed meanwhile
+            self.currency[player.user_id] += 1
+        self._run(play, player.player_number, card_id, color, expected_version=expected_version)
+
+    def draw_card(self, user, expected_version=None):
         """draw a card and finish the turn"""
         player = self.get_player(user)
-        if player.player_number != self.game.current_player_number:
-            raise Exception("It's not your turn")
-        if self.game.stored_to_draw != 0:
-            for _ in range(self.game.stored_to_draw):
-                self._draw_one(player)
-            self.game.stored_to_draw = 0
-        else :
-            self._draw_one(player)
-        
-        self.finish_turn()
-    
-    def _draw_one(self, player:UnoPlayer):
-        """draw one card from the pile if possible"""
-        if self.game.pile.count() != 0:
-            card = random.choice(self.game.pile.all())
-            self.game.pile.remove(card)
-            player.hand.add(card)
-            player.said_uno = False
-            player.save()
-    
-    def say_uno(self, user):
-        """announce that you have one card left
-        can be done only if you have one card, or two cards during your turn"""
+        self._run(self.state.draw_card, player.player_number, expected_version=expected_version)
+
+    def say_uno(self, user, expected_version=None):
+        """announce that you have one card left"""
         player = self.get_player(user)
-        card_count = player.hand.count()
-        if card_count == 1 or card_count == 2:
-            player.said_uno = True
-            player.save()
-        else:
-            raise Exception("You can't say uno")
+        self._run(self.state.say_uno, player.player_number, expected_version=expected_version)
 
-    def deny_uno(self, target_user):
+    def deny_uno(self, target_user, expected_version=None):
         """has only one card and didn't say uno, draw two cards"""
         target_player = self.get_player(target_user)
-        if target_player.hand.count() == 1 and not target_player.said_uno:
-            self._draw_one(target_player)
-            self._draw_one(target_player)
-            self.finish_turn()
-            target_player.save()
-        else:
-            raise Exception("You can't deny uno")
-    
+        self._run(self.state.deny_uno, target_player.player_number, expected_version=expected_version)
+
     def to_dict(self, request=None) -> dict:
-        return self.game.to_dict()
+        """the game rendered from memory, the database may be behind"""
+        return self.game.to_dict(players=sorted(self.players.values(), key=lambda player: player.user_id))
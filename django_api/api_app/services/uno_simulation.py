@@ -0,0 +1,181 @@
+import random
+import time
+import tracemalloc
+from collections import Counter
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from api_app.services.card_catalog import get_catalog
+from api_app.services.uno_engine import UnoGameState
+
+# headless games, used to measure how many turns per second the engine sustains.
+# A player strategy receives the state and its player number and returns
+# (card id, color) to play, or None to draw.
+
+MAX_TURNS = 1000 # a game where nobody can draw anymore could last forever
+
+
+def random_player(state:UnoGameState, player_number:int, rng:random.Random):
+    hand = state.hands[player_number]
+    playable = [card_id for card_id, can_play in zip(hand, state.playable_mask(player_number)) if can_play]
+    if not playable:
+        return None
+    return rng.choice(playable), rng.choice(state.cards.colors)
+
+
+def heuristic_player(state:UnoGameState, player_number:int, rng:random.Random):
+    """keep the wild cards for the end, pick the color we have the most of"""
+    hand = state.hands[player_number]
+    playable = [card_id for card_id, can_play in zip(hand, state.playable_mask(player_number)) if can_play]
+    if not playable:
+        return None
+    playable.sort(key=lambda card_id: state.cards.get(card_id).color == "black")
+    colors = Counter(state.cards.get(card_id).color for card_id in hand if state.cards.get(card_id).color != "black")
+    color = colors.most_common(1)[0][0] if colors else rng.choice(state.cards.colors)
+    return playable[0], color
+
+
+STRATEGIES = {
+    "random": random_player,
+    "heuristic": heuristic_player,
+}
+
+
+def play_turn(state:UnoGameState, strategy, rng:random.Random):
+    """the current player says uno if needed, then plays or draws"""
+    number = state.current_player_number
+    if len(state.hands[number]) == 2 and not state.said_uno[number]:
+        state.say_uno(number)
+    move = strategy(state, number, rng)
+    if move is None:
+        state.draw_card(number)
+    else:
+        state.play_card(number, move[0], move[1])
+
+
+class SimulationReport:
+    """turn latencies and query counts of a batch of games"""
+    def __init__(self, mode:str):
+        self.mode = mode
+        self.games = 0
+        self.finished_games = 0
+        self.latencies = [] # seconds, one per turn
+        self.queries = 0
+        self.elapsed = 0.0
+        self.memory_per_game = 0
+
+    @property
+    def turns(self) -> int:
+        return len(self.latencies)
+
+    def percentile(self, percent:float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+    def to_dict(self) -> dict:
+        return {
+            "mode": self.mode,
+            "games": self.games,
+            "finished_games": self.finished_games,
+            "turns": self.turns,
+            "turns_per_second": self.turns / self.elapsed if self.elapsed else 0.0,
+            "queries_per_turn": self.queries / self.turns if self.turns else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "memory_per_game_bytes": self.memory_per_game,
+        }
+
+
+def _deal(player_count:int, rng:random.Random) -> UnoGameState:
+    from api_app.services.uno_game_service import get_base_deck
+    deck = get_base_deck()
+    rng.shuffle(deck)
+    return UnoGameState.deal(get_catalog(), deck, player_count, 7, rng)
+
+
+def simulate_in_memory(games:int, player_count:int, strategy:str="heuristic", seed:int=None) -> SimulationReport:
+    """play full games on UnoGameState only, no database"""
+    rng = random.Random(seed)
+    strategy = STRATEGIES[strategy]
+    report = SimulationReport("memory")
+
+    # memory: how much a live game costs, measured on freshly dealt games
+    # (the catalog and the deck template are loaded before measuring)
+    _deal(player_count, rng)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    states = [_deal(player_count, rng) for _ in range(max(1, min(games, 100)))]
+    report.memory_per_game = (tracemalloc.get_traced_memory()[0] - before) // len(states)
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for index in range(games):
+        state = states[index] if index < len(states) else _deal(player_count, rng)
+        report.games += 1
+        for _ in range(MAX_TURNS):
+            if state.game_over:
+                break
+            turn_start = time.perf_counter()
+            play_turn(state, strategy, rng)
+            report.latencies.append(time.perf_counter() - turn_start)
+        report.finished_games += state.game_over
+    report.elapsed = time.perf_counter() - start
+    return report
+
+
+def simulate_with_database(games:int, player_count:int, strategy:str="heuristic", seed:int=None) -> SimulationReport:
+    """play full games through UnoGameService on the configured database.
+    Every turn loads the game, runs the command and persists it, like the websocket does.
+    Everything is rolled back at the end.
+    """
+    from django.contrib.auth import get_user_model
+    from api_app.models import Room
+    from api_app.models.uno import UnoGame
+    from api_app.services.uno_game_service import UnoGameRules, UnoGameService
+
+    rng = random.Random(seed)
+    strategy = STRATEGIES[strategy]
+    report = SimulationReport("database")
+    User = get_user_model()
+
+    with transaction.atomic():
+        room = Room(name="simulation")
+        room.invitation_code = room.generate_invitation_code()
+        room.save()
+        users = [
+            User.objects.create(username=f"simulation_{room.invitation_code}_{number}", room=room)
+            for number in range(player_count)
+        ]
+
+        start = time.perf_counter()
+        for _ in range(games):
+            UnoGame.objects.filter(room=room).delete()
+            rules = UnoGameRules()
+            rules.players = users
+            rules.select_base_deck()
+            UnoGameService(UnoGame(room=room), rng=rng).start_game(rules)
+            report.games += 1
+
+            for _ in range(MAX_TURNS):
+                turn_start = time.perf_counter()
+                with CaptureQueriesContext(connection) as queries:
+                    service = UnoGameService(UnoGame.objects.get(room=room), rng=rng)
+                    if service.state.game_over:
+                        break
+                    number = service.state.current_player_number
+                    user = service.players[number].user
+                    if len(service.state.hands[number]) == 2 and not service.state.said_uno[number]:
+                        service.say_uno(user)
+                    move = strategy(service.state, number, rng)
+                    if move is None:
+                        service.draw_card(user)
+                    else:
+                        service.play_card(user, move[0], move[1])
+                report.latencies.append(time.perf_counter() - turn_start)
+                report.queries += len(queries)
+            report.finished_games += service.state.game_over
+        report.elapsed = time.perf_counter() - start
+
+        transaction.set_rollback(True)
+    return report
@@ -1,3 +1,773 @@
-from django.test import TestCase
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from django.contrib.auth import get_user_model
+from django.db import connection
+import msgpack
+import random
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from unittest import mock
+from rest_framework.test import APIClient
 
-# Create your tests here.
+from api_app.consummers import room_replay
+from api_app.consummers.room_queue import RoomCommandQueue
+from api_app.consummers.room_replay import RoomReplay
+from api_app.consummers.uno_game_consummer import expected_version
+from api_app.models.shop import CardBackInventory, GameEnvironment
+from api_app.models.uno import CardBack, UnoCard
+from api_app.models import Room
+from api_app.models.uno import UnoGame
+from api_app.services import card_catalog, cosmetics_cache, leaderboard
+from api_app.services.game_log import SNAPSHOT_INTERVAL, rebuild_state
+from api_app.services.leaderboard import DatabaseRanks, MemoryRanks, RankedList
+from api_app.services.game_snapshot import apply_patch, compact_cards, diff_game, project_for_viewer
+from api_app.services.live_games import LiveGameRegistry
+from api_app.services.presence import USER_SOCKETS, DatabasePresence, MemoryPresence, PresenceRegistry
+from api_app.services.room_sequence import DatabaseSequencer, MemorySequencer
+from api_app.services.socket_channel_layer import ChannelBroker, UnixSocketChannelLayer
+from api_app.services.uno_engine import card_playable, playability_for
+from api_app.services.uno_game_service import StaleGameError, UnoGameRules, UnoGameService, load_game
+from api_app.services.uno_simulation import simulate_in_memory, simulate_with_database
+from auth_app.broadcaster import UserUpdateBroadcaster
+from auth_app.models import ACTIVE_COSMETICS, changed_user_fields, user_patch
+
+
+def create_uno_cards():
+    """the cards of the base game, like the ones created by the card script"""
+    colors = ["red", "green", "blue", "yellow"]
+    for color in colors:
+        for action in [str(number) for number in range(10)] + ["+2", "skip", "reverse"]:
+            UnoCard.objects.create(color=color, action=action, image=f"base_cards/{color}_{action}.png")
+        for action in ["wild", "wild_+4_reverse"]:
+            UnoCard.objects.create(color=color, action=action, image=f"base_cards/{action}_{color}.png", is_special=True)
+    for action in ["wild", "wild_+4_reverse"]:
+        UnoCard.objects.create(color="black", action=action, image=f"base_cards/{action}.png")
+    CardBack.objects.create(name="default", image="card_back/default.png")
+    GameEnvironment.objects.create(name="default", description="", price=0, image="game_environments/default.png")
+
+
+class CachesResetMixin:
+    """the process-wide caches are rebuilt from the rows of each test"""
+    def setUp(self):
+        super().setUp()
+        card_catalog.reset_catalog()
+        cosmetics_cache.reset_cosmetics()
+        leaderboard.rank_store.reset()
+
+
+class GameSnapshotTests(CachesResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_uno_cards()
+
+    def setUp(self):
+        super().setUp()
+        self.room = Room.objects.create(name="snapshot", invitation_code="SNAPSHOT")
+        users = [get_user_model().objects.create(username=f"snapshot_{number}", room=self.room) for number in range(3)]
+        rules = UnoGameRules()
+        rules.players = users
+        rules.select_base_deck()
+        UnoGameService(UnoGame(room=self.room)).start_game(rules)
+
+    def test_patch_rebuilds_the_new_game(self):
+        changed = set()
+        for _ in range(30):
+            service = UnoGameService(load_game(room=self.room))
+            if service.state.game_over:
+                break
+            old = service.to_dict()
+            number = service.state.current_player_number
+            playable = [card_id for card_id, can_play in zip(service.state.hands[number], service.state.playable_mask(number)) if can_play]
+            if playable:
+                service.play_card(service.players[number].user, playable[0], "red")
+            else:
+                service.draw_card(service.players[number].user)
+            new = service.to_dict()
+            patch = diff_game(old, new)
+            self.assertIn("hand", patch["players"][str(number)])
+            self.assertEqual(apply_patch(old, patch), new)
+            changed.update(patch)
+        self.assertLessEqual({"current_card", "pile", "current_player_number"}, changed)
+
+    def test_binary_projection_has_card_ids(self):
+        service = UnoGameService(load_game(room=self.room))
+        number = service.state.current_player_number
+        viewer = service.players[number].user_id
+        projection = project_for_viewer(service.to_dict(), viewer)
+        compact = compact_cards(projection)
+
+        self.assertEqual(compact["current_card"], service.state.current_card)
+        for player in compact["players"]:
+            if player["user"]["id"] == viewer:
+                self.assertEqual(player["hand"], list(service.state.hands[number]))
+                self.assertEqual(player["can_play"], service.state.playable_mask(number))
+            else:
+                self.assertIsInstance(player["hand"], int)
+        self.assertEqual(msgpack.unpackb(msgpack.packb(compact)), compact)
+
+    def test_other_players_can_not_be_patched(self):
+        game = UnoGameService(load_game(room=self.room)).to_dict()
+        self.assertIsNone(diff_game(game, {**game, "players": game["players"][1:]}))
+
+
+class UnoGameRulesTests(SimpleTestCase):
+    def test_client_counts_are_checked(self):
+        rules = UnoGameRules()
+        rules.set_options({"deck_count": "2", "starting_cards_count": 10})
+        self.assertEqual((rules.deck_count, rules.starting_cards_count), (2, 10))
+        invalid = [
+            ({"deck_count": 10 ** 8}, "Can't play with more than 4 decks"),
+            ({"deck_count": 0}, "Can't play with less than one deck"),
+            ({"deck_count": "two"}, "deck_count must be a whole number"),
+            ({"deck_count": 1.5}, "deck_count must be a whole number"),
+            ({"starting_cards_count": [7]}, "starting_cards_count must be a whole number"),
+            ({"starting_cards_count": "-3"}, "Can't start with less than one card"),
+            ({"starting_cards_count": 500}, "Can't start with more than 20 cards"),
+        ]
+        for options, error in invalid:
+            with self.subTest(options=options), self.assertRaisesMessage(Exception, error):
+                UnoGameRules().set_options(options)
+
+
+class RoomCommandQueueTests(SimpleTestCase):
+    async def test_commands_of_a_room_run_in_order(self):
+        log = []
+
+        async def command(room_id, name):
+            log.append(("start", room_id, name))
+            await asyncio.sleep(0.01 if name == 0 else 0) # the first one is the slowest
+            log.append(("end", room_id, name))
+            if name == 2:
+                raise ValueError("refused")
+            return name
+
+        results = await asyncio.gather(
+            *(RoomCommandQueue.run(1, command, 1, name) for name in range(4)),
+            RoomCommandQueue.run(2, command, 2, 9),
+            return_exceptions=True,
+        )
+        self.assertEqual(results[:2] + results[3:], [0, 1, 3, 9])
+        self.assertIsInstance(results[2], ValueError)
+        room_log = [entry for entry in log if entry[1] == 1]
+        self.assertEqual(room_log, [(step, 1, name) for name in range(4) for step in ("start", "end")])
+        # the other room did not wait for the slow command
+        self.assertLess(log.index(("end", 2, 9)), log.index(("end", 1, 0)))
+        self.assertEqual(RoomCommandQueue.rooms, {})
+
+
+class PlayabilityTableTests(CachesResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_uno_cards()
+
+    def test_table_matches_the_rules(self):
+        catalog = card_catalog.get_catalog()
+        table = playability_for(catalog)
+        self.assertIs(playability_for(catalog), table)
+        hand = list(catalog.ids)
+        for stacking in (False, True):
+            for top_id in catalog.ids:
+                top = catalog.get(top_id)
+                expected = [card_playable(catalog.get(card_id), top, stacking) for card_id in hand]
+                self.assertEqual(table.playable_mask(hand, top_id, stacking), expected)
+                self.assertEqual([table.playable(top_id, card_id, stacking) for card_id in hand], expected)
+
+
+class UnoSimulationTests(CachesResetMixin, TestCase):
+    # queries a turn may cost through UnoGameService (load, command, persist), about 8 today
+    QUERIES_PER_TURN_BUDGET = 9
+
+    @classmethod
+    def setUpTestData(cls):
+        create_uno_cards()
+
+    def test_in_memory_games_finish(self):
+        report = simulate_in_memory(50, 4, seed=1)
+        self.assertEqual(report.finished_games, 50)
+        self.assertEqual(report.queries, 0)
+
+    def test_random_players_play_valid_moves(self):
+        report = simulate_in_memory(50, 6, strategy="random", seed=2)
+        self.assertEqual(report.games, 50)
+        self.assertGreater(report.turns, 0)
+
+    def test_seed_replays_the_same_games(self):
+        random.seed(0)
+        expected = random.random()
+        first = simulate_in_memory(5, 4, seed=4)
+        random.seed(0)
+        second = simulate_in_memory(5, 4, seed=4)
+        self.assertEqual(first.turns, second.turns)
+        # the simulation has its own generator, the process-wide one is left alone
+        self.assertEqual(random.random(), expected)
+
+    def test_database_turn_query_budget(self):
+        report = simulate_with_database(3, 4, seed=3)
+        self.assertEqual(report.finished_games, 3)
+        self.assertLessEqual(report.to_dict()["queries_per_turn"], self.QUERIES_PER_TURN_BUDGET)
+
+
+class GameLogTests(CachesResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_uno_cards()
+
+    def setUp(self):
+        super().setUp()
+        self.room = Room.objects.create(name="log", invitation_code="LOGTEST")
+        self.users = [get_user_model().objects.create(username=f"log_{number}", room=self.room) for number in range(3)]
+        rules = UnoGameRules()
+        rules.players = self.users
+        rules.select_base_deck()
+        UnoGameService(UnoGame(room=self.room)).start_game(rules)
+
+    def assertSameGame(self, state, other):
+        # the pile has no order
+        state, other = state.to_snapshot(), other.to_snapshot()
+        self.assertEqual(sorted(state.pop("pile")), sorted(other.pop("pile")))
+        self.assertEqual(state, other)
+
+    def play(self, turns:int, service:UnoGameService=None) -> UnoGameService:
+        for _ in range(turns):
+            if service is None or not service.write_behind:
+                service = UnoGameService(UnoGame.objects.get(room=self.room))
+            if service.state.game_over:
+                break
+            number = service.state.current_player_number
+            playable = [card_id for card_id, can_play in zip(service.state.hands[number], service.state.playable_mask(number)) if can_play]
+            if playable:
+                service.play_card(service.players[number].user, playable[0], "red")
+            else:
+                service.draw_card(service.players[number].user)
+        return UnoGameService(UnoGame.objects.get(room=self.room))
+
+    def test_replay_rebuilds_the_game(self):
+        service = self.play(40)
+        self.assertSameGame(rebuild_state(service.game.log), service.state)
+
+    def test_log_outlives_the_game(self):
+        service = self.play(5)
+        log = service.game.log
+        UnoGame.objects.filter(room=self.room).delete()
+        self.assertEqual(log.events.count(), 5)
+        self.assertSameGame(rebuild_state(log), service.state)
+
+    def test_moves_on_the_same_version_race(self):
+        first, second = (UnoGameService(UnoGame.objects.get(room=self.room)) for _ in range(2))
+        number = first.state.current_player_number
+        user = first.players[number].user
+        first.draw_card(user)
+        saved = UnoGame.objects.get(room=self.room)
+
+        with self.assertRaises(StaleGameError):
+            second.draw_card(second.players[number].user)
+        with self.assertRaises(StaleGameError):
+            UnoGameService(UnoGame.objects.get(room=self.room)).draw_card(user, expected_version=first.saved_version - 1)
+        game = UnoGameService(UnoGame.objects.get(room=self.room))
+        self.assertEqual(game.game.version, first.game.version)
+        self.assertSameGame(game.state, first.state)
+        self.assertEqual(game.game.log.events.count(), 1)
+        # the move was only appended to the log, the rows are still the dealt game
+        self.assertEqual((saved.version, saved.pile), (1, UnoGame.objects.get(room=self.room).pile))
+
+    def test_moves_only_append_to_the_log(self):
+        service = UnoGameService(UnoGame.objects.get(room=self.room))
+        number = service.state.current_player_number
+        with CaptureQueriesContext(connection) as queries:
+            service.draw_card(service.players[number].user)
+        statements = [query["sql"].split()[0] for query in queries if "SAVEPOINT" not in query["sql"]]
+        self.assertEqual(statements, ["INSERT"])
+
+        # the rows are written with the snapshots, and the game loads the same either way
+        service = self.play(SNAPSHOT_INTERVAL)
+        saved = UnoGame.objects.get(room=self.room)
+        self.assertLess(service.game.version - saved.version, SNAPSHOT_INTERVAL)
+        self.assertSameGame(rebuild_state(service.game.log), service.state)
+
+    def test_client_version_is_a_whole_number(self):
+        self.assertEqual([expected_version({}), expected_version({"version": 3}), expected_version({"version": "3"})], [None, 3, 3])
+        for version in ["three", 3.5, True, [3]]:
+            with self.subTest(version=version), self.assertRaisesMessage(ValueError, "The version must be a whole number"):
+                expected_version({"version": version})
+
+    def test_end_of_game_stats_are_one_update(self):
+        service = UnoGameService(UnoGame.objects.get(room=self.room))
+        service.state.game_over = True
+        service.state.winner = 1
+        winner = service.players[1].user_id
+        # another game of the winner ended after this one was loaded
+        get_user_model().objects.filter(pk=winner).update(games_played=1, games_won=1, win_rate=1.0)
+        cosmetics_cache.get_cosmetics()
+        with mock.patch("api_app.services.uno_game_service.broadcast_user_updates") as broadcast, \
+                mock.patch("api_app.services.uno_game_service.rank_store") as ranks, \
+                CaptureQueriesContext(connection) as queries, self.captureOnCommitCallbacks(execute=True):
+            service.finish_turn()
+        # the new stats are read back for the patches
+        statements = [query["sql"] for query in queries if "SAVEPOINT" not in query["sql"]]
+        self.assertEqual([sql.split()[0] for sql in statements], ["UPDATE", "SELECT"])
+        # set before games_won and games_played, whatever order the database evaluates them in
+        self.assertLess(statements[0].index('"win_rate" ='), statements[0].index('"games_won" ='))
+        stats = {user.id: (user.games_played, user.games_won, user.win_rate) for user in get_user_model().objects.filter(room=self.room)}
+        self.assertEqual(stats[winner], (2, 2, 1.0))
+        self.assertEqual(sorted(stats.values()), [(1, 0, 0.0), (1, 0, 0.0), (2, 2, 1.0)])
+        self.assertEqual(broadcast.call_args.args[0][winner], {"games_played": 2, "games_won": 2, "win_rate": 1.0})
+        ranks.record.assert_called_once_with(stats)
+        self.assertEqual((service.players[1].user.games_played, service.players[1].user.games_won), (2, 2))
+
+    def test_played_card_only_writes_the_currency(self):
+        service = UnoGameService(UnoGame.objects.get(room=self.room))
+        number = service.state.current_player_number
+        user = service.players[number].user
+        # changed by another request after the game was loaded
+        get_user_model().objects.filter(pk=user.pk).update(cards_currency=50, roblox_username="builder")
+
+        playable = [card_id for card_id, can_play in zip(service.state.hands[number], service.state.playable_mask(number)) if can_play]
+        with mock.patch("api_app.services.uno_game_service.broadcast_user_updates") as broadcast, self.captureOnCommitCallbacks(execute=True):
+            if playable:
+                service.play_card(user, playable[0], "red")
+            else:
+                service.draw_card(user)
+        saved = get_user_model().objects.get(pk=user.pk)
+        self.assertEqual((saved.cards_currency, saved.roblox_username), (50 + bool(playable), "builder"))
+        if playable:
+            # the balance of the database is sent, not the one of the loaded user
+            broadcast.assert_called_once_with({user.pk: {"cards_currency": 51}})
+
+    def test_write_behind_flushes_dirty_games(self):
+        registry = LiveGameRegistry(0) # no flusher thread, flushed by hand
+        service = registry.get(self.room.id, lambda: UnoGameService(UnoGame.objects.get(room=self.room), write_behind=True))
+        self.play(5, service)
+        self.assertTrue(service.dirty)
+        self.assertEqual(UnoGame.objects.get(room=self.room).version, 1)
+
+        earned = dict(service.currency)
+        with mock.patch("api_app.services.uno_game_service.broadcast_user_updates") as broadcast, self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(registry.flush(), 1)
+        self.assertEqual(registry.flush(), 0)
+        # the balances written with update() are still sent to the users
+        balances = dict(get_user_model().objects.filter(pk__in=earned).values_list("id", "cards_currency"))
+        self.assertEqual(balances, earned)
+        broadcast.assert_called_once_with({user_id: {"cards_currency": balance} for user_id, balance in balances.items()})
+        saved = UnoGameService(UnoGame.objects.get(room=self.room))
+        self.assertEqual(saved.game.version, service.game.version)
+        self.assertSameGame(saved.state, service.state)
+        self.assertSameGame(rebuild_state(saved.game.log), service.state)
+
+    def test_write_behind_failures_stay_in_their_game(self):
+        registry = LiveGameRegistry(0)
+        broken = mock.Mock(dirty=True)
+        broken.save.side_effect = RuntimeError("database is gone")
+        registry.add("broken", broken)
+        service = registry.get(self.room.id, lambda: UnoGameService(UnoGame.objects.get(room=self.room), write_behind=True))
+        # the same game loaded by another process
+        outdated = registry.get("outdated", lambda: UnoGameService(UnoGame.objects.get(room=self.room), write_behind=True))
+        self.play(3, service)
+        self.play(1, outdated)
+
+        with mock.patch.object(registry, "_notify_outdated") as notify:
+            self.assertEqual(registry.flush(), 1)
+        self.assertFalse(service.dirty)
+        # the outdated game is dropped and its room told, the failed one is kept to be written again
+        notify.assert_called_once_with("outdated")
+        self.assertEqual(list(registry.games), ["broken", self.room.id])
+        broken.save.side_effect = None
+        self.assertEqual(registry.flush(), 1)
+
+
+class CardCatalogViewTests(CachesResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_uno_cards()
+
+    def test_catalog_is_revalidated_with_its_etag(self):
+        response = self.client.get("/cards/catalog/")
+        self.assertEqual(response.status_code, 200)
+        catalog = response.json()
+        self.assertEqual(len(catalog["cards"]), UnoCard.objects.count())
+        self.assertEqual(response["ETag"], f'"{catalog["version"]}"')
+
+        etag = response["ETag"]
+        for if_none_match in [etag, f"W/{etag}", f'"other", {etag}', "*"]:
+            with self.subTest(if_none_match=if_none_match):
+                response = self.client.get("/cards/catalog/", HTTP_IF_NONE_MATCH=if_none_match)
+                self.assertEqual(response.status_code, 304)
+        # a tag containing the version is another tag
+        for if_none_match in [f'"x{catalog["version"]}"', catalog["version"], '"other"']:
+            with self.subTest(if_none_match=if_none_match):
+                response = self.client.get("/cards/catalog/", HTTP_IF_NONE_MATCH=if_none_match)
+                self.assertEqual(response.status_code, 200)
+
+    def test_versioned_catalog_is_immutable(self):
+        version = card_catalog.get_catalog().version
+        response = self.client.get(f"/cards/catalog/?v={version}")
+        self.assertIn("immutable", response["Cache-Control"])
+
+        # saving a card replaces the catalog, and so its version
+        card = UnoCard.objects.get(action="wild", color="black")
+        card.image = "base_cards/new_wild.png"
+        card.save()
+        self.assertNotEqual(card_catalog.get_catalog().version, version)
+        response = self.client.get("/cards/catalog/")
+        self.assertEqual(response["ETag"], f'"{card_catalog.get_catalog().version}"')
+
+
+class GameStateQueryTests(CachesResetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        create_uno_cards()
+        cls.card_back = CardBack.objects.create(name="gold", image="card_back/gold.png", price=10)
+
+    def start_game(self, player_count:int) -> Room:
+        room = Room.objects.create(name="queries", invitation_code=f"QUERIES{player_count}")
+        users = [get_user_model().objects.create(username=f"queries_{player_count}_{number}", room=room) for number in range(player_count)]
+        # half of the players have a card back, the others get the default one
+        for user in users[::2]:
+            CardBackInventory.objects.create(user=user, card_back=self.card_back, is_active=True)
+            user.active_card_back = self.card_back
+            user.save()
+        rules = UnoGameRules()
+        rules.players = users
+        rules.select_base_deck()
+        UnoGameService(UnoGame(room=room)).start_game(rules)
+        return room
+
+    def count_render_queries(self, room:Room) -> int:
+        cosmetics_cache.get_cosmetics() # loaded once per process, not per render
+        with CaptureQueriesContext(connection) as queries:
+            UnoGameService(load_game(room=room)).to_dict()
+        return len(queries)
+
+    def test_render_queries_do_not_depend_on_player_count(self):
+        self.assertEqual(self.count_render_queries(self.start_game(2)), self.count_render_queries(self.start_game(6)))
+
+    def test_activated_card_back_is_read_from_the_user(self):
+        user = get_user_model().objects.create(username="activate")
+        item = CardBackInventory.objects.create(user=user, card_back=self.card_back)
+        client = APIClient()
+        client.force_authenticate(user)
+        response = client.post(f"/shop/card_backs/inventory/activate/{item.id}/")
+        self.assertEqual(response.status_code, 200)
+
+        user = get_user_model().objects.select_related(*ACTIVE_COSMETICS).get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(user.card_back, self.card_back)
+
+    def test_shop_list_is_cached_until_a_card_back_changes(self):
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.create(username="shopper"))
+        client.get("/shop/card_backs/")
+        with self.assertNumQueries(0):
+            response = client.get("/shop/card_backs/")
+        self.assertEqual(len(response.json()), 2)
+
+        CardBack.objects.create(name="silver", image="card_back/silver.png", price=5)
+        self.assertEqual(len(client.get("/shop/card_backs/").json()), 3)
+
+
+class UserBroadcasterTests(SimpleTestCase):
+    async def test_saves_are_coalesced(self):
+        broadcaster = UserUpdateBroadcaster(20)
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add("user_1", channel)
+        broadcaster.subscribe(1)
+
+        broadcaster.mark_dirty(1, {"cards_currency": 5})
+        broadcaster.mark_dirty(1, {"cards_currency": 6, "is_online": True})
+        broadcaster.mark_dirty(2, {"is_online": True}) # nobody can listen with this layer, skipped
+        self.assertEqual(list(broadcaster.pending), [1])
+        await asyncio.sleep(0.1)
+        self.assertEqual((await layer.receive(channel))["data"], {"cards_currency": 6, "is_online": True})
+        self.assertEqual(broadcaster.pending, {})
+        await layer.group_discard("user_1", channel)
+
+    def test_closed_loop_does_not_block_the_next_patches(self):
+        broadcaster = UserUpdateBroadcaster(20)
+        broadcaster.subscribers[1] += 1
+        broadcaster.loop = asyncio.new_event_loop()
+        broadcaster.loop.close()
+        with mock.patch.object(broadcaster, "flush") as flush:
+            broadcaster.mark_dirty(1, {"is_online": True})
+            time.sleep(0.1)
+        # flushed from a timer thread instead
+        flush.assert_called_once()
+
+    def test_other_processes_sockets_are_found_in_the_registry(self):
+        broadcaster = UserUpdateBroadcaster(20) # no socket and no loop in this process
+        registry = MemoryPresence()
+        registry.join(USER_SOCKETS, 2, "socket of another process")
+        layer = mock.Mock(group_send=mock.AsyncMock())
+        with mock.patch("auth_app.broadcaster.get_channel_layer", return_value=layer), mock.patch("auth_app.broadcaster.presence", registry):
+            broadcaster.mark_dirty(2, {"cards_currency": 5})
+            broadcaster.mark_dirty(2, {"cards_currency": 6})
+            broadcaster.mark_dirty(3, {"cards_currency": 1}) # not connected anywhere
+            time.sleep(0.2)
+        layer.group_send.assert_called_once_with("user_2", {"type": "user_update", "data": {"cards_currency": 6}})
+        self.assertEqual((broadcaster.pending, broadcaster.scheduled), ({}, False))
+
+
+class UserPatchTests(TestCase):
+    def test_only_changed_visible_fields_are_sent(self):
+        user = get_user_model().objects.create(username="patched")
+        user = get_user_model().objects.get(pk=user.pk)
+        user.save(update_fields=["last_activity"])
+        self.assertEqual(changed_user_fields(user), [])
+
+        user.cards_currency = 10
+        user.is_online = True
+        user.save(update_fields=["cards_currency"])
+        self.assertEqual(user_patch(user, changed_user_fields(user, ["is_online"])), {"is_online": True})
+        self.assertEqual(changed_user_fields(user), []) # both were remembered
+
+
+class SocketChannelLayerTests(SimpleTestCase):
+    async def test_workers_share_the_groups(self):
+        path = os.path.join(tempfile.mkdtemp(), "channels.sock")
+        server = await asyncio.start_unix_server(ChannelBroker(capacity=2).handle, path=path)
+        first, second = UnixSocketChannelLayer(path), UnixSocketChannelLayer(path) # two workers
+        channels = [await first.new_channel(), await second.new_channel()]
+        self.assertTrue(all(channel.startswith("specific.unix!") for channel in channels))
+        await first.group_add("room", channels[0])
+        await second.group_add("room", channels[1])
+
+        await first.group_send("room", {"type": "move"})
+        self.assertEqual([await first.receive(channels[0]), await second.receive(channels[1])], [{"type": "move"}] * 2)
+        await first.send(channels[1], {"type": "a"})
+        await first.send(channels[1], {"type": "b"})
+        with self.assertRaises(ChannelFull):
+            await first.send(channels[1], {"type": "c"})
+        self.assertEqual((await second.receive(channels[1]))["type"], "a")
+
+        for layer in (first, second):
+            await layer.close()
+            self.assertEqual(len(layer.connections), 0)
+        server.close()
+
+    def test_connections_close_with_their_loop(self):
+        path = os.path.join(tempfile.mkdtemp(), "channels.sock")
+        broker_loop = asyncio.new_event_loop()
+        server = broker_loop.run_until_complete(asyncio.start_unix_server(ChannelBroker().handle, path=path))
+        broker = threading.Thread(target=broker_loop.run_forever, daemon=True)
+        broker.start()
+        layer = UnixSocketChannelLayer(path)
+
+        async def send():
+            await layer.send("room", {"type": "a"})
+            return next(iter(layer.connections.values()))
+
+        # like async_to_sync, every call runs in a new loop
+        connections = [asyncio.run(send()) for _ in range(3)]
+        self.assertTrue(all(connection.closed and connection.writer.is_closing() for connection in connections))
+        self.assertEqual(len(layer.connections), 0)
+        broker_loop.call_soon_threadsafe(broker_loop.stop)
+        broker.join()
+        server.close()
+        broker_loop.run_until_complete(server.wait_closed())
+        broker_loop.close()
+
+
+class RoomReplayTests(SimpleTestCase):
+    def setUp(self):
+        self.numbers = MemorySequencer() # the sequencer shared by the processes
+
+    def send(self, version:int) -> dict:
+        """a game message of room 1, numbered by whichever process sends it"""
+        if version == 1:
+            event = {"type": "websocket_game_state", "game": {"version": 1, "players": []}}
+        else:
+            event = {"type": "websocket_game_patch", "base_version": version - 1, "version": version, "patch": {"version": version}}
+        event["sequence"] = self.numbers.next(1)
+        return event
+
+    @mock.patch.object(room_replay, "BUFFER_SIZE", 3)
+    def test_resume_sends_only_what_was_missed(self):
+        replay = RoomReplay()
+        events = [self.send(version) for version in range(1, 6)]
+        for event in events:
+            replay.add(event)
+        start, last = events[0]["sequence"], self.numbers.last(1)
+
+        game, missed = replay.resume(start + 2, last)
+        self.assertEqual(game["version"], 3)
+        self.assertEqual([event["version"] for event in missed], [4, 5])
+        self.assertEqual(replay.resume(last, last), (game | {"version": 5}, []))
+        self.assertIsNone(replay.resume(start, last)) # no longer kept
+        self.assertIsNone(replay.resume(last + 1, last)) # numbered by nobody
+        self.send(6) # sent, not received here yet
+        self.assertIsNone(replay.resume(last, self.numbers.last(1)))
+
+    def test_processes_share_the_numbers(self):
+        first, second = RoomReplay(), RoomReplay() # the replays of two processes
+        events = [self.send(version) for version in range(1, 6)]
+        for event in events:
+            first.add(event)
+            second.add(event)
+            second.add(event) # received by a second socket of the process
+        last = self.numbers.last(1)
+        for sequence in (events[0]["sequence"], events[2]["sequence"]):
+            self.assertEqual(first.resume(sequence, last), second.resume(sequence, last))
+        self.assertEqual([event["version"] for event in first.resume(events[2]["sequence"], last)[1]], [4, 5])
+
+        # the sockets of a third process missed messages 2 and 3
+        third = RoomReplay()
+        for event in (events[0], events[3], events[4], events[1]): # the late one is ignored
+            third.add(event)
+        self.assertEqual(third.sequence, last)
+        self.assertIsNone(third.resume(events[0]["sequence"], last))
+        self.assertIsNone(third.resume(events[3]["sequence"], last))
+        # until a socket loads the game
+        third.seed({"version": 5, "players": []}, last)
+        self.assertEqual(third.resume(last, last), ({"version": 5, "players": []}, []))
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        self.room = Room.objects.create(name="presence", invitation_code="PRESENCE")
+        self.users = [get_user_model().objects.create(username=f"presence_{number}", room=self.room) for number in range(2)]
+
+    def check_registry(self, create):
+        registry = create(ttl=30)
+        first, second = (user.id for user in self.users)
+        self.assertTrue(registry.join(self.room.id, first, "a"))
+        self.assertFalse(registry.join(self.room.id, first, "b")) # a second tab
+        self.assertTrue(registry.join(self.room.id, second, "c"))
+        self.assertEqual((registry.members(self.room.id), registry.count(self.room.id)), ({first, second}, 2))
+
+        self.assertFalse(registry.leave(self.room.id, first, "a"))
+        self.assertTrue(registry.is_member(self.room.id, first))
+        self.assertTrue(registry.leave(self.room.id, first, "b"))
+        self.assertEqual(registry.members(self.room.id), {second})
+
+        # the connections of a dead process stop sending heartbeats
+        registry.ttl = 0
+        registry.heartbeat(self.room.id, second, "c")
+        self.assertEqual(registry.count(self.room.id), 0)
+        self.assertEqual(registry.sweep(), [(self.room.id, second)])
+        self.assertEqual(registry.sweep(), [])
+        return registry
+
+    def test_memory_registry(self):
+        self.check_registry(MemoryPresence)
+
+    def test_database_registry(self):
+        registry = self.check_registry(DatabasePresence)
+        # the user sockets have no room
+        registry.ttl = 30
+        user_id = self.users[0].id
+        self.assertTrue(registry.join(USER_SOCKETS, user_id, "user socket"))
+        self.assertEqual((registry.is_member(USER_SOCKETS, user_id), registry.is_member(self.room.id, user_id)), (True, False))
+        registry.ttl = 0
+        registry.heartbeat(USER_SOCKETS, user_id, "user socket")
+        self.assertEqual(registry.sweep(), [(USER_SOCKETS, user_id)])
+
+    def check_sequencer(self, sequencer):
+        start = sequencer.last(self.room.id)
+        self.assertEqual([sequencer.next(self.room.id) for _ in range(2)], [start + 1, start + 2])
+        self.assertEqual(sequencer.last(self.room.id), start + 2)
+
+    def test_memory_sequencer(self):
+        self.check_sequencer(MemorySequencer())
+
+    def test_database_sequencer(self):
+        sequencer = DatabaseSequencer()
+        self.check_sequencer(sequencer)
+        # another process numbers the messages after these
+        self.assertEqual(DatabaseSequencer().next(self.room.id), 3)
+        self.assertEqual(sequencer.last(self.room.id), 3)
+        with CaptureQueriesContext(connection) as queries:
+            sequencer.next(self.room.id)
+        self.assertEqual(len(queries), 1 if sequencer._returning() else 4)
+
+        room_id = self.room.id
+        self.room.delete()
+        self.assertEqual((sequencer.next(room_id), sequencer.last(room_id)), (None, 0))
+
+    def test_registries_implement_every_operation(self):
+        class NoSweep(PresenceRegistry):
+            join = heartbeat = leave = is_member = members = MemoryPresence.join
+        with self.assertRaises(TypeError):
+            NoSweep()
+
+
+class LeaderboardTests(CachesResetMixin, TestCase):
+    def test_ranked_list_matches_a_sorted_list(self):
+        rng = random.Random(3)
+        items = [rng.randrange(1000) for _ in range(300)]
+        ranked_list = RankedList(items[:100], bucket_size=4)
+        for item in items[100:]:
+            ranked_list.add(item)
+        for item in items[::3]:
+            ranked_list.remove(item)
+            items.remove(item)
+        items.sort()
+        self.assertEqual(len(ranked_list), len(items))
+        self.assertEqual(ranked_list.slice(0, len(items)), items)
+        self.assertEqual(ranked_list.slice(17, 30), items[17:30])
+        for item in [items[0], items[50], items[-1], 1000]:
+            self.assertEqual(ranked_list.index(item), sum(other < item for other in items))
+        with self.assertRaises(KeyError):
+            ranked_list.remove(1000)
+
+    def test_memory_ranks_follow_the_database(self):
+        rng = random.Random(5)
+        users = [get_user_model().objects.create(username=f"ranked_{number}") for number in range(40)]
+        memory = MemoryRanks()
+        memory.top("games_won", 1) # loaded now, kept up to date by record() from there
+        for _ in range(60):
+            user_ids = [user.id for user in rng.sample(users, 3)]
+            winner = rng.choice(user_ids)
+            for user in get_user_model().objects.filter(pk__in=user_ids):
+                user.games_played += 1
+                user.games_won += user.id == winner
+                user.win_rate = user.games_won / user.games_played
+                get_user_model().objects.filter(pk=user.pk).update(games_played=user.games_played, games_won=user.games_won, win_rate=user.win_rate)
+                memory.record({user.id: (user.games_played, user.games_won, user.win_rate)})
+        database = DatabaseRanks()
+        for metric in memory.metrics:
+            with self.subTest(metric=metric):
+                self.assertEqual(memory.top(metric, 40), database.top(metric, 40))
+                for user in users[::7]:
+                    self.assertEqual(memory.around(metric, user.id, 3), database.around(metric, user.id, 3))
+        memory.discard(users[0].id)
+        self.assertEqual((memory.count(), memory.around("games_won", users[0].id, 3)), (39, (None, [])))
+
+    def test_rank_and_neighbours_follow_the_ordering(self):
+        users = [get_user_model().objects.create(username=f"rank_{number}", games_played=10, games_won=number % 4) for number in range(7)]
+        response = self.client.get("/leaderboard/?sort_by=games_won&limit=3")
+        # ties are broken by the id
+        self.assertEqual([(user["id"], user["rank"]) for user in response.json()], [(users[3].id, 1), (users[2].id, 2), (users[6].id, 3)])
+
+        user = users[5] # won 1, like users[1]
+        user.games_played = 11
+        with self.captureOnCommitCallbacks(execute=True):
+            user.save() # ranked again once committed
+        client = APIClient()
+        client.force_authenticate(user)
+        for sort_by in ["games_won", "games_played", "win_rate", "cards_currency"]:
+            with self.subTest(sort_by=sort_by):
+                order = [entry["id"] for entry in self.client.get(f"/leaderboard/?sort_by={sort_by}&limit=100").json()]
+                me = client.get(f"/leaderboard/me/?sort_by={sort_by}&radius=2").json()
+                position = order.index(user.id)
+                first = max(position - 2, 0)
+                self.assertEqual((me["rank"], me["total"]), (position + 1, 7))
+                self.assertEqual([(entry["id"], entry["rank"]) for entry in me["neighbours"]], [(user_id, first + i + 1) for i, user_id in enumerate(order[first:position + 3])])
+
+    def test_sort_keys_are_validated(self):
+        self.assertEqual(self.client.get("/leaderboard/?sort_by=password").status_code, 400)
+        get_user_model().objects.create(username="rich", cards_currency=500)
+        response = self.client.get("/leaderboard/?sort_by=cards_currency&limit=1")
+        self.assertEqual(response.json()[0]["username"], "rich")
+
+    def test_sizes_are_validated(self):
+        client = APIClient()
+        client.force_authenticate(get_user_model().objects.create(username="alone"))
+        for url in ["/leaderboard/?limit=0", "/leaderboard/?limit=-5", "/leaderboard/?limit=ten", "/leaderboard/me/?radius=-1"]:
+            with self.subTest(url=url):
+                self.assertEqual(client.get(url).status_code, 400)
+        me = client.get("/leaderboard/me/?radius=0").json()
+        self.assertEqual([entry["username"] for entry in me["neighbours"]], ["alone"])
@@ -1,7 +1,7 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 from api_app.consummers import chat_consummer, uno_game_consummer, user_consummer
-from api_app.views import room, script, shop, leaderboard, avatar  # added import for avatar
+from api_app.views import room, script, shop, leaderboard, avatar, cards  # added import for avatar
 
 router = DefaultRouter()
 
@@ -32,7 +32,10 @@ urlpatterns = [
   path("shop/game_environments/inventory/", shop.GameEnvironmentInventoryView.as_view(), name="game_environment_inventory"),
   path("shop/game_environments/inventory/activate/<int:inventory_id>/", shop.GameEnvironmentInventoryView.as_view(), name="activate_game_environment"),
   
+  path("cards/catalog/", cards.CardCatalogView.as_view(), name="card_catalog"),
+
   path("leaderboard/", leaderboard.LeaderboardView.as_view(), name="leaderboard"),
+  path("leaderboard/me/", leaderboard.LeaderboardMeView.as_view(), name="leaderboard_me"),
   
   # New routes for avatar models
   path("avatar/<str:player_name>/model/", avatar.AvatarModelView.as_view(), name="avatar_model"),
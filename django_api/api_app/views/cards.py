@@ -0,0 +1,37 @@
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.permissions import AllowAny
+from rest_framework.response import Response
+from rest_framework.views import APIView
+from api_app.services.card_catalog import get_catalog
+
+
+class CardCatalogView(APIView):
+    """
+    Every uno card, so game payloads can refer to cards by id.
+    The catalog only changes when the cards do, its version is a hash of the cards:
+    clients revalidate with the ETag, and a url with ?v=<version> can be cached forever.
+    """
+    permission_classes = [AllowAny]
+    authentication_classes = []
+
+    def get(self, request):
+        catalog = get_catalog()
+        etag = f'"{catalog.version}"'
+
+        # a list of tags or "*", compared weakly like django's conditional views
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        if "*" in if_none_match or etag in [tag.removeprefix("W/") for tag in if_none_match]:
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(
+                {"version": catalog.version, "cards": catalog.to_list()}, status=status.HTTP_200_OK
+            )
+
+        response["ETag"] = etag
+        if request.query_params.get("v") == catalog.version:
+            response["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            # the latest catalog, always revalidated (a 304 when nothing changed)
+            response["Cache-Control"] = "public, no-cache"
+        return response
@@ -1,17 +1,61 @@
 from rest_framework.views import APIView
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework import status
+from api_app.services.leaderboard import ORDERINGS, ranks_for
 from auth_app.models import CustomUser
-from django.db.models import F, ExpressionWrapper, FloatField, Case, When, Value
-from django.db.models.functions import Cast
+
+MAX_LIMIT = 100
+
+
+def ranked(user_ids:list, first_rank:int=1) -> list:
+    """the public users in the order of the ranks, the ids of users deleted meanwhile are skipped"""
+    users = CustomUser.objects.in_bulk(user_ids)
+    return [
+        {**users[user_id].to_dict_public(), "rank": first_rank + i}
+        for i, user_id in enumerate(user_ids) if user_id in users
+    ]
+
 
 class LeaderboardView(APIView):
     def get(self, request):
         sort_by = request.query_params.get('sort_by', 'games_won')
-        limit = int(request.query_params.get('limit', 10))
-        
-        queryset = CustomUser.objects.all().order_by(f'-{sort_by}')[:limit]
-        
-        leaderboard_data = [user.to_dict_public() for user in queryset]
-        
-        return Response(leaderboard_data, status=status.HTTP_200_OK)
+        if sort_by not in ORDERINGS:
+            return Response({"error": "Invalid sort_by"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(int(request.query_params.get('limit', 10)), MAX_LIMIT)
+        except ValueError:
+            return Response({"error": "Invalid limit"}, status=status.HTTP_400_BAD_REQUEST)
+        if limit < 1:
+            # a negative slice is not supported by querysets
+            return Response({"error": "Invalid limit"}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(ranked(ranks_for(sort_by).top(sort_by, limit)), status=status.HTTP_200_OK)
+
+
+class LeaderboardMeView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        """the rank of the user and the users around them"""
+        sort_by = request.query_params.get('sort_by', 'games_won')
+        if sort_by not in ORDERINGS:
+            return Response({"error": "Invalid sort_by"}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            radius = min(int(request.query_params.get('radius', 5)), MAX_LIMIT // 2)
+        except ValueError:
+            return Response({"error": "Invalid radius"}, status=status.HTTP_400_BAD_REQUEST)
+        if radius < 0:
+            return Response({"error": "Invalid radius"}, status=status.HTTP_400_BAD_REQUEST)
+
+        ranks = ranks_for(sort_by)
+        rank, user_ids = ranks.around(sort_by, request.user.pk, radius)
+        if rank is None:
+            return Response({"error": "User not ranked"}, status=status.HTTP_404_NOT_FOUND)
+        first_rank = rank - user_ids.index(request.user.pk)
+
+        return Response({
+            "rank": rank,
+            "total": ranks.count(),
+            "neighbours": ranked(user_ids, first_rank),
+        }, status=status.HTTP_200_OK)
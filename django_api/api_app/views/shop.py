@@ -11,16 +11,14 @@ from api_app.models.shop import (
     GameEnvironmentInventory,
 )
 from api_app.models.uno import CardBack
+from api_app.services.cosmetics_cache import get_cosmetics
 
 
 class CardBackListView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        card_backs = CardBack.objects.all()
-        return Response(
-            [card_back.to_dict() for card_back in card_backs], status=status.HTTP_200_OK
-        )
+        return Response(get_cosmetics().card_back_list(), status=status.HTTP_200_OK)
 
 
 class PurchaseCardBackView(APIView):
@@ -71,6 +69,8 @@ class CardBackInventoryView(APIView):
         CardBackInventory.objects.filter(user=request.user).update(is_active=False)
         inventory_item.is_active = True
         inventory_item.save()
+        request.user.active_card_back = inventory_item.card_back
+        request.user.save(update_fields=["active_card_back"])
         return Response({"success": "Card back activated"}, status=status.HTTP_200_OK)
 
 
@@ -78,10 +78,7 @@ class ProfileEffectListView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        profile_effects = ProfileEffect.objects.all()
-        return Response(
-            [effect.to_dict() for effect in profile_effects], status=status.HTTP_200_OK
-        )
+        return Response(get_cosmetics().profile_effect_list(), status=status.HTTP_200_OK)
 
 
 class PurchaseProfileEffectView(APIView):
@@ -132,6 +129,8 @@ class ProfileEffectInventoryView(APIView):
         ProfileEffectInventory.objects.filter(user=request.user).update(is_active=False)
         inventory_item.is_active = True
         inventory_item.save()
+        request.user.active_profile_effect = inventory_item.profile_effect
+        request.user.save(update_fields=["active_profile_effect"])
         return Response(
             {"success": "Profile effect activated"}, status=status.HTTP_200_OK
         )
@@ -141,10 +140,7 @@ class GameEnvironmentListView(APIView):
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
-        game_environments = GameEnvironment.objects.all()
-        return Response(
-            [env.to_dict() for env in game_environments], status=status.HTTP_200_OK
-        )
+        return Response(get_cosmetics().game_environment_list(), status=status.HTTP_200_OK)
 
 
 class PurchaseGameEnvironmentView(APIView):
@@ -197,6 +193,8 @@ class GameEnvironmentInventoryView(APIView):
         )
         inventory_item.is_active = True
         inventory_item.save()
+        request.user.active_game_environment = inventory_item.game_environment
+        request.user.save(update_fields=["active_game_environment"])
         return Response(
             {"success": "Game environment activated"}, status=status.HTTP_200_OK
         )
@@ -58,11 +58,57 @@ INSTALLED_APPS = [
 
 ASGI_APPLICATION = "api_project.asgi.application"
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
+# "memory" only reaches the sockets of its own process, with several workers use
+# "unix" (a broker shared by the workers of the host, see `manage.py channel_broker`)
+# or "redis" (any number of hosts). A channel holds at most CHANNEL_LAYER_CAPACITY messages
+CHANNEL_LAYER = os.getenv('CHANNEL_LAYER', 'memory')
+CHANNEL_LAYER_CAPACITY = int(os.getenv('CHANNEL_LAYER_CAPACITY', '100'))
+CHANNEL_LAYER_SOCKET = os.getenv('CHANNEL_LAYER_SOCKET', '/tmp/uno-channels.sock')
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {
+                "hosts": [os.getenv('CHANNEL_LAYER_REDIS_URL', 'redis://localhost:6379/1')],
+                "capacity": CHANNEL_LAYER_CAPACITY,
+            },
+        }
     }
-}
+elif CHANNEL_LAYER == 'unix':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "api_app.services.socket_channel_layer.UnixSocketChannelLayer",
+            "CONFIG": {"path": CHANNEL_LAYER_SOCKET},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": {"capacity": CHANNEL_LAYER_CAPACITY},
+        }
+    }
+
+# keep the games being played in memory and write them every UNO_WRITE_BEHIND_FLUSH_MS
+# instead of at every move. Needs every socket of a room on the same process
+UNO_WRITE_BEHIND = os.getenv('UNO_WRITE_BEHIND', 'False') == 'True'
+UNO_WRITE_BEHIND_FLUSH_MS = int(os.getenv('UNO_WRITE_BEHIND_FLUSH_MS', '500'))
+
+# who is connected to each room: "memory" (one process only), "database" or "redis",
+# shared by every process. Sockets that stop sending heartbeats leave after UNO_PRESENCE_TTL seconds
+UNO_PRESENCE_BACKEND = os.getenv('UNO_PRESENCE_BACKEND', 'memory')
+UNO_PRESENCE_REDIS_URL = os.getenv('UNO_PRESENCE_REDIS_URL', 'redis://localhost:6379/0')
+UNO_PRESENCE_TTL = int(os.getenv('UNO_PRESENCE_TTL', '30'))
+# what numbers the game messages of each room, the same choices as UNO_PRESENCE_BACKEND (and the same by default)
+UNO_SEQUENCE_BACKEND = os.getenv('UNO_SEQUENCE_BACKEND', UNO_PRESENCE_BACKEND)
+UNO_SEQUENCE_REDIS_URL = os.getenv('UNO_SEQUENCE_REDIS_URL', UNO_PRESENCE_REDIS_URL)
+# where the leaderboard ranks are kept, the same choices as UNO_PRESENCE_BACKEND (and the same by default).
+# memory and redis keep them sorted and updated at the end of each game, database counts them in SQL
+UNO_LEADERBOARD_BACKEND = os.getenv('UNO_LEADERBOARD_BACKEND', UNO_PRESENCE_BACKEND)
+UNO_LEADERBOARD_REDIS_URL = os.getenv('UNO_LEADERBOARD_REDIS_URL', UNO_PRESENCE_REDIS_URL)
+
+# the user_update messages of a user are sent at most once per window
+USER_UPDATE_WINDOW_MS = int(os.getenv('USER_UPDATE_WINDOW_MS', '250'))
 
 MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",  # Mettre au début ou avant le CommonMiddleware
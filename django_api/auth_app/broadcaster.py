@@ -0,0 +1,86 @@
+import asyncio
+import threading
+from collections import Counter
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import InMemoryChannelLayer, get_channel_layer
+from django.conf import settings
+from api_app.services.presence import USER_SOCKETS, presence
+
+
+class UserUpdateBroadcaster:
+    """
+    Coalesces the user_update messages. A save only merges the fields it changed into
+    the pending patch of the user, and this process sends at most one patch per user
+    per `window_ms`, whoever listens to it.
+    The flush runs on the event loop of the user sockets, or in a timer thread in a
+    process that has none (a worker only serving requests).
+    A user with no socket in this process gets its patch only if one of its sockets is
+    in the shared presence registry, and never when the channel layer is in memory
+    (nobody else can listen).
+    """
+    def __init__(self, window_ms:int):
+        self.window = window_ms / 1000
+        self.lock = threading.Lock()
+        self.subscribers = Counter() # user id -> sockets open in this process
+        self.pending = {} # user id -> fields to send
+        self.loop = None # the loop of the sockets, the flushes run on it
+        self.scheduled = False
+
+    def subscribe(self, user_id:int):
+        """called by a user socket when it connects, from its event loop"""
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.subscribers[user_id] += 1
+
+    def unsubscribe(self, user_id:int):
+        with self.lock:
+            self.subscribers[user_id] -= 1
+            if self.subscribers[user_id] <= 0:
+                del self.subscribers[user_id]
+
+    def is_listened(self, user_id:int) -> bool:
+        """False when no socket can receive the updates of this user, without asking the registry"""
+        return user_id in self.subscribers or not isinstance(get_channel_layer(), InMemoryChannelLayer)
+
+    def mark_dirty(self, user_id:int, patch:dict):
+        """send these fields in the next window. Can be called from any thread"""
+        with self.lock:
+            if not self.is_listened(user_id):
+                return
+            self.pending.setdefault(user_id, {}).update(patch)
+            if self.scheduled:
+                return
+            self.scheduled = True
+            loop = self.loop
+        try:
+            loop.call_soon_threadsafe(loop.call_later, self.window, self._start_flush)
+        except (AttributeError, RuntimeError):
+            # no loop in this process, or it is closed
+            timer = threading.Timer(self.window, async_to_sync(self.flush))
+            timer.daemon = True
+            timer.start()
+
+    def _start_flush(self):
+        self.loop.create_task(self.flush())
+
+    async def flush(self):
+        with self.lock:
+            pending = self.pending
+            local = set(self.subscribers)
+            self.pending = {}
+            self.scheduled = False
+
+        channel_layer = get_channel_layer()
+        shared = not isinstance(channel_layer, InMemoryChannelLayer)
+        for user_id, patch in pending.items():
+            try:
+                # the socket may be on another process
+                if user_id not in local and not (shared and await database_sync_to_async(presence.is_member)(USER_SOCKETS, user_id)):
+                    continue
+                await channel_layer.group_send(f"user_{user_id}", {"type": "user_update", "data": patch})
+            except Exception as e:
+                print(f"Failed to send user update for user {user_id}: {str(e)}")
+
+
+user_broadcaster = UserUpdateBroadcaster(getattr(settings, "USER_UPDATE_WINDOW_MS", 250))
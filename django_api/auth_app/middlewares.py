@@ -13,5 +13,5 @@ class LastActivityTraceMiddleware:
         user: User  = request.user
         if user.is_authenticated and user.last_activity < now() - timedelta(minutes=5):
             user.last_activity = now()
-            user.save()
+            user.save(update_fields=["last_activity"])
         return response
\ No newline at end of file
@@ -0,0 +1,45 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_active_cosmetics(apps, schema_editor):
+    """copy the active inventory items to the user"""
+    CustomUser = apps.get_model("auth_app", "CustomUser")
+    inventories = [
+        ("CardBackInventory", "card_back", "active_card_back"),
+        ("GameEnvironmentInventory", "game_environment", "active_game_environment"),
+        ("ProfileEffectInventory", "profile_effect", "active_profile_effect"),
+    ]
+    for model_name, item_field, user_field in inventories:
+        Inventory = apps.get_model("api_app", model_name)
+        for item in Inventory.objects.filter(is_active=True).order_by("id"):
+            CustomUser.objects.filter(pk=item.user_id).update(**{f"{user_field}_id": getattr(item, f"{item_field}_id")})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("api_app", "0011_unogamelog"),
+        ("auth_app", "0005_customuser_roblox_username"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customuser",
+            name="active_card_back",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="api_app.cardback"),
+        ),
+        migrations.AddField(
+            model_name="customuser",
+            name="active_game_environment",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="api_app.gameenvironment"),
+        ),
+        migrations.AddField(
+            model_name="customuser",
+            name="active_profile_effect",
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name="+", to="api_app.profileeffect"),
+        ),
+        migrations.RunPython(backfill_active_cosmetics, migrations.RunPython.noop),
+    ]
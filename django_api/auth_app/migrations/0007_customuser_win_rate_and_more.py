@@ -0,0 +1,43 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:20
+
+from django.db import migrations, models
+from django.db.models import FloatField
+from django.db.models.functions import Cast
+
+
+def backfill_win_rate(apps, schema_editor):
+    CustomUser = apps.get_model("auth_app", "CustomUser")
+    CustomUser.objects.filter(games_played__gt=0).update(
+        win_rate=Cast("games_won", FloatField()) / Cast("games_played", FloatField())
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth_app", "0006_customuser_active_cosmetics"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="customuser",
+            name="win_rate",
+            field=models.FloatField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name="customuser",
+            name="cards_currency",
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name="customuser",
+            name="games_played",
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.AlterField(
+            model_name="customuser",
+            name="games_won",
+            field=models.IntegerField(db_index=True, default=0),
+        ),
+        migrations.RunPython(backfill_win_rate, migrations.RunPython.noop),
+    ]
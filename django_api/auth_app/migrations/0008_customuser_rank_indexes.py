@@ -0,0 +1,49 @@
+# Generated by Django 5.1.6 on 2026-10-18 13:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("auth_app", "0007_customuser_win_rate_and_more"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="customuser",
+            name="cards_currency",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="customuser",
+            name="games_played",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="customuser",
+            name="games_won",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="customuser",
+            name="win_rate",
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name="customuser",
+            index=models.Index(fields=["-games_won", "-games_played", "id"], name="user_rank_games_won"),
+        ),
+        migrations.AddIndex(
+            model_name="customuser",
+            index=models.Index(fields=["-games_played", "-games_won", "id"], name="user_rank_games_played"),
+        ),
+        migrations.AddIndex(
+            model_name="customuser",
+            index=models.Index(fields=["-win_rate", "-games_played", "id"], name="user_rank_win_rate"),
+        ),
+        migrations.AddIndex(
+            model_name="customuser",
+            index=models.Index(fields=["-cards_currency", "id"], name="user_rank_cards_currency"),
+        ),
+    ]
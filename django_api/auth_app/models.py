@@ -1,90 +1,162 @@
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.db import models
-from django.db.models.signals import post_save
+from django.db.models.signals import post_init, post_save
 from django.dispatch import receiver
-from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
 import json
 
 
 class CustomUser(AbstractUser):
     profile_picture = models.ImageField(upload_to='profile_pictures/', null=True, blank=True)
     room = models.ForeignKey("api_app.Room", on_delete=models.SET_NULL, null=True, blank=True, related_name="users")
+    # the leaderboard sorts on these, see Meta.indexes
     cards_currency = models.IntegerField(default=0)
     games_played = models.IntegerField(default=0)
     games_won = models.IntegerField(default=0)
+    win_rate = models.FloatField(default=0) # games_won / games_played, updated at the end of each game
     is_online = models.BooleanField(default=False)
     last_activity = models.DateTimeField(auto_now=True)
     roblox_username = models.CharField(max_length=50, null=True, blank=True)
 
+    # the active cosmetics, set when an inventory item is activated.
+    # The dicts only need the ids (see api_app.services.cosmetics_cache), load users with
+    # select_related(*ACTIVE_COSMETICS) to read the instances without a query
+    active_card_back = models.ForeignKey("api_app.CardBack", on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    active_game_environment = models.ForeignKey("api_app.GameEnvironment", on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+    active_profile_effect = models.ForeignKey("api_app.ProfileEffect", on_delete=models.SET_NULL, null=True, blank=True, related_name="+")
+
     @property
     def card_back(self):
-        active_card = self.card_back_inventory.filter(is_active=True).first()
-        return active_card.card_back if active_card else None
+        return self.active_card_back
 
     @property
     def game_environment(self):
-        active_game_env = self.game_environment_inventory.filter(is_active=True).first()
-        return active_game_env.game_environment if active_game_env else None
+        return self.active_game_environment
     
     @property
     def profile_effect(self):
-        active_effect = self.profile_effect_inventory.filter(is_active=True).first()
-        return active_effect.profile_effect if active_effect else None
+        return self.active_profile_effect
 
     @property
     def active_profile_effects(self):
         return self.profile_effect_inventory.filter(is_active=True).all()
 
     def to_dict(self) -> dict:
+        from api_app.services.cosmetics_cache import get_cosmetics
         return {
             'id': self.id,
             'username': self.username,
             'profile_picture': f"{settings.MEDIA_FULL_URL}{self.profile_picture}"  if self.profile_picture else None,
-            'room_id': self.room.id if self.room else None,
+            'room_id': self.room_id,
             'cards_currency': self.cards_currency,
             'games_played': self.games_played,
             'games_won': self.games_won,
+            'win_rate': self.win_rate,
             'is_online': self.is_online,
             'last_activity': self.last_activity.isoformat(),
-            'profile_effect': self.profile_effect.name if self.profile_effect else "default",
+            'profile_effect': get_cosmetics().profile_effect_name(self.active_profile_effect_id),
             'roblox_username': self.roblox_username,
         }
     
     def to_dict_public(self) -> dict:
+        from api_app.services.cosmetics_cache import get_cosmetics
         return {
             'id': self.id,
             'username': self.username,
             "profile_picture": f"{settings.MEDIA_FULL_URL}{self.profile_picture}" if self.profile_picture else None,
             'games_played': self.games_played,
             'games_won': self.games_won,
-            'profile_effect': self.profile_effect.name if self.profile_effect else "default",
+            'win_rate': self.win_rate,
+            'profile_effect': get_cosmetics().profile_effect_name(self.active_profile_effect_id),
             'is_online': self.is_online,
             'roblox_username': self.roblox_username,
         }
 
+    class Meta(AbstractUser.Meta):
+        # one per leaderboard ordering (api_app.views.leaderboard.ORDERINGS), in the same order:
+        # a page is an index scan, a rank an index range count
+        indexes = [
+            models.Index(fields=["-games_won", "-games_played", "id"], name="user_rank_games_won"),
+            models.Index(fields=["-games_played", "-games_won", "id"], name="user_rank_games_played"),
+            models.Index(fields=["-win_rate", "-games_played", "id"], name="user_rank_win_rate"),
+            models.Index(fields=["-cards_currency", "id"], name="user_rank_cards_currency"),
+        ]
+
+
+ACTIVE_COSMETICS = ["active_card_back", "active_game_environment", "active_profile_effect"]
+
 
 class CustomUserManager(BaseUserManager):
     pass
 
 
+# model field -> key of to_dict() sent to the user when it changes.
+# last_activity is not sent on its own, it changes on most saves
+USER_UPDATE_FIELDS = {
+    "username": "username",
+    "profile_picture": "profile_picture",
+    "room": "room_id",
+    "cards_currency": "cards_currency",
+    "games_played": "games_played",
+    "games_won": "games_won",
+    "win_rate": "win_rate",
+    "is_online": "is_online",
+    "active_profile_effect": "profile_effect",
+    "roblox_username": "roblox_username",
+}
+
+
+def _sent_values(user:CustomUser) -> dict:
+    """the values of USER_UPDATE_FIELDS, without the deferred fields"""
+    values = {}
+    for name in USER_UPDATE_FIELDS:
+        attname = CustomUser._meta.get_field(name).attname
+        if attname in user.__dict__:
+            value = user.__dict__[attname]
+            values[name] = getattr(value, "name", value) # files are compared by name
+    return values
+
+
+def changed_user_fields(user:CustomUser, update_fields=None) -> list:
+    """the fields of USER_UPDATE_FIELDS saved with a new value since the user was loaded
+    (or last saved), and remember the new values
+    """
+    current = _sent_values(user)
+    if update_fields is not None:
+        current = {name: value for name, value in current.items() if name in update_fields}
+    loaded = user.__dict__.get("_sent_values", {})
+    changed = [name for name, value in current.items() if name not in loaded or loaded[name] != value]
+    loaded.update(current)
+    user._sent_values = loaded
+    return changed
+
+
+def user_patch(user:CustomUser, fields:list) -> dict:
+    data = user.to_dict()
+    return {USER_UPDATE_FIELDS[name]: data[USER_UPDATE_FIELDS[name]] for name in fields}
+
+
+def broadcast_user_updates(patches:dict):
+    """send users changed by an update() (which fires no signal), `patches` is user id -> changed fields"""
+    from auth_app.broadcaster import user_broadcaster
+    for user_id, patch in patches.items():
+        user_broadcaster.mark_dirty(user_id, patch)
+
+
+@receiver(post_init, sender=CustomUser)
+def remember_sent_values(sender, instance:CustomUser, **kwargs):
+    instance._sent_values = _sent_values(instance)
+
+
 @receiver(post_save, sender=CustomUser)
-def user_updated(sender, instance:CustomUser, **kwargs):
+def user_updated(sender, instance:CustomUser, created=False, update_fields=None, **kwargs):
     """
     Signal handler to broadcast user updates to connected clients
+    only the fields the clients see and that changed are sent, nothing at all when there
+    is none. The patch is coalesced with the other changes of the user (see auth_app.broadcaster)
     """
-    channel_layer = get_channel_layer()
-    if channel_layer:
-        # Send to user-specific group
-        try:
-            async_to_sync(channel_layer.group_send)(
-                f"user_{instance.id}",
-                {
-                    "type": "user_update",
-                    "data": instance.to_dict()
-                }
-            )
-        except Exception as e:
-            # Handle any channel layer errors
-            print(f"Failed to send user update for user {instance.id}: {str(e)}")
\ No newline at end of file
+    from auth_app.broadcaster import user_broadcaster
+    fields = changed_user_fields(instance, update_fields)
+    if created or not fields or not user_broadcaster.is_listened(instance.id):
+        return
+    user_broadcaster.mark_dirty(instance.id, user_patch(instance, fields))
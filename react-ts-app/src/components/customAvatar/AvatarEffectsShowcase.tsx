@@ -37,6 +37,7 @@ export const AvatarEffectsShowcase: React.FC<AvatarEffectsShowcaseProps> = ({
         cards_currency: 100,
         games_played: 10,
         games_won: 5,
+        win_rate: 0.5,
         room_id: 0,
         profile_effect: effect,
     });
@@ -36,11 +36,13 @@ export const UserProvider: React.FC<UserProviderProps> = ({ children }) => {
         newSocket.onmessage = (event) => {
             try {
                 const message = JSON.parse(event.data);
-                if (message.type === "user_data" || message.type === "user_update") {
+                if (message.type === "user_data") {
                     console.log("Received user data");
-                    // Transform snake_case to camelCase for React
-                    const userData = message.data;
-                    setUser(userData);
+                    setUser(message.data);
+                } else if (message.type === "user_update") {
+                    // only the fields that changed are sent
+                    const changes: Partial<IUser> = message.data;
+                    setUser((previous) => (previous ? { ...previous, ...changes } : previous));
                 }
             } catch (err) {
                 console.error("Error processing WebSocket message:", err);
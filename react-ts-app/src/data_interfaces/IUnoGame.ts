@@ -3,11 +3,13 @@ import IUnoPlayer from './IUnoPlayer';
 
 export default interface IUnoGame {
     id?: number;
+    version?: number;
     players: IUnoPlayer[];
     current_player_number: string;
     current_card: IUnoCard;
     pile: IUnoCard[] | number;
     direction: boolean;
+    stored_to_draw?: number;
     winner?: IUnoPlayer;
     card_back: IUnoCard;
     game_over?: boolean;
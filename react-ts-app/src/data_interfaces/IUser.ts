@@ -7,6 +7,7 @@ export interface IUser {
     cards_currency: number;
     games_played: number;
     games_won: number;
+    win_rate: number;
     room_id: number;
     profile_effect: string;
     roblox_username?: string | undefined;
@@ -18,6 +19,7 @@ export interface IPublicUser {
     profile_picture?: string | undefined;
     games_played: number;
     games_won: number;
+    win_rate: number;
     profile_effect: string;
     roblox_username?: string | undefined;
 }
\ No newline at end of file
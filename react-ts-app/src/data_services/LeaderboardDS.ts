@@ -3,7 +3,7 @@ import CustomAxios from "./CustomAxios";
 import { IPublicUser } from "../data_interfaces/IUser";
 
 interface LeaderboardParams {
-  sort_by?: 'games_won' | 'games_played'; 
+  sort_by?: 'games_won' | 'games_played' | 'win_rate' | 'cards_currency';
   limit?: number;
 }
 
@@ -1,5 +1,11 @@
 import { BehaviorSubject } from "rxjs";
 import IUnoGame from "@DI/IUnoGame";
+import IUnoPlayer from "@DI/IUnoPlayer";
+
+// changes sent by the server after each move, players are keyed by player number
+interface IUnoGamePatch extends Partial<Omit<IUnoGame, "players">> {
+    players?: Record<string, Partial<IUnoPlayer>>;
+}
 
 export class UnoGameWebsocketDS {
     private socket: WebSocket | null = null;
@@ -8,6 +14,8 @@ export class UnoGameWebsocketDS {
     private reconnectAttempts = 0;
     private maxReconnectAttempts = 5;
     private reconnectTimeout: number | null = null;
+    // sequence of the last game message, a reconnection only gets the ones after it
+    private lastSequence: number | null = null;
 
     // Observable for game state updates
     public gameState$ = new BehaviorSubject<IUnoGame | null>(null);
@@ -29,7 +37,8 @@ export class UnoGameWebsocketDS {
         this.connectionStatus$.next("connecting");
 
         // Connect to WebSocket with authentication token
-        const wsUrl = `${import.meta.env.VITE_WS_URL}ws/rooms/${this.roomId}/uno/?token=${this.token}`;
+        const resume = this.lastSequence !== null ? `&last_seq=${this.lastSequence}` : "";
+        const wsUrl = `${import.meta.env.VITE_WS_URL}ws/rooms/${this.roomId}/uno/?token=${this.token}&deltas=1${resume}`;
         this.socket = new WebSocket(wsUrl);
 
         this.socket.onopen = () => {
@@ -42,9 +51,18 @@ export class UnoGameWebsocketDS {
             // console.log("TEST 4 : Received message from UnoGame WebSocket:", event.data);
             try {
                 const data = JSON.parse(event.data);
+                if (data.sequence !== undefined) {
+                    if (this.lastSequence !== null && data.sequence < this.lastSequence) {
+                        return; // already applied
+                    }
+                    this.lastSequence = data.sequence;
+                }
                 if (data.type === "game_state") {
                     this.gameState$.next(data.game);
                 }
+                else if (data.type === "game_patch") {
+                    this.applyPatch(data.base_version, data.patch);
+                }
                 else if (data.type === "player_count") {
                     this.connectedCount$.next(data.count);
                 }
@@ -94,6 +112,23 @@ export class UnoGameWebsocketDS {
         }
     }
 
+    private applyPatch(baseVersion: number, patch: IUnoGamePatch) {
+        const game = this.gameState$.value;
+        if (!game || game.version !== baseVersion) {
+            // we missed a move, ask for the whole game again
+            this.send({ type: "sync" });
+            return;
+        }
+        const { players, ...changes } = patch;
+        this.gameState$.next({
+            ...game,
+            ...changes,
+            players: players
+                ? game.players.map((player) => players[player.player_number] ? { ...player, ...players[player.player_number] } : player)
+                : game.players,
+        });
+    }
+
     private send(message: unknown) {
         // console.log("TEST 8 : Sending message to UnoGame WebSocket:", message);
         if (this.socket && this.socket.readyState === WebSocket.OPEN) {
@@ -125,18 +160,19 @@ export class UnoGameWebsocketDS {
             type: "play_card",
             card_id: cardId,
             color: color,
+            version: this.gameState$.value?.version,
         });
     }
 
     drawCard() {
-        this.send({ type: "draw_card" });
+        this.send({ type: "draw_card", version: this.gameState$.value?.version });
     }
 
     sayUno() {
-        this.send({ type: "say_uno" });
+        this.send({ type: "say_uno", version: this.gameState$.value?.version });
     }
 
     denyUno( playerId: number) {
-        this.send({ type: "deny_uno", player_id: playerId });
+        this.send({ type: "deny_uno", player_id: playerId, version: this.gameState$.value?.version });
     }
 }